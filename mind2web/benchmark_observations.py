@@ -0,0 +1,99 @@
+"""
+Time per-step observation building: the utils.env code eval_sample used before StepObservations
+(loaded from git at --baseline_rev, so later changes to utils.env do not leak into it) vs. one shared
+StepObservations. Differing outputs can come from fixes made to utils.env since, not only from regressions.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import numpy as np
+from utils.data import load_json, add_scores
+from utils.env import get_raw_target, StepObservations
+
+# utils/env.py before the observation-building changes (StepObservations, raw_html fallback): the initial tree
+BASELINE_REV = "2cf42d3"
+
+
+def load_baseline_env(rev: str):
+    """utils/env.py as of git revision `rev`, imported as a standalone module."""
+    source = subprocess.run(
+        ["git", "show", f"{rev}:./utils/env.py"], cwd=os.path.dirname(os.path.abspath(__file__)),
+        check=True, capture_output=True, text=True,
+    ).stdout
+    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
+        f.write(source)
+    try:
+        spec = importlib.util.spec_from_file_location("baseline_env", f.name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.remove(f.name)
+    return module
+
+
+baseline_env = None  # set in __main__
+
+
+def legacy_step(s: dict, previous_top_k: int, top_k: int) -> tuple:
+    """The three calls eval_sample used to make, each parsing the step's HTML on its own (baseline code)."""
+    target = baseline_env.get_target_obs_and_act(s)
+    previous = baseline_env.get_top_k_obs(s, previous_top_k)
+    current = baseline_env.get_top_k_obs(s, top_k) if s["pos_candidates"] else None
+    return target, previous, current
+
+
+def shared_step(s: dict, previous_top_k: int, top_k: int) -> tuple:
+    # Start cold: the raw_html target cache would otherwise carry over between runs of a step
+    get_raw_target.cache_clear()
+    step = StepObservations(s)
+    target = step.target_obs_and_act()
+    previous = step.top_k_obs(previous_top_k)
+    current = step.top_k_obs(top_k) if s["pos_candidates"] else None
+    return target, previous, current
+
+
+def summarize(name: str, seconds: list):
+    ms = np.array(seconds) * 1000
+    print(f"{name:>8}: mean {ms.mean():8.2f} ms  median {np.median(ms):8.2f} ms  p95 {np.percentile(ms, 95):8.2f} ms  total {ms.sum() / 1000:8.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--benchmark", type=str, default="test_task",
+        choices=["test_task", "test_website", "test_domain", "train"])
+    parser.add_argument("--website", type=str, default=None, help="Only this website (default: all)")
+    parser.add_argument("--score_path", type=str, default="data/scores_all_data.pkl")
+    parser.add_argument("--previous_top_k_elements", type=int, default=3)
+    parser.add_argument("--top_k_elements", type=int, default=5)
+    parser.add_argument("--max_steps", type=int, default=500)
+    parser.add_argument("--baseline_rev", type=str, default=BASELINE_REV,
+        help="Git revision whose utils/env.py is the legacy implementation")
+    args = parser.parse_args()
+
+    baseline_env = load_baseline_env(args.baseline_rev)
+
+    examples = load_json(args.data_dir, args.benchmark)
+    if args.website:
+        examples = [s for s in examples if s["website"] == args.website]
+    examples = add_scores(examples, score_path=args.score_path)
+    steps = [s for sample in examples for s in sample["actions"]][:args.max_steps]
+
+    timings = {"legacy": [], "shared": []}
+    mismatches = 0
+    for s in steps:
+        results = {}
+        for name, fn in (("legacy", legacy_step), ("shared", shared_step)):
+            start = time.perf_counter()
+            results[name] = fn(s, args.previous_top_k_elements, args.top_k_elements)
+            timings[name].append(time.perf_counter() - start)
+        mismatches += results["legacy"] != results["shared"]
+
+    print(f"{len(steps)} steps, {mismatches} with differing output")
+    for name, seconds in timings.items():
+        summarize(name, seconds)
+    print(f"speedup: {sum(timings['legacy']) / max(sum(timings['shared']), 1e-9):.2f}x")
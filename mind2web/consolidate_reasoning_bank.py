@@ -0,0 +1,28 @@
+"""Merge near-duplicate memories in a Reasoning Bank and report how much it shrank."""
+
+import json
+import argparse
+from utils.reasoning_bank import ReasoningBank, ShardedReasoningBank
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--memory_path", type=str, default="data/reasoning_bank.json",
+                        help="Path to the reasoning bank JSON file")
+    parser.add_argument("--memory_embeddings_path", type=str, default="data/reasoning_bank_embeddings.json",
+                        help="Path to the reasoning bank embeddings JSON file")
+    parser.add_argument("--threshold", type=float, default=0.95,
+                        help="Cosine similarity at or above which items (same domain and score) are merged")
+    parser.add_argument("--sharded", action="store_true",
+                        help="The bank is stored as per-domain shards")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only report what would be merged")
+    args = parser.parse_args()
+
+    bank_cls = ShardedReasoningBank if args.sharded else ReasoningBank
+    bank = bank_cls(storage_path=args.memory_path, embedding_path=args.memory_embeddings_path)
+    report = bank.consolidate(threshold=args.threshold, dry_run=args.dry_run)
+
+    print(json.dumps(report, indent=2))
+    print(f"{'Would remove' if args.dry_run else 'Removed'} {report['removed']} of {report['before']} memories "
+          f"({100 * report['shrink_ratio']:.1f}%).")
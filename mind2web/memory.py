@@ -4,23 +4,23 @@ from pathlib import Path
 from openai import BadRequestError
 from utils.env import *
 from utils.llm import (
-    generate_response, num_tokens_from_messages,
-    MAX_TOKENS, extract_from_response,
+    generate_response, MAX_TOKENS, extract_from_response,
 )
-from utils.reasoning_bank import ReasoningBank
+from utils.reasoning_bank import get_reasoning_bank
+from utils.obs_cache import get_observation_cache
+from utils.prefetch import step_observations
+from utils.token_counter import get_token_counter
 from utils.distiller import MemoryDistiller
 
 import logging
 logger = logging.getLogger(__name__)
 
-# Initialize Bank and Distiller
-# Note: In a real distributed setting, we might need a more robust singleton or DB
-# reasoning_bank = ReasoningBank() # Removed global instantiation
+# Initialize Distiller (banks are obtained per path from the process-wide registry)
 memory_distiller = MemoryDistiller()
 
 
-def get_relevant_memories(args, task_query: str, domain: str, retrieve_type: str, reasoning_bank: ReasoningBank) -> str:
-    """Retrieve relevant memories from Reasoning Bank and format them for the prompt."""
+def get_relevant_memories(args, task_query: str, domain: str, retrieve_type: str, reasoning_bank) -> str:
+    """Retrieve relevant memories from `reasoning_bank` (a ReasoningBank or ShardedReasoningBank) and format them for the prompt."""
     memories = reasoning_bank.retrieve(task_query, top_k=3, domain=domain, retrieve_type=retrieve_type)
 
     if not memories:
@@ -71,23 +71,20 @@ from pathlib import Path
 from openai import BadRequestError
 from utils.env import *
 from utils.llm import (
-    generate_response, num_tokens_from_messages,
-    MAX_TOKENS, extract_from_response,
+    generate_response, MAX_TOKENS, extract_from_response,
 )
-from utils.reasoning_bank import ReasoningBank
+from utils.reasoning_bank import get_reasoning_bank
 from utils.distiller import MemoryDistiller
 
 import logging
 logger = logging.getLogger(__name__)
 
-# Initialize Bank and Distiller
-# Note: In a real distributed setting, we might need a more robust singleton or DB
-# reasoning_bank = ReasoningBank() # Removed global instantiation
+# Initialize Distiller (banks are obtained per path from the process-wide registry)
 memory_distiller = MemoryDistiller()
 
 
-def get_relevant_memories(args, task_query: str, domain: str, retrieve_type: str, reasoning_bank: ReasoningBank) -> str:
-    """Retrieve relevant memories from Reasoning Bank and format them for the prompt."""
+def get_relevant_memories(args, task_query: str, domain: str, retrieve_type: str, reasoning_bank) -> str:
+    """Retrieve relevant memories from `reasoning_bank` (a ReasoningBank or ShardedReasoningBank) and format them for the prompt."""
     memories = reasoning_bank.retrieve(task_query, top_k=3, domain=domain, retrieve_type=retrieve_type)
 
     if not memories:
@@ -104,8 +101,8 @@ def get_relevant_memories(args, task_query: str, domain: str, retrieve_type: str
     return formatted_memories
 
 
-def get_exemplars(args) -> list:
-    """Get exemplar workflows in the prompt."""
+def get_exemplars(args, rng: random.Random = None) -> list:
+    """Get exemplar workflows in the prompt; concrete examples are sampled with `rng` (default: the global RNG)."""
     # workflow memory
     memory = []
     workflow_text = open(args.workflow_path, 'r').read().strip()
@@ -126,21 +123,40 @@ def get_exemplars(args) -> list:
             if all([tag in cex[0].get("specifier", "") for tag in [args.domain, args.subdomain] if tag is not None])
         ]
 
-    memory += random.sample(concrete_examples, 
+    memory += (rng or random).sample(concrete_examples, 
         min(args.retrieve_top_k, len(concrete_examples)))
     memory = [[{k:v for k,v in m.items() if k!="specifier"} for m in e] for e in memory]
     return memory
 
 
-def eval_sample(task_id, args, sample):
+def reasoning_bank_kwargs(args) -> dict:
+    """ReasoningBank options from the command line (see run_mind2web.py)."""
+    return {
+        "capacity": args.memory_capacity,
+        "dedup_threshold": args.dedup_threshold,
+        "index_type": args.index_type,
+        "ann_nprobe": args.ann_nprobe,
+        "ann_min_size": args.ann_min_size,
+        "hybrid_fusion": args.hybrid_fusion,
+        "hybrid_dense_weight": args.hybrid_dense_weight,
+    }
+
+
+def eval_sample(task_id, args, sample, prefetched=None):
+    """Evaluate one sample; `prefetched` holds futures of its step observations (see utils.prefetch.StepPrefetcher)."""
     # initialize metrics
     element_acc, action_f1, step_success, success = [], [], [], []
-    token_stats = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    token_stats = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
     conversation = []
     episode_length = len(sample["action_reprs"])
 
-    exemplars = get_exemplars(args)
+    # The stable layout fixes the exemplars per website, so samples of a website share the prompt prefix
+    stable_layout = args.prompt_layout == "stable"
+    exemplars = get_exemplars(args, rng=random.Random(args.website) if stable_layout else None)
     # print(exemplars)
+    # Exemplars are fixed for the sample: count them once, then fit each step's prompt by prefix sums
+    token_counter = get_token_counter(args.model)
+    exemplar_tokens = token_counter.prefix_tokens(exemplars)
 
     # --- Reasoning Bank Injection ---
     relevant_memories = ""
@@ -150,15 +166,20 @@ def eval_sample(task_id, args, sample):
         
         if args.is_memory_transfer_custom:
             # Custom logic to retrieve from two separate banks and combine
+            # Banks stay resident across samples; identical paths share one instance and index
             # Private bank for current task's domain
-            private_bank = ReasoningBank(
+            private_bank = get_reasoning_bank(
                 storage_path=args.private_memory_path,
-                embedding_path=args.private_memory_embeddings_path
+                embedding_path=args.private_memory_embeddings_path,
+                sharded=args.shard_by_domain,
+                **reasoning_bank_kwargs(args)
             )
             # Transfer bank for other domains
-            transfer_bank = ReasoningBank(
+            transfer_bank = get_reasoning_bank(
                 storage_path=args.transfer_memory_path,
-                embedding_path=args.transfer_memory_embeddings_path
+                embedding_path=args.transfer_memory_embeddings_path,
+                sharded=args.shard_by_domain,
+                **reasoning_bank_kwargs(args)
             )
 
             # Retrieve from private bank (top 3)
@@ -183,9 +204,11 @@ def eval_sample(task_id, args, sample):
 
         else:
             # Standard logic: use a single reasoning bank
-            standard_reasoning_bank = ReasoningBank(
+            standard_reasoning_bank = get_reasoning_bank(
                 storage_path=args.private_memory_path, # Using private_memory_path for consistency
-                embedding_path=args.private_memory_embeddings_path
+                embedding_path=args.private_memory_embeddings_path,
+                sharded=args.shard_by_domain,
+                **reasoning_bank_kwargs(args)
             )
             relevant_memories = get_relevant_memories(args, sample['confirmed_task'], current_domain, args.retrieve_type, standard_reasoning_bank)
             reasoning_bank_for_update = standard_reasoning_bank
@@ -201,20 +224,33 @@ def eval_sample(task_id, args, sample):
             "content": full_system_content,
         }
     ]
+    memory_message = []
+    if stable_layout:
+        # Most static content first (action space, then workflow and exemplars), then the per-sample
+        # memories and the trajectory, so provider-side prompt caching can reuse the prefix
+        sys_message = [{"role": "system", "content": base_system_prompt}]
+        if relevant_memories:
+            memory_message = [{"role": "system", "content": relevant_memories.strip()}]
 
     prev_actions, prev_obs = [], []
     previous_k = 5
 
-    for s, act_repr in zip(sample["actions"], sample["action_reprs"]):
-        _, target_act = get_target_obs_and_act(s)
-        pos_candidates = [
-            c for c in s["pos_candidates"] if c["rank"] < args.top_k_elements
-        ]
+    # Observations depend only on the data; read them from the precomputed cache if one is given
+    obs_cache = None
+    if prefetched is None and args.obs_cache_path:
+        obs_cache = get_observation_cache(args.obs_cache_path)
 
-        # get query, obs, act
-        target_obs, _ = get_top_k_obs(s, args.previous_top_k_elements)
+    for step_index, (s, act_repr) in enumerate(zip(sample["actions"], sample["action_reprs"])):
+        # get query, obs, act (computed ahead by worker processes when prefetched)
+        if prefetched is not None:
+            step_obs = prefetched[step_index].result()
+        else:
+            step_obs = step_observations(
+                s, sample["annotation_id"], args.previous_top_k_elements, args.top_k_elements, obs_cache
+            )
+        target_act, target_obs = step_obs["target_act"], step_obs["target_obs"]
         # Continue next loop if the ground truth element is not in the cleaned html
-        if len(pos_candidates) == 0:
+        if step_obs["obs"] is None:
             element_acc.append(0)
             action_f1.append(0)
             step_success.append(0)
@@ -235,7 +271,7 @@ def eval_sample(task_id, args, sample):
                 query.append({"role": "user", "content": o})
             query.append({"role": "assistant", "content": a})
         
-        obs, _ = get_top_k_obs(s, args.top_k_elements, use_raw=False)
+        obs = step_obs["obs"]
         if len(query) == 0:
             query.append({
                 "role": "user",
@@ -249,7 +285,7 @@ def eval_sample(task_id, args, sample):
         prev_actions.append("Action: `" + target_act + "` (" + act_repr + ")")
         
         # token limit
-        total_num_tokens = num_tokens_from_messages(sys_message + query, args.model)
+        total_num_tokens = token_counter.count(sys_message + memory_message + query)
         if total_num_tokens > MAX_TOKENS[args.model]:
             logger.info(
                 f"Too many tokens in acting ({total_num_tokens} / {MAX_TOKENS[args.model]}), skipping..."
@@ -259,27 +295,21 @@ def eval_sample(task_id, args, sample):
             step_success.append(0)
             conversation.append(
                 {
-                    "input": sys_message + query,
+                    "input": sys_message + memory_message + query,
                     "output": f"FAILED DUE TO THE CONTEXT LIMIT: {total_num_tokens}",
                 }
             )
             continue
 
         # message
-        demo_message = []
-        for e_id, e in enumerate(exemplars):
-            total_num_tokens = num_tokens_from_messages(
-                sys_message + demo_message + e + query, args.model
+        num_exemplars = token_counter.fit(exemplar_tokens, MAX_TOKENS[args.model] - total_num_tokens)
+        if num_exemplars < len(exemplars):
+            logger.info(
+                f"Using {num_exemplars} / {len(exemplars)} exemplars due to context limit"
             )
-            if total_num_tokens > MAX_TOKENS[args.model]:
-                logger.info(
-                    f"Using {e_id} / {len(exemplars)} exemplars due to context limit"
-                )
-                break
-            else:
-                demo_message.extend(e)
+        demo_message = [m for e in exemplars[:num_exemplars] for m in e]
 
-        message = sys_message + demo_message + query
+        message = sys_message + demo_message + memory_message + query
         try:
             response, info = generate_response(
                 messages=message,
@@ -294,6 +324,7 @@ def eval_sample(task_id, args, sample):
                 "prompt_tokens": 0,
                 "completion_tokens": 0,
                 "total_tokens": 0,
+                "cached_tokens": 0,
             }
         conversation.append({"input": message, "output": response, "token_stats": info})
         for k, v in info.items():
@@ -328,14 +359,14 @@ def eval_sample(task_id, args, sample):
     else:
         success.append(0)
 
-    conversation.append(
-        {
-            "element_acc": element_acc,
-            "action_f1": action_f1,
-            "step_success": step_success,
-            "success": success,
-        }
-    )
+    metrics = {
+        "element_acc": element_acc,
+        "action_f1": action_f1,
+        "step_success": step_success,
+        "success": success,
+        "token_stats": token_stats,
+    }
+    conversation.append(metrics)
     # log_dir = Path(f"{args.log_dir}/{args.model}/{args.benchmark}/{args.website}/{args.suffix}")
     log_dir = Path(args.log_dir)
     log_dir.mkdir(parents=True, exist_ok=True)
@@ -369,16 +400,15 @@ def eval_sample(task_id, args, sample):
                     prompt_type="success"
                 )
 
-                # Store each memory item as a separate entry with its own embedding
+                # Store each memory item as a separate entry with its own embedding (one batched write)
                 if success_memory_items:
-                    for item in success_memory_items:
-                        reasoning_bank_for_update.add_memory_item(
-                            task_query=sample['confirmed_task'],
-                            memory_item=item,
-                            outcome="SUCCESS",
-                            domain=args.domain if args.domain else "",
-                            context=f"Successful steps from task (Total: {len(success_steps)} steps)"
-                        )
+                    reasoning_bank_for_update.add_memory_items(
+                        task_query=sample['confirmed_task'],
+                        memory_items=success_memory_items,
+                        outcome="SUCCESS",
+                        domain=args.domain if args.domain else "",
+                        context=f"Successful steps from task (Total: {len(success_steps)} steps)"
+                    )
                     logger.info(f"Distilled and saved {len(success_memory_items)} success memory items for task {task_id}")
 
             # Distill failed steps separately
@@ -392,18 +422,18 @@ def eval_sample(task_id, args, sample):
                     prompt_type="failure"
                 )
 
-                # Store each memory item as a separate entry with its own embedding
+                # Store each memory item as a separate entry with its own embedding (one batched write)
                 if failure_memory_items:
-                    for item in failure_memory_items:
-                        reasoning_bank_for_update.add_memory_item(
-                            task_query=sample['confirmed_task'],
-                            memory_item=item,
-                            outcome="FAILURE",
-                            domain=args.domain if args.domain else "",
-                            context=f"Failed steps from task (Total: {len(failure_steps)} steps)"
-                        )
+                    reasoning_bank_for_update.add_memory_items(
+                        task_query=sample['confirmed_task'],
+                        memory_items=failure_memory_items,
+                        outcome="FAILURE",
+                        domain=args.domain if args.domain else "",
+                        context=f"Failed steps from task (Total: {len(failure_steps)} steps)"
+                    )
                     logger.info(f"Distilled and saved {len(failure_memory_items)} failure memory items for task {task_id}")
 
         except Exception as e:
             logger.error(f"Error during Reasoning Bank update: {e}")
 
+    return metrics
@@ -225,7 +225,7 @@ if __name__ == "__main__":
     parser.add_argument("--transfer_memory_embeddings_path", type=str, help="Path to the transfer memory embeddings file.")
 
     # Retrieve type
-    parser.add_argument("--retrieve_type", type=str, default="embedding", choices=["bm25", "embedding"], help="Type of retrieval method to use")
+    parser.add_argument("--retrieve_type", type=str, default="embedding", choices=["bm25", "embedding", "ann", "hybrid"], help="Type of retrieval method to use")
 
     args = parser.parse_args()
 
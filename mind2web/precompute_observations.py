@@ -0,0 +1,47 @@
+"""Precompute the model-independent step observations of a Mind2Web split into an observation cache."""
+
+import argparse
+from tqdm import tqdm
+from utils.data import load_json, add_scores
+from utils.env import StepObservations
+from utils.obs_cache import ObservationCache
+
+
+def precompute_sample(cache: ObservationCache, sample: dict, top_k_values: list) -> int:
+    """Compute and store the observations of every step of `sample` that are not cached yet."""
+    items = {}
+    for s in sample["actions"]:
+        keys = {cache.target_key(sample["annotation_id"], s): None}
+        keys.update({cache.top_k_key(sample["annotation_id"], s, k): k for k in top_k_values})
+        cached = cache.contains(keys)
+        step = StepObservations(s)
+        for key, k in keys.items():
+            if key in cached:
+                continue
+            items[key] = list(step.target_obs_and_act()) if k is None else list(step.top_k_obs(k))
+    cache.put_many(items)
+    return len(items)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, default="data")
+    parser.add_argument("--benchmark", type=str, default="test_task",
+        choices=["test_task", "test_website", "test_domain", "train"])
+    parser.add_argument("--website", type=str, default=None, help="Only this website (default: all)")
+    parser.add_argument("--score_path", type=str, default="data/scores_all_data.pkl")
+    parser.add_argument("--obs_cache_path", type=str, required=True)
+    parser.add_argument("--top_k_values", type=int, nargs="+", default=[3, 5],
+        help="Values of --previous_top_k_elements / --top_k_elements that runs will use")
+    args = parser.parse_args()
+
+    examples = load_json(args.data_dir, args.benchmark)
+    if args.website:
+        examples = [s for s in examples if s["website"] == args.website]
+    examples = add_scores(examples, score_path=args.score_path)
+
+    cache = ObservationCache(args.obs_cache_path)
+    added = 0
+    for sample in tqdm(examples):
+        added += precompute_sample(cache, sample, args.top_k_values)
+    print(f"Added {added} observations; {len(cache)} cached in {args.obs_cache_path}")
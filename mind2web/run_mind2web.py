@@ -1,7 +1,13 @@
 import os
+import json
 import argparse
+import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from memory import eval_sample
+from utils.llm import set_rate_limit
+from utils.prefetch import StepPrefetcher
+from utils.reasoning_bank import query_cache_stats
 from utils.data import load_json, add_scores
 
 import logging
@@ -12,21 +18,96 @@ handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)
 logger.addHandler(handler)
 
 
+def evaluate(examples: list, indices: list) -> dict:
+    """Run eval_sample on examples[i] for each index; returns {index: metrics} of the samples that finished."""
+    results = {}
+    parallel = args.parallel
+    if parallel > 1 and args.enable_reasoning_bank:
+        # Each sample reads the memories written by the ones before it
+        logger.warning("Reasoning bank enabled: evaluating samples sequentially")
+        parallel = 1
+
+    # HTML processing of upcoming samples runs in worker processes while LLM requests are in flight
+    prefetcher = None
+    if args.prefetch_workers > 0:
+        prefetcher = StepPrefetcher(
+            examples, indices, args.previous_top_k_elements, args.top_k_elements,
+            obs_cache_path=args.obs_cache_path, workers=args.prefetch_workers, lookahead=max(parallel, 1) + 1,
+        )
+
+    def run(i: int) -> dict:
+        prefetched = prefetcher.steps(i) if prefetcher is not None else None
+        return eval_sample(i, args, examples[i], prefetched=prefetched)
+
+    try:
+        if parallel <= 1:
+            for i in tqdm(indices):
+                results[i] = run(i)
+            return results
+
+        # Samples are independent; each writes its own result file as soon as it finishes
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {executor.submit(run, i): i for i in indices}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    logger.error(f"Sample {i} failed: {e}")
+        return results
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+
+def summarize(results: dict) -> dict:
+    """Per-sample metrics in index order, and their averages over samples."""
+    samples = []
+    for i in sorted(results):
+        metrics = results[i]
+        samples.append({
+            "task_id": i,
+            "element_acc": float(np.mean(metrics["element_acc"])) if metrics["element_acc"] else 0.0,
+            "action_f1": float(np.mean(metrics["action_f1"])) if metrics["action_f1"] else 0.0,
+            "step_success": float(np.mean(metrics["step_success"])) if metrics["step_success"] else 0.0,
+            "success": metrics["success"][0],
+        })
+    overall = {
+        k: float(np.mean([sample[k] for sample in samples])) if samples else 0.0
+        for k in ["element_acc", "action_f1", "step_success", "success"]
+    }
+    token_stats = {}
+    for metrics in results.values():
+        for k, v in metrics.get("token_stats", {}).items():
+            token_stats[k] = token_stats.get(k, 0) + v
+    return {"num_samples": len(samples), "overall": overall, "token_stats": token_stats, "samples": samples}
+
+
 def main():
     examples = load_json(args.data_dir, args.benchmark)
     examples = [s for s in examples if s["website"] == args.website]
     print(f"Filtering down to #{len(examples)} examples on website [{args.website}]")
     examples = add_scores(examples) # add prediction scores and ranks to elements
 
+    if args.mode == "action":
+        raise NotImplementedError
+    elif args.mode != "memory":
+        raise ValueError(f"Unsupported workflow format: {args.workflow_format}")
+    set_rate_limit(args.requests_per_minute, args.tokens_per_minute)
+
     if args.end_idx is None:
         args.end_idx = len(examples)
-    for i in tqdm(range(args.start_idx, args.end_idx)):
-        if args.mode == "memory":
-            eval_sample(i, args, examples[i])
-        elif args.mode == "action":
-            raise NotImplementedError
-        else:
-            raise ValueError(f"Unsupported workflow format: {args.workflow_format}")
+    indices = list(range(args.start_idx, args.end_idx))
+    summary = summarize(evaluate(examples, indices))
+    logger.info(f"Evaluated {summary['num_samples']} / {len(indices)} samples: {summary['overall']}")
+    if args.summary_path:
+        os.makedirs(os.path.dirname(args.summary_path) or ".", exist_ok=True)
+        with open(args.summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.enable_reasoning_bank:
+        for path, stats in query_cache_stats().items():
+            logger.info(f"Retrieval cache for {path}: {stats}")
 
 
 if __name__ == "__main__":
@@ -45,6 +126,10 @@ if __name__ == "__main__":
     parser.add_argument("--previous_top_k_elements", type=int, default=3)
     parser.add_argument("--top_k_elements", type=int, default=5)
     parser.add_argument("--retrieve_top_k", type=int, default=1)
+    parser.add_argument("--prompt_layout", type=str, default="default", choices=["default", "stable"],
+        help="stable: static content first and exemplars fixed per website, so provider prompt caching applies")
+    parser.add_argument("--obs_cache_path", type=str, default=None,
+        help="Observation cache (see precompute_observations.py); missing steps are computed and added")
 
     # workflow
     parser.add_argument("--website", type=str, required=True)
@@ -67,7 +152,15 @@ if __name__ == "__main__":
     parser.add_argument("--enable_reasoning_bank", type=str2bool, default=False, help="Enable reading/writing from Reasoning Bank")
     parser.add_argument("--private_memory_path", type=str, default="data/reasoning_bank.json", help="Path to the reasoning bank JSON file")
     parser.add_argument("--private_memory_embeddings_path", type=str, default="data/reasoning_bank_embeddings.json", help="Path to the reasoning bank embeddings JSON file")
-    parser.add_argument("--retrieve_type", type=str, default="embedding", choices=["bm25", "embedding"], help="Type of retrieval method to use")
+    parser.add_argument("--retrieve_type", type=str, default="embedding", choices=["bm25", "embedding", "ann", "hybrid"], help="Type of retrieval method to use")
+    parser.add_argument("--shard_by_domain", type=str2bool, default=False, help="Store reasoning banks as per-domain shards (an existing bank is split on first use)")
+    parser.add_argument("--memory_capacity", type=int, default=None, help="Maximum number of items per reasoning bank; the lowest-utility items are evicted to an archive file")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Skip new memory items at least this similar (cosine) to an existing item of the same domain and outcome")
+    parser.add_argument("--index_type", type=str, default="exact", choices=["exact", "ivf"], help="Embedding search: exact scan, or the approximate IVF index")
+    parser.add_argument("--ann_nprobe", type=int, default=8, help="IVF lists probed per query (higher: better recall, slower)")
+    parser.add_argument("--ann_min_size", type=int, default=10_000, help="Banks with fewer embedded items are always searched exactly")
+    parser.add_argument("--hybrid_fusion", type=str, default="rrf", choices=["rrf", "zscore"], help="How hybrid retrieval fuses embedding and BM25 scores")
+    parser.add_argument("--hybrid_dense_weight", type=float, default=0.5, help="Weight of the embedding score in hybrid retrieval (BM25 gets the rest)")
 
     # memory transfer custom
     parser.add_argument("--is_memory_transfer_custom", type=str2bool, default=False, help="Enable custom memory transfer logic")
@@ -79,6 +172,13 @@ if __name__ == "__main__":
     parser.add_argument("--start_idx", type=int, default=0, help="Select example index.")
     parser.add_argument("--end_idx", type=int, default=None, help="Select example index.")
 
+    # concurrency
+    parser.add_argument("--parallel", type=int, default=1, help="Number of samples evaluated concurrently (sequential when the reasoning bank is enabled)")
+    parser.add_argument("--requests_per_minute", type=int, default=None, help="Limit on LLM requests per minute across all workers")
+    parser.add_argument("--tokens_per_minute", type=int, default=None, help="Limit on LLM tokens per minute across all workers")
+    parser.add_argument("--prefetch_workers", type=int, default=0, help="Worker processes computing step observations ahead of the LLM calls (0: computed inline)")
+    parser.add_argument("--summary_path", type=str, default=None, help="Write per-sample metrics (in index order) and their averages to this JSON file")
+
     args = parser.parse_args()
 
     # sanity check
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Tests for the batched, cached embedding service.
+Runs against a local fake embedding function, so no API key or network is needed.
+"""
+import sys
+import os
+import tempfile
+import threading
+sys.path.insert(0, os.path.dirname(__file__))
+
+from utils.embedding_service import EmbeddingService, EmbeddingCache
+
+
+class FakeEmbedder:
+    """Deterministic stand-in for the embeddings API that records every request."""
+
+    def __init__(self, delay: threading.Event = None):
+        self.calls = []
+        self.delay = delay
+
+    def __call__(self, texts, model):
+        if self.delay is not None:
+            self.delay.wait(timeout=5)
+        self.calls.append(list(texts))
+        return [[float(len(t)), float(sum(map(ord, t)) % 97), 1.0] for t in texts]
+
+
+def test_batches_and_deduplicates():
+    fake = FakeEmbedder()
+    service = EmbeddingService(fake, batch_size=2)
+    vectors = service.embed_many(["a", "bb", "a", "ccc", "bb"], "m")
+
+    assert vectors[0] == vectors[2] and vectors[1] == vectors[4]
+    # 3 unique texts in batches of 2
+    assert fake.calls == [["a", "bb"], ["ccc"]]
+
+
+def test_persistent_cache_skips_seen_text():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite")
+        fake = FakeEmbedder()
+        first = EmbeddingService(fake, cache=EmbeddingCache(path)).embed_many(["task one", "task\ntwo"], "m")
+
+        # A new process (new service, same file) makes zero calls for seen text
+        fake_again = FakeEmbedder()
+        second = EmbeddingService(fake_again, cache=EmbeddingCache(path)).embed_many(["task two", "task one"], "m")
+        assert fake_again.calls == []
+        assert second == [first[1], first[0]]
+
+        # Different model -> different key
+        EmbeddingService(fake_again, cache=EmbeddingCache(path)).embed("task one", "other-model")
+        assert fake_again.calls == [["task one"]]
+
+
+def test_cache_is_opened_on_first_request():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "data", "cache.sqlite")
+        service = EmbeddingService(FakeEmbedder(), open_cache=lambda: EmbeddingCache(path))
+        assert not os.path.exists(os.path.dirname(path))
+        vector = service.embed("task one", "m")
+        assert os.path.exists(path)
+        assert EmbeddingCache(path).get_many(["missing"]) == {}
+        assert EmbeddingService(FakeEmbedder(), cache=EmbeddingCache(path)).embed("task one", "m") == vector
+
+
+def test_cache_eviction_is_bounded():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = EmbeddingCache(os.path.join(tmp, "cache.sqlite"), max_entries=10)
+        service = EmbeddingService(FakeEmbedder(), cache=cache)
+        service.embed_many([f"text {i}" for i in range(25)], "m")
+        assert len(cache) <= 10
+
+
+def test_inflight_requests_are_shared():
+    gate = threading.Event()
+    fake = FakeEmbedder(delay=gate)
+    service = EmbeddingService(fake)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.embed("same", "m"))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    gate.set()
+    for t in threads:
+        t.join()
+
+    assert len(results) == 4 and all(r == results[0] for r in results)
+    assert sum(len(c) for c in fake.calls) == 1
+
+
+def test_failure_propagates_and_releases_keys():
+    def broken(texts, model):
+        raise RuntimeError("boom")
+
+    service = EmbeddingService(broken)
+    try:
+        service.embed("x", "m")
+        assert False, "expected failure"
+    except RuntimeError:
+        pass
+    service.embed_fn = FakeEmbedder()
+    assert service.embed("x", "m") == [1.0, float(ord("x") % 97), 1.0]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✓ {name}")
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Tests for the reasoning bank's storage and retrieval.
+Embeddings come from a local bag-of-words fake, so no API key or network is needed.
+"""
+import sys
+import os
+import json
+import tempfile
+import zlib
+sys.path.insert(0, os.path.dirname(__file__))
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
+
+import numpy as np
+from utils import reasoning_bank
+from utils.reasoning_bank import BM25Index, ReasoningBank, ShardedReasoningBank, get_reasoning_bank
+
+QUERIES = ["search flights to paris", "add item to shopping cart", "filter results by price", "sign in to account"]
+RETRIEVE_TYPES = ["embedding", "bm25", "hybrid"]
+
+
+def fake_embedding(text):
+    """Hashed bag of words, so texts sharing words are similar."""
+    vec = np.zeros(32)
+    for word in text.lower().split():
+        vec[zlib.crc32(word.encode()) % 32] += 1.0
+    return vec.tolist()
+
+
+reasoning_bank.get_embedding = fake_embedding
+reasoning_bank.get_embeddings = lambda texts: [fake_embedding(t) for t in texts]
+
+
+def make_items(n, topic):
+    return [{"title": f"{topic} strategy {i}", "description": f"how to {topic} step {i}",
+             "content": f"to {topic} use the {['search box', 'cart button', 'price filter', 'login form'][i % 4]} first"}
+            for i in range(n)]
+
+
+def fill(bank):
+    bank.add_memory_items("search flights to paris", make_items(3, "search flights"), "SUCCESS", domain="travel")
+    bank.add_memory_items("buy a shirt", make_items(4, "add to cart"), "FAILURE", domain="shopping")
+    bank.add_memory_items("book a hotel", make_items(2, "filter hotels by price"), "SUCCESS", domain="travel")
+
+
+def results(bank, domain=None):
+    return {(query, retrieve_type): [(round(score, 6), entry["id"]) for score, entry in
+                                     bank.retrieve_scored(query, top_k=4, domain=domain, retrieve_type=retrieve_type)]
+            for query in QUERIES for retrieve_type in RETRIEVE_TYPES}
+
+
+def paths(tmp, name="bank"):
+    return os.path.join(tmp, f"{name}.json"), os.path.join(tmp, f"{name}_embeddings.json")
+
+
+def test_journal_round_trip():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = ReasoningBank(storage_path, embedding_path, query_cache_size=0)
+        fill(bank)
+        expected, expected_travel = results(bank), results(bank, domain="travel")
+        # Nothing is snapshotted yet: the items live in the journal
+        assert not os.path.exists(storage_path) and os.path.exists(bank.journal_path)
+
+        reopened = ReasoningBank(storage_path, embedding_path, query_cache_size=0)
+        assert [m["id"] for m in reopened.memories] == [m["id"] for m in bank.memories]
+        assert results(reopened) == expected and results(reopened, domain="travel") == expected_travel
+
+        reopened.compact()
+        assert not os.path.exists(reopened.journal_path)
+        compacted = ReasoningBank(storage_path, embedding_path, query_cache_size=0)
+        assert results(compacted) == expected and results(compacted, domain="travel") == expected_travel
+
+
+def test_torn_journal_record_is_dropped():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = ReasoningBank(storage_path, embedding_path)
+        fill(bank)
+        with open(bank.journal_path, 'a', encoding='utf-8') as f:
+            f.write('{"op": "add", "entry": {"id": "torn"')
+
+        reopened = ReasoningBank(storage_path, embedding_path)
+        assert [m["id"] for m in reopened.memories] == [m["id"] for m in bank.memories]
+        with open(bank.journal_path, 'rb') as f:
+            assert f.read().endswith(b"\n")
+
+
+def test_registry_reloads_stale_bank():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = get_reasoning_bank(storage_path, embedding_path)
+        fill(bank)
+        assert get_reasoning_bank(storage_path, embedding_path) is bank
+
+        # Another process writes to the same files
+        ReasoningBank(storage_path, embedding_path).add_memory_item("sign in", make_items(1, "sign in")[0], "SUCCESS", domain="account")
+        reloaded = get_reasoning_bank(storage_path, embedding_path)
+        assert reloaded is not bank and len(reloaded.memories) == len(bank.memories) + 1
+
+
+def test_registry_keys_on_bank_options():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        plain = get_reasoning_bank(storage_path, embedding_path)
+        bounded = get_reasoning_bank(storage_path, embedding_path, capacity=5, hybrid_fusion="zscore", eviction_weights={"hits": 2.0})
+        assert bounded is not plain and plain.capacity is None
+        assert bounded.capacity == 5 and bounded.hybrid_fusion == "zscore" and bounded.eviction_weights["hits"] == 2.0
+        assert get_reasoning_bank(storage_path, embedding_path, hybrid_fusion="zscore", eviction_weights={"hits": 2.0}, capacity=5) is bounded
+
+        sharded = get_reasoning_bank(storage_path, embedding_path, sharded=True, index_type="ivf")
+        assert isinstance(sharded, ShardedReasoningBank) and sharded.bank_kwargs == {"index_type": "ivf"}
+
+
+def test_bm25_index_is_persisted():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = ReasoningBank(storage_path, embedding_path)
+        fill(bank)
+        bank.retrieve_scored("search flights", retrieve_type="bm25")
+        assert os.path.exists(bank.bm25_index_path)
+
+        # Inserts and the queries after them do not rewrite the index; a reload indexes the journaled tail
+        saved = []
+        original_save = BM25Index.save
+        original_add = BM25Index.add
+        BM25Index.save = lambda self, path: saved.append(path) or original_save(self, path)
+        BM25Index.add = lambda self, *args: added.append(args[0]) or original_add(self, *args)
+        try:
+            added = []
+            bank.add_memory_items("sign in", make_items(2, "sign in"), "SUCCESS", domain="account")
+            expected = bank.retrieve_scored("add item to shopping cart", top_k=4, retrieve_type="bm25")
+            assert saved == []
+            added = []
+            reopened = ReasoningBank(storage_path, embedding_path)
+            assert [(s, e["id"]) for s, e in reopened.retrieve_scored("add item to shopping cart", top_k=4, retrieve_type="bm25")] == \
+                [(s, e["id"]) for s, e in expected]
+            assert added == [m["id"] for m in bank.memories[-2:]] and saved == []
+
+            # The snapshot saves the full index, so the next process loads it without indexing anything
+            bank.compact()
+            assert saved == [bank.bm25_index_path]
+            added = []
+            reopened = ReasoningBank(storage_path, embedding_path)
+            scored = reopened.retrieve_scored("add item to shopping cart", top_k=4, retrieve_type="bm25")
+        finally:
+            BM25Index.save = original_save
+            BM25Index.add = original_add
+        assert added == []
+        assert len(reopened._bm25_index) == len(bank.memories)
+        assert [(s, e["id"]) for s, e in scored] == [(s, e["id"]) for s, e in expected]
+
+
+def test_sharded_round_trip():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = ShardedReasoningBank(storage_path, embedding_path, query_cache_size=0)
+        fill(bank)
+        assert sorted(bank.shards) == ["shopping", "travel"]
+        expected, expected_travel = results(bank), results(bank, domain="travel")
+
+        reopened = ShardedReasoningBank(storage_path, embedding_path, query_cache_size=0)
+        assert sorted(m["id"] for m in reopened.memories) == sorted(m["id"] for m in bank.memories)
+        assert results(reopened) == expected and results(reopened, domain="travel") == expected_travel
+
+
+def test_split_bank_scores_like_unsharded():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        # z-score fusion does not depend on row order, so fused scores must match exactly
+        unsharded = ReasoningBank(storage_path, embedding_path, hybrid_fusion="zscore")
+        fill(unsharded)
+        sharded = ShardedReasoningBank(storage_path, embedding_path, hybrid_fusion="zscore")
+        assert len(sharded.memories) == len(unsharded.memories)
+
+        # All-domain BM25 and hybrid scores are computed over every shard, not merged per shard
+        for (query, retrieve_type), scored in results(unsharded).items():
+            assert [s for s, _ in results(sharded)[query, retrieve_type]] == [s for s, _ in scored], (query, retrieve_type)
+
+
+def test_eviction_archives_lowest_utility_items():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = ReasoningBank(storage_path, embedding_path, capacity=5, query_cache_size=0)
+        bank.add_memory_items("buy a shirt", make_items(4, "add to cart"), "FAILURE", domain="shopping")
+        bank.add_memory_items("search flights to paris", make_items(3, "search flights"), "SUCCESS", domain="travel")
+        failures = [m["id"] for m in bank.memories if m["score"] == 0.0]
+        successes = [m["id"] for m in bank.memories if m["score"] == 1.0]
+        # Failures score lowest and the oldest of them go first
+        assert [m["id"] for m in bank.live_memories()] == failures[2:] + successes
+
+        # A retrieval hit raises an item's utility above its peers
+        (_, hit), = bank.retrieve_scored("price filter", top_k=1, domain="shopping", retrieve_type="bm25")
+        assert hit["id"] == failures[2] and hit["hits"] == 1
+        bank.add_memory_item("sign in", make_items(1, "sign in")[0], "SUCCESS", domain="account")
+        live = [m["id"] for m in bank.live_memories()]
+        assert live == [failures[2]] + successes + [bank.memories[-1]["id"]]
+
+        with open(bank.archive_path, encoding='utf-8') as f:
+            assert [json.loads(line)["entry"]["id"] for line in f] == [failures[0], failures[1], failures[3]]
+        for capacity in (5, None):
+            reopened = ReasoningBank(storage_path, embedding_path, capacity=capacity)
+            assert [m["id"] for m in reopened.live_memories()] == live
+        bank.compact()
+        assert [m["id"] for m in ReasoningBank(storage_path, embedding_path).memories] == live
+
+
+def test_hits_are_only_tracked_with_a_capacity():
+    with tempfile.TemporaryDirectory() as tmp:
+        bank = ReasoningBank(*paths(tmp))
+        fill(bank)
+        bank.retrieve("search flights to paris")
+        assert not any("hits" in m or "last_retrieved" in m for m in bank.memories)
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✓ {name}")
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Tests for incremental token accounting in eval_sample.
+Runs against a fake encoding, so no tiktoken download is needed.
+"""
+import sys
+import os
+import random
+sys.path.insert(0, os.path.dirname(__file__))
+
+from utils.token_counter import TokenCounter
+
+
+class FakeEncoding:
+    """One token per whitespace-separated word; records every string it encodes."""
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, text):
+        self.calls.append(text)
+        return text.split()
+
+
+def reference_count(messages, tokens_per_message, tokens_per_name):
+    """The cookbook recipe num_tokens_from_messages used to implement."""
+    num_tokens = 0
+    for message in messages:
+        num_tokens += tokens_per_message
+        for key, value in message.items():
+            num_tokens += len(value.split())
+            if key == "name":
+                num_tokens += tokens_per_name
+    return num_tokens + 3
+
+
+def random_messages(rng, n):
+    roles = ["system", "user", "assistant"]
+    messages = []
+    for _ in range(n):
+        message = {"role": rng.choice(roles), "content": " ".join("w" * rng.randint(1, 3) for _ in range(rng.randint(0, 40)))}
+        if rng.random() < 0.2:
+            message["name"] = "example_user"
+        messages.append(message)
+    return messages
+
+
+def test_count_matches_reference():
+    rng = random.Random(0)
+    for model, (per_message, per_name) in [("gpt-4o", (3, 1)), ("gpt-3.5-turbo-0301", (4, -1))]:
+        counter = TokenCounter(model, encoding=FakeEncoding())
+        for _ in range(50):
+            messages = random_messages(rng, rng.randint(0, 8))
+            assert counter.count(messages) == reference_count(messages, per_message, per_name)
+
+
+def test_strings_are_encoded_once():
+    encoding = FakeEncoding()
+    counter = TokenCounter("gpt-4o", encoding=encoding)
+    system = {"role": "system", "content": "a long system prompt"}
+    query = [system]
+    for step in range(5):
+        query.append({"role": "user", "content": f"observation {step}"})
+        counter.count(query)
+    # "system", "user" and the prompt once, plus one new observation per step
+    assert sorted(encoding.calls) == sorted(["system", "a long system prompt", "user"] + [f"observation {i}" for i in range(5)])
+
+
+def test_fit_matches_incremental_loop():
+    rng = random.Random(1)
+    counter = TokenCounter("gpt-4o", encoding=FakeEncoding())
+    for _ in range(200):
+        exemplars = [random_messages(rng, rng.randint(1, 4)) for _ in range(rng.randint(0, 6))]
+        base = random_messages(rng, rng.randint(1, 4))
+        limit = rng.randint(0, 400)
+
+        # The loop eval_sample used to run, recounting the whole prompt for each exemplar
+        demo_message = []
+        for e in exemplars:
+            if reference_count(base + demo_message + e, 3, 1) > limit:
+                break
+            demo_message.extend(e)
+
+        prefix = counter.prefix_tokens(exemplars)
+        num_exemplars = counter.fit(prefix, limit - counter.count(base))
+        assert [m for e in exemplars[:num_exemplars] for m in e] == demo_message
+
+
+def test_unknown_model_is_rejected():
+    try:
+        TokenCounter("unknown-model", encoding=FakeEncoding())
+    except NotImplementedError:
+        return
+    assert False, "expected NotImplementedError"
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✓ {name}")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Tests for the shared tokenization service.
+Uses a byte-level tiktoken encoding built in place, so no encoding download is needed.
+"""
+import sys
+import os
+import threading
+sys.path.insert(0, os.path.dirname(__file__))
+
+import tiktoken
+from utils.tokenization import TokenizationService
+
+
+class RecordingEncoding(tiktoken.Encoding):
+    """One token per byte of each word or run of whitespace; records every encode call."""
+
+    def __init__(self):
+        super().__init__(
+            name="test_bytes",
+            pat_str=r"\S+|\s+",
+            mergeable_ranks={bytes([i]): i for i in range(256)},
+            special_tokens={},
+        )
+        self.calls = []
+        self.batching = False
+
+    def encode(self, text, **kwargs):
+        if not self.batching:  # encode_batch encodes each text with encode
+            self.calls.append(("encode", text))
+        return super().encode(text, **kwargs)
+
+    def encode_batch(self, texts, **kwargs):
+        self.calls.append(("encode_batch", list(texts)))
+        self.batching = True
+        try:
+            return super().encode_batch(texts, **kwargs)
+        finally:
+            self.batching = False
+
+
+def test_counts_match_encoder():
+    encoding = RecordingEncoding()
+    service = TokenizationService(encoding)
+    texts = ["", "plain text", "ünïcödé text", "<button id=1> Submit </button>" * 20]
+    assert service.count_many(texts) == [len(encoding.encode(t)) for t in texts]
+    assert [service.count(t) for t in texts] == [len(encoding.encode(t)) for t in texts]
+
+
+def test_count_many_batches_and_deduplicates():
+    encoding = RecordingEncoding()
+    service = TokenizationService(encoding)
+    assert service.count_many(["a b", "cc", "a b", "dd d"]) == [3, 2, 3, 4]
+    # 3 distinct texts in one batch call
+    assert encoding.calls == [("encode_batch", ["a b", "cc", "dd d"])]
+
+    encoding.calls.clear()
+    assert service.count_many(["cc", "eee", "a b"]) == [2, 3, 3]
+    assert encoding.calls == [("encode", "eee")]
+    assert service.count("dd d") == 4 and encoding.calls == [("encode", "eee")]
+
+
+def test_cache_is_bounded_lru():
+    encoding = RecordingEncoding()
+    service = TokenizationService(encoding, max_entries=3)
+    for text in ["one", "two", "three"]:
+        service.count(text)
+    service.count("one")  # most recently used
+    service.count("four")  # evicts "two"
+    assert len(service) == 3
+
+    encoding.calls.clear()
+    service.count_many(["one", "three", "four"])
+    assert encoding.calls == []
+    service.count("two")
+    assert encoding.calls == [("encode", "two")]
+
+
+def test_concurrent_counts_agree():
+    service = TokenizationService(RecordingEncoding(), max_entries=50)
+    texts = [f"text {i} " * (i % 7 + 1) for i in range(200)]
+    expected = [len(RecordingEncoding().encode(t)) for t in texts]
+    results = [None] * 8
+
+    def work(i):
+        results[i] = service.count_many(texts[i:] + texts[:i])
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i, counts in enumerate(results):
+        assert counts == expected[i:] + expected[:i]
+    assert len(service) <= 50
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✓ {name}")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Regression tests for get_tree_repr, which writes the representation in one walk of the tree,
+and for the raw_html fallback (get_raw_target), which represents only the target's subtree.
+Expected strings were produced by the original serialize-then-rewrite implementation.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from lxml import etree
+from utils.env import (
+    get_target_obs, get_tree_repr, prune_tree, _get_tree_repr_by_rewriting,
+    get_raw_target, get_target_obs_and_act, get_top_k_obs, StepObservations,
+)
+
+
+# Mind2Web-style steps: one plain, one full of quotes, entities and rewrite look-alikes
+STEPS = [
+    {
+        "cleaned_html": (
+            '<html backend_node_id="1"><body backend_node_id="2">'
+            '<div backend_node_id="3" class="header nav-bar"><a backend_node_id="4" href="https://www.example.com/" aria_label="Home">'
+            '<text backend_node_id="5">Example  Air</text></a></div>'
+            '<form backend_node_id="6" role="search" name="flight-search">'
+            '<label backend_node_id="7"><text backend_node_id="8">From</text></label>'
+            '<input backend_node_id="9" type="text" placeholder="City or airport" input_value="" value=""/>'
+            '<label backend_node_id="10"><text backend_node_id="11">To</text></label>'
+            '<input backend_node_id="12" type="text" placeholder="City or airport" aria_label="Destination"/>'
+            '<select backend_node_id="13" name="cabin"><option backend_node_id="14" option_selected="true">'
+            '<text backend_node_id="15">Economy</text></option><option backend_node_id="16" option_selected="false">'
+            '<text backend_node_id="17">Business</text></option></select>'
+            '<button backend_node_id="18" type="submit" class="btn btn-primary"><text backend_node_id="19">Search flights</text></button>'
+            '</form></body></html>'
+        ),
+        "pos_candidates": [{"backend_node_id": "12"}],
+        "neg_candidates": [{"backend_node_id": "9", "rank": 0}, {"backend_node_id": "18", "rank": 1}, {"backend_node_id": "14", "rank": 2}],
+    },
+    {
+        "cleaned_html": (
+            '<html backend_node_id="1"><body backend_node_id="2"><!-- results -->'
+            '<ul backend_node_id="3" role="list">'
+            '<li backend_node_id="4" title="&quot;Best&quot; deal &amp; more"><text backend_node_id="5">$12.99 &amp; up</text>'
+            '<text backend_node_id="6">Tom&apos;s Diner &lt;Downtown&gt;</text></li>'
+            '<li backend_node_id="7" class="card sold-out" aria_description="hidden"><span backend_node_id="8" value="a=b"/>'
+            '<text backend_node_id="9">Sold out\n\t(again)</text> tail &quot;text&quot;</li>'
+            '<li backend_node_id="10" label="Size 10/"><text backend_node_id="11">&amp;lt;escaped&amp;gt; $/$ meta= x</text></li>'
+            '</ul><p backend_node_id="12">Terms <text backend_node_id="13">&amp; Conditions</text> apply</p></body></html>'
+        ),
+        "pos_candidates": [{"backend_node_id": "7"}],
+        "neg_candidates": [{"backend_node_id": "10", "rank": 0}, {"backend_node_id": "4", "rank": 1}, {"backend_node_id": "12", "rank": 2}],
+    },
+]
+
+# (get_target_obs over all candidates, get_tree_repr of the whole page without brackets)
+EXPECTED = [
+    (
+        '<html><form search flight-search><label>From</label><input id=9 text city or airport /><label>To</label><input id=12 text destination city or airport /><select cabin><option id=14 true>Economy</option><option false>Business</option></select><button id=18 submit btn btn-primary>Search flights</button></form></html>',
+        '(html id=1(body id=2(div id=3 header nav-bar(a id=4 home(text backend_node_id=5Example Air)))(form id=6 search flight-search(label id=7(text backend_node_id=8From))(input id=9 text city or airport )(label id=10(text backend_node_id=11To))(input id=12 text destination city or airport )(select id=13 cabin(option id=14 true(text backend_node_id=15Economy))(option id=16 false(text backend_node_id=17Business)))(button id=18 submit btn btn-primary(text backend_node_id=19Search flights)))))',
+    ),
+    (
+        '<html><body><!-- results --><ul list><li id=4 "best" deal & more>$12.99 & upTom\'s Diner <Downtown></li><li id=7 card sold-out><span a=b />Sold out (again) tail text </li><li id=10 size 10/><escaped> $/$ x</li></ul><p id=12>Terms & Conditions apply</p></body></html>',
+        '(html id=1(body id=2(!-- results --(ul id=3 list(li id=4 "best" deal & more(text backend_node_id=5$12.99 & up)(text backend_node_id=6Tom\'s Diner <Downtown>))(li id=7 card sold-out(span id=8 a=b )(text backend_node_id=9Sold out (again)) tail text )(li id=10 size 10)(text backend_node_id=11<escaped> ) x)))(p id=12Terms (text backend_node_id=13& Conditions) apply)))',
+    ),
+]
+
+
+def candidate_ids(s):
+    return [c["backend_node_id"] for c in s["pos_candidates"] + s["neg_candidates"]]
+
+
+def test_matches_recorded_output():
+    for s, (target_obs, page_repr) in zip(STEPS, EXPECTED):
+        dom_tree = etree.fromstring(s["cleaned_html"])
+        assert get_target_obs(dom_tree, candidate_ids(s)) == target_obs
+        assert get_tree_repr(dom_tree, id_mapping={}, keep_html_brackets=False)[0] == page_repr
+
+
+def test_matches_rewriting_on_every_view():
+    for s in STEPS:
+        dom_tree = etree.fromstring(s["cleaned_html"])
+        ids = candidate_ids(s)
+        trees = [dom_tree] + [prune_tree(dom_tree, ids[:k]) for k in range(1, len(ids) + 1)]
+        for tree in trees:
+            for keep_html_brackets in (True, False):
+                for max_value_length, max_length in ((5, 20), (1, 2)):
+                    expected_mapping, mapping = {"0": 0}, {"0": 0}
+                    expected = _get_tree_repr_by_rewriting(
+                        tree, max_value_length, max_length, expected_mapping, keep_html_brackets
+                    )[0]
+                    assert get_tree_repr(tree, max_value_length, max_length, mapping, keep_html_brackets)[0] == expected
+                    assert mapping == expected_mapping
+
+
+def test_tree_is_not_modified():
+    dom_tree = etree.fromstring(STEPS[1]["cleaned_html"])
+    before = etree.tostring(dom_tree)
+    get_tree_repr(dom_tree, id_mapping={})
+    assert etree.tostring(dom_tree) == before
+
+
+def test_nested_text_elements_fall_back():
+    # <text> unwrapping is not local once a text element has children
+    html = '<html backend_node_id="1"><div><text>a<text>b</text></text>c</div><text>d</text></html>'
+    for keep_html_brackets in (True, False):
+        expected = _get_tree_repr_by_rewriting(etree.fromstring(html), 5, 20, {}, keep_html_brackets)[0]
+        assert get_tree_repr(html, id_mapping={}, keep_html_brackets=keep_html_brackets)[0] == expected
+
+
+# raw_html pages whose target (data_pw_testid_buckeye="u1", backend_node_id 4) is not in cleaned_html
+RAW_PAGES = {
+    "plain": '<html backend_node_id="1"><body backend_node_id="2"><div backend_node_id="3">'
+             '<button backend_node_id="4" data_pw_testid_buckeye="u1" aria_label="Next &gt; page"><text backend_node_id="5">Next</text></button>'
+             '<a backend_node_id="6" title="Home">x</a></div></body></html>',
+    # The old scan of the serialized page ran on into the next <input>
+    "self_closing": '<html backend_node_id="1"><body backend_node_id="2"><form backend_node_id="3">'
+                    '<input backend_node_id="4" data_pw_testid_buckeye="u1" type="text" placeholder="From"/>'
+                    '<input backend_node_id="5" type="text" placeholder="To"/></form></body></html>',
+    # The old scan stopped at the ">" of the meta value
+    "gt_in_meta": '<html backend_node_id="1"><body backend_node_id="2"><div backend_node_id="3">'
+                  '<button backend_node_id="4" data_pw_testid_buckeye="u1" aria_label="a&gt;b"><span backend_node_id="5">Next</span></button>'
+                  '<a backend_node_id="6">x</a></div></body></html>',
+}
+RAW_TARGETS = {
+    "plain": '<button id=4 next > page>Next</button>',
+    "self_closing": '<input id=4 text from />',
+    "gt_in_meta": '<button id=4 a>b />',
+}
+
+
+def raw_step(html, action_uid="u1"):
+    return {
+        "raw_html": html, "action_uid": action_uid, "operation": {"op": "CLICK", "value": ""},
+        "cleaned_html": '<html backend_node_id="1"><div backend_node_id="7"><a backend_node_id="8" title="Home">x</a></div></html>',
+        "pos_candidates": [], "neg_candidates": [{"backend_node_id": "8", "rank": 0}],
+    }
+
+
+def test_raw_target_is_its_span_in_the_page_observation():
+    for name, html in RAW_PAGES.items():
+        get_raw_target.cache_clear()
+        assert get_raw_target(html, "u1") == ("4", RAW_TARGETS[name]), name
+        assert RAW_TARGETS[name] in get_target_obs(etree.fromstring(html), ["4"]), name
+
+
+def test_raw_target_fallback_observations():
+    for name, html in RAW_PAGES.items():
+        s = raw_step(html)
+        target = (f"<html> {RAW_TARGETS[name]} </html>", "CLICK [4]")
+        top_k = (f"<html><a id=8 home>x</a>{RAW_TARGETS[name]} </html>", ["8"])
+        assert get_target_obs_and_act(s) == target and get_top_k_obs(s, 2) == top_k, name
+        step = StepObservations(s)
+        assert step.target_obs_and_act() == target and step.top_k_obs(2) == top_k, name
+
+
+def test_raw_target_without_backend_node_id_raises():
+    html = '<html backend_node_id="1"><body backend_node_id="2"><button data_pw_testid_buckeye="u1">Go</button></body></html>'
+    for fn in (lambda: get_raw_target(html, "u1"), lambda: get_target_obs_and_act(raw_step(html))):
+        try:
+            fn()
+        except ValueError:
+            continue
+        raise AssertionError("expected ValueError")
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✓ {name}")
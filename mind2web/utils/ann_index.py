@@ -0,0 +1,183 @@
+import os
+import math
+import numpy as np
+from typing import List, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over unit vectors.
+
+    A spherical k-means coarse quantizer splits the rows into `nlist` lists. A query probes the
+    `nprobe` closest lists, ranks their rows with float16 codes, and re-ranks the best
+    `rerank_factor * k` of them exactly against the caller's full-precision vectors.
+    Rows are opaque integer ids chosen by the caller (e.g. positions in the bank).
+    `nprobe` is the recall/latency knob: nprobe == nlist is exhaustive.
+    """
+    VERSION = 1
+
+    def __init__(self, dim: int, nlist: int = 0, nprobe: int = 8, rerank_factor: int = 4, seed: int = 0):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.rerank_factor = rerank_factor
+        self.seed = seed
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        self.trained_size = 0
+        self.doc_ids: List[str] = []
+        self.rows = np.zeros(0, dtype=np.int64)        # position -> caller row
+        self.assign = np.zeros(0, dtype=np.int32)      # position -> list id
+        self.codes = np.zeros((0, dim), dtype=np.float16)
+        self.lists: List[List[int]] = []               # list id -> positions
+        self._list_arrays: dict = {}
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @staticmethod
+    def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def train(self, vectors: np.ndarray, iterations: int = 10, sample_size: int = 50_000):
+        """Fit the coarse quantizer with spherical k-means on (a sample of) `vectors`."""
+        vectors = self._normalize_rows(vectors)
+        n = len(vectors)
+        nlist = self.nlist or max(1, int(math.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(self.seed)
+        sample = vectors[rng.choice(n, size=min(n, sample_size), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+                else:
+                    # Re-seed empty lists with a random point
+                    centroids[c] = sample[rng.integers(len(sample))]
+            centroids = self._normalize_rows(centroids)
+        self.nlist = nlist
+        self.centroids = centroids
+        self.trained_size = n
+
+    def reset(self):
+        self.doc_ids = []
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.assign = np.zeros(0, dtype=np.int32)
+        self.codes = np.zeros((0, self.dim), dtype=np.float16)
+        self.lists = [[] for _ in range(self.nlist)]
+        self._list_arrays = {}
+
+    def add(self, doc_ids: List[str], rows: np.ndarray, vectors: np.ndarray):
+        """Insert vectors (assigned to their nearest list). The index must be trained."""
+        if len(doc_ids) == 0:
+            return
+        vectors = self._normalize_rows(vectors)
+        assign = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+        start = len(self.doc_ids)
+        self.doc_ids.extend(doc_ids)
+        self.rows = np.concatenate([self.rows, np.asarray(rows, dtype=np.int64)])
+        self.assign = np.concatenate([self.assign, assign])
+        self.codes = np.concatenate([self.codes, vectors.astype(np.float16)])
+        for offset, list_id in enumerate(assign):
+            self.lists[list_id].append(start + offset)
+            self._list_arrays.pop(int(list_id), None)
+
+    def needs_retrain(self) -> bool:
+        """The quantizer was fit on a much smaller collection; lists have become too long."""
+        return len(self) > 4 * max(self.trained_size, 1)
+
+    def search(self, query: np.ndarray, matrix: np.ndarray, k: int, row_mask: Optional[np.ndarray] = None, nprobe: int = None) -> np.ndarray:
+        """
+        Approximate top-k caller rows for a unit `query`, best first.
+        `matrix` holds the full-precision vectors by caller row (used for cosine re-ranking) and
+        `row_mask`, if given, is a boolean array over caller rows restricting the result.
+        May return fewer than k rows when the probed lists hold too few candidates.
+        """
+        if len(self) == 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe] if nprobe < self.nlist else np.arange(self.nlist)
+
+        positions = np.concatenate([self._list_array(int(c)) for c in probe])
+        if row_mask is not None and len(positions):
+            positions = positions[row_mask[self.rows[positions]]]
+        if len(positions) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Approximate stage on float16 codes
+        approx = self.codes[positions].astype(np.float32) @ query
+        shortlist = min(len(positions), max(k, self.rerank_factor * k))
+        if shortlist < len(positions):
+            positions = positions[np.argpartition(-approx, shortlist - 1)[:shortlist]]
+
+        # Exact re-rank on the shortlist
+        rows = self.rows[positions]
+        vectors = np.asarray(matrix[rows], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+        exact = (vectors @ query) / norms
+        order = np.argsort(-exact, kind="stable")[:k]
+        return rows[order]
+
+    def _list_array(self, list_id: int) -> np.ndarray:
+        arr = self._list_arrays.get(list_id)
+        if arr is None:
+            arr = np.asarray(self.lists[list_id], dtype=np.int64)
+            self._list_arrays[list_id] = arr
+        return arr
+
+    def matches_prefix(self, doc_ids: List[str]) -> bool:
+        """True if this index covers exactly the first len(self) of `doc_ids`, in order."""
+        return len(self.doc_ids) <= len(doc_ids) and self.doc_ids == doc_ids[:len(self.doc_ids)]
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            version=self.VERSION,
+            params=np.array([self.dim, self.nlist, self.nprobe, self.rerank_factor, self.seed, self.trained_size]),
+            centroids=self.centroids,
+            doc_ids=np.array(self.doc_ids, dtype=str),
+            rows=self.rows,
+            assign=self.assign,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, vectors_for_rows) -> Optional["IVFIndex"]:
+        """
+        Load a saved index; `vectors_for_rows(rows)` supplies the vectors used to rebuild the codes.
+        Returns None if the file is missing, unreadable, from another version, or refers to rows
+        `vectors_for_rows` cannot supply.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                if int(data["version"]) != cls.VERSION:
+                    return None
+                dim, nlist, nprobe, rerank_factor, seed, trained_size = (int(x) for x in data["params"])
+                index = cls(dim, nlist=nlist, nprobe=nprobe, rerank_factor=rerank_factor, seed=seed)
+                index.centroids = data["centroids"].astype(np.float32)
+                index.trained_size = trained_size
+                index.doc_ids = data["doc_ids"].tolist()
+                index.rows = data["rows"].astype(np.int64)
+                index.assign = data["assign"].astype(np.int32)
+            if len(index.rows):
+                index.codes = index._normalize_rows(vectors_for_rows(index.rows)).astype(np.float16)
+        except Exception as e:
+            logger.warning(f"Failed to load ANN index {path}: {e}")
+            return None
+        index.lists = [[] for _ in range(index.nlist)]
+        for position, list_id in enumerate(index.assign):
+            index.lists[list_id].append(position)
+        return index
@@ -4,6 +4,8 @@ import json
 import os
 import string
 import ast
+from functools import lru_cache
+from itertools import islice
 from lxml import etree
 
 
@@ -108,45 +110,9 @@ def construct_act_str(op, val):
 
 def get_target_obs_and_act(example):
     if len(example["pos_candidates"]) == 0:
-        # Simplify the raw_html if pos_candidates is empty (not in the cleaned html)
-        dom_tree = etree.fromstring(example["raw_html"])
-        gt_element = dom_tree.xpath(
-            f"//*[@data_pw_testid_buckeye='{example['action_uid']}']"
-        )
-        element_id = gt_element[0].get("backend_node_id")
-        raw_obs = get_target_obs(dom_tree, [element_id])
-        # Find the start index of the target element using the element ID
-        start_idx = raw_obs.find(f"id={element_id}")
-        # Find the start tag for the target element
-        start_tag_idx = raw_obs.rfind("<", 0, start_idx)
-        end_tag_idx = raw_obs.find(">", start_idx)
-        # Extract the tag name
-        tag_name = raw_obs[start_tag_idx + 1 : end_tag_idx].split()[0]
-        # Initialize count for open and close tags
-        open_count = 0
-        close_count = 0
-        search_idx = start_tag_idx
-        while True:
-            # Find the next open or close tag of the same type
-            next_open_tag = raw_obs.find(f"<{tag_name}", search_idx)
-            next_close_tag = raw_obs.find(f"</{tag_name}>", search_idx)
-            # No more tags found, break
-            if next_open_tag == -1 and next_close_tag == -1:
-                break
-            # Decide whether the next tag is an open or close tag
-            if next_open_tag != -1 and (
-                next_open_tag < next_close_tag or next_close_tag == -1
-            ):
-                open_count += 1
-                search_idx = raw_obs.find(">", next_open_tag) + 1
-            else:
-                close_count += 1
-                search_idx = next_close_tag + len(f"</{tag_name}>")
-            # If we've closed all open tags, break
-            if open_count == close_count:
-                break
-        # Extract the target element
-        o = f"<html> {raw_obs[start_tag_idx:search_idx]} </html>"
+        # Take the target element from the raw_html if pos_candidates is empty (not in the cleaned html)
+        element_id, target_element = get_raw_target(example["raw_html"], example["action_uid"])
+        o = f"<html> {target_element} </html>"
         a = get_target_act(example, element_id)
     else:
         dom_tree = etree.fromstring(example["cleaned_html"])
@@ -157,7 +123,7 @@ def get_target_obs_and_act(example):
     return o, a
 
 
-def get_top_k_obs(s: dict, top_k: int, use_raw: bool = True) -> tuple[str, str]:
+def get_top_k_candidates(s: dict, top_k: int) -> list:
     # Find one positive candidate (it can be zero)
     pos_candidates = s["pos_candidates"]
     pos_ids = [c["backend_node_id"] for c in pos_candidates][:1]
@@ -165,49 +131,18 @@ def get_top_k_obs(s: dict, top_k: int, use_raw: bool = True) -> tuple[str, str]:
     neg_candidates = s["neg_candidates"]
     neg_candidates = sorted(neg_candidates, key=lambda c: c["rank"])[: top_k - 1]
     neg_ids = [c["backend_node_id"] for c in neg_candidates]
+    return pos_ids + neg_ids
+
+
+def get_top_k_obs(s: dict, top_k: int, use_raw: bool = True) -> tuple[str, str]:
     # Prune html with all candidates
-    all_candidates = pos_ids + neg_ids
+    all_candidates = get_top_k_candidates(s, top_k)
     obs = get_target_obs(etree.fromstring(s["cleaned_html"]), all_candidates)
     # If there is no positive candidate in cleaned_html, get it from raw_html
     if len(s["pos_candidates"]) == 0:
         assert use_raw
-        # Simplify the raw_html if pos_candidates is empty (not in the cleaned html)
-        dom_tree = etree.fromstring(s["raw_html"])
-        gt_element = dom_tree.xpath(f"//*[@data_pw_testid_buckeye='{s['action_uid']}']")
-        element_id = gt_element[0].get("backend_node_id")
-        raw_obs = get_target_obs(dom_tree, [element_id])
-        # Find the start index of the target element using the element ID
-        start_idx = raw_obs.find(f"id={element_id}")
-        # Find the start tag for the target element
-        start_tag_idx = raw_obs.rfind("<", 0, start_idx)
-        end_tag_idx = raw_obs.find(">", start_idx)
-        # Extract the tag name
-        tag_name = raw_obs[start_tag_idx + 1 : end_tag_idx].split()[0]
-        # Initialize count for open and close tags
-        open_count = 0
-        close_count = 0
-        search_idx = start_tag_idx
-        while True:
-            # Find the next open or close tag of the same type
-            next_open_tag = raw_obs.find(f"<{tag_name}", search_idx)
-            next_close_tag = raw_obs.find(f"</{tag_name}>", search_idx)
-            # No more tags found, break
-            if next_open_tag == -1 and next_close_tag == -1:
-                break
-            # Decide whether the next tag is an open or close tag
-            if next_open_tag != -1 and (
-                next_open_tag < next_close_tag or next_close_tag == -1
-            ):
-                open_count += 1
-                search_idx = raw_obs.find(">", next_open_tag) + 1
-            else:
-                close_count += 1
-                search_idx = next_close_tag + len(f"</{tag_name}>")
-            # If we've closed all open tags, break
-            if open_count == close_count:
-                break
-        # Extract the target element
-        target_element = raw_obs[start_tag_idx:search_idx]
+        # Take the target element from the raw_html if pos_candidates is empty (not in the cleaned html)
+        _, target_element = get_raw_target(s["raw_html"], s["action_uid"])
         obs = obs.replace("</html>", f"{target_element} </html>")
 
     return obs, all_candidates
@@ -247,30 +182,38 @@ def get_descendants(node, max_depth, current_depth=0):
     return descendants
 
 
-def get_attribute_repr(node, max_value_length=5, max_length=20):
+# Attributes whose values make up the meta of an element, in order
+META_ATTRIBUTES = [
+    "role",
+    "aria_role",
+    "type",
+    "alt",
+    "aria_description",
+    "aria_label",
+    "label",
+    "title",
+    "name",
+    "text_value",
+    "value",
+    "placeholder",
+    "input_checked",
+    "input_value",
+    "option_selected",
+    "class",
+]
+_META_ATTRIBUTE_SET = frozenset(META_ATTRIBUTES)
+
+
+def _attribute_meta(attrib, max_value_length=5, max_length=20) -> str:
+    present = _META_ATTRIBUTE_SET.intersection(attrib.keys())
+    if not present:
+        return ""
     # get attribute values in order
     attr_values_set = set()
     attr_values = ""
-    for attr in [
-        "role",
-        "aria_role",
-        "type",
-        "alt",
-        "aria_description",
-        "aria_label",
-        "label",
-        "title",
-        "name",
-        "text_value",
-        "value",
-        "placeholder",
-        "input_checked",
-        "input_value",
-        "option_selected",
-        "class",
-    ]:
-        if attr in node.attrib and node.attrib[attr] is not None:
-            value = node.attrib[attr].lower()
+    for attr in META_ATTRIBUTES:
+        if attr in present and attrib[attr] is not None:
+            value = attrib[attr].lower()
             # less menaingful values
             if value in [
                 "hidden",
@@ -285,138 +228,412 @@ def get_attribute_repr(node, max_value_length=5, max_length=20):
             if value and value not in attr_values_set:
                 attr_values_set.add(value)
                 attr_values += value + " "
+    return " ".join(attr_values.split()[:max_length])
+
+
+def get_attribute_repr(node, max_value_length=5, max_length=20):
+    meta = _attribute_meta(node.attrib, max_value_length, max_length)
     uid = node.attrib.get("backend_node_id", "")
     # clear all attributes
     node.attrib.clear()
     if uid:
         node.attrib["id"] = uid
     # add meta attribute
-    if attr_values:
-        node.attrib["meta"] = " ".join(attr_values.split()[:max_length])
-
-
-
-def prune_tree(
-    dom_tree,
-    candidate_set,
-    max_depth=5,
-    max_children=50,
-    max_sibling=3,
-):
+    if meta:
+        node.attrib["meta"] = meta
+
+
+def build_node_index(dom_tree) -> dict:
+    """backend_node_id -> element (the first in document order), built in one traversal."""
+    node_index = {}
+    for node in dom_tree.iter(etree.Element):
+        node_id = node.get("backend_node_id")
+        if node_id is not None:
+            node_index.setdefault(node_id, node)
+    return node_index
+
+
+def iter_descendants(node, max_depth):
+    """The elements of get_descendants(node, max_depth), in the same (pre-)order, produced lazily."""
+    stack = [(iter(node), 0)]
+    while stack:
+        children, depth = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            continue
+        yield child
+        if depth + 1 <= max_depth:
+            stack.append((iter(child), depth + 1))
+
+
+def get_keep_set(node_index, candidate_set, max_depth=5, max_children=50, max_sibling=3) -> set:
+    """
+    backend_node_ids to keep around the candidates: their ancestors, descendants up to max_depth
+    (at most max_children of them), and up to max_sibling siblings on each side.
+    """
     nodes_to_keep = set()
+    # Elements whose ancestors are all in nodes_to_keep already; shared ancestor chains are walked once
+    walked = set()
     for candidate_id in candidate_set:
-        candidate_node = dom_tree.xpath(f'//*[@backend_node_id="{candidate_id}"]')[0]
-        nodes_to_keep.add(candidate_node.attrib["backend_node_id"])
+        candidate_node = node_index[candidate_id]
+        nodes_to_keep.add(candidate_id)
         # get all ancestors
-        nodes_to_keep.update(
-            [
-                x.attrib.get("backend_node_id", "")
-                for x in candidate_node.xpath("ancestor::*")
-            ]
-        )
+        ancestor = candidate_node.getparent()
+        while ancestor is not None and ancestor not in walked:
+            walked.add(ancestor)
+            nodes_to_keep.add(ancestor.attrib.get("backend_node_id", ""))
+            ancestor = ancestor.getparent()
         # get descendants with max depth
         nodes_to_keep.update(
-            [
-                x.attrib.get("backend_node_id", "")
-                for x in get_descendants(candidate_node, max_depth)
-            ][:max_children]
+            x.attrib.get("backend_node_id", "")
+            for x in islice(iter_descendants(candidate_node, max_depth), max_children)
         )
         # get siblings within range
         parent = candidate_node.getparent()
         if parent is not None:
-            siblings = [x for x in parent.getchildren() if x.tag != "text"]
+            siblings = [x for x in parent if x.tag != "text"]
             idx_in_sibling = siblings.index(candidate_node)
             nodes_to_keep.update(
-                [
-                    x.attrib.get("backend_node_id", "")
-                    for x in siblings[
-                        max(0, idx_in_sibling - max_sibling) : idx_in_sibling
-                        + max_sibling
-                        + 1
-                    ]
-                ]
-            )
-    # clone the tree
-    new_tree = copy.deepcopy(dom_tree)
-    # remove nodes not in nodes_to_keep
-    for node in new_tree.xpath("//*")[::-1]:
-        if node.tag != "text":
-            is_keep = node.attrib.get("backend_node_id", "") in nodes_to_keep
-            is_candidate = node.attrib.get("backend_node_id", "") in candidate_set
-        else:
-            is_keep = (
-                node.getparent().attrib.get("backend_node_id", "") in nodes_to_keep
-            )
-            is_candidate = (
-                node.getparent().attrib.get("backend_node_id", "") in candidate_set
+                x.attrib.get("backend_node_id", "")
+                for x in siblings[max(0, idx_in_sibling - max_sibling) : idx_in_sibling + max_sibling + 1]
             )
-        if not is_keep and node.getparent() is not None:
-            node.getparent().remove(node)
-        else:
-            if not is_candidate or node.tag == "text":
-                node.attrib.pop("backend_node_id", None)
-            if (
-                len(node.attrib) == 0
-                and not any([x.tag == "text" for x in node.getchildren()])
-                and node.getparent() is not None
-                and node.tag != "text"
-                and len(node.getchildren()) <= 1
-            ):
-                # insert all children into parent
-                for child in node.getchildren():
-                    node.addprevious(child)
-                node.getparent().remove(node)
-    return new_tree
+    return nodes_to_keep
+
+
+def prune_tree(
+    dom_tree,
+    candidate_set,
+    max_depth=5,
+    max_children=50,
+    max_sibling=3,
+    node_index=None,
+):
+    """
+    A pruned copy of `dom_tree` (which is left untouched) holding the candidates and their context
+    (see get_keep_set). Kept nodes lose backend_node_id unless they are candidates, and attribute-less
+    elements with at most one child and no text are collapsed into that child. Pass `node_index`
+    (from build_node_index) to reuse one index across several prunes of the same tree.
+    """
+    if node_index is None:
+        node_index = build_node_index(dom_tree)
+    nodes_to_keep = get_keep_set(node_index, candidate_set, max_depth, max_children, max_sibling)
+    return _copy_kept(dom_tree, nodes_to_keep, set(candidate_set))[0]
+
+
+def _copy_kept(node, nodes_to_keep, candidate_set, parent_id=None):
+    """
+    Copy of `node` after pruning, as the list of elements that take its place (empty if it is
+    removed, its only child if it is collapsed), built in one post-order pass over the kept nodes.
+    `parent_id` is the backend_node_id of the parent ("" if it has none); None marks the root.
+    """
+    if not isinstance(node.tag, str):
+        # Comments and processing instructions are never removed on their own
+        return [copy.copy(node)]
+    is_root = parent_id is None
+    # Text nodes follow their parent
+    node_id = parent_id if node.tag == "text" and not is_root else node.get("backend_node_id", "")
+    if node_id not in nodes_to_keep and not is_root:
+        return []
+
+    new_node = etree.Element(node.tag, node.attrib)
+    if node.tag == "text" or node_id not in candidate_set:
+        new_node.attrib.pop("backend_node_id", None)
+    new_node.text, new_node.tail = node.text, node.tail
+    child_parent_id = node.get("backend_node_id", "")
+    children = [c for child in node for c in _copy_kept(child, nodes_to_keep, candidate_set, child_parent_id)]
+    if (
+        len(new_node.attrib) == 0
+        and not any(c.tag == "text" for c in children)
+        and not is_root
+        and node.tag != "text"
+        and len(children) <= 1
+    ):
+        # Collapse into the (at most one) child; the node's own text and tail are dropped
+        return children
+    new_node.extend(children)
+    return [new_node]
+
+
+HTML_ESCAPE_TABLE = [
+    ("&quot;", '"'),
+    ("&amp;", "&"),
+    ("&lt;", "<"),
+    ("&gt;", ">"),
+    ("&nbsp;", " "),
+    ("&ndash;", "-"),
+    ("&rsquo;", "'"),
+    ("&lsquo;", "'"),
+    ("&ldquo;", '"'),
+    ("&rdquo;", '"'),
+    ("&#39;", "'"),
+    ("&#40;", "("),
+    ("&#41;", ")"),
+]
+# Text without these characters comes out of the per-piece rewrites of get_tree_repr unchanged
+_REWRITTEN_TEXT_CHARS = re.compile(r'["&<>$=\r]')
+# Same for the id and meta values of a tag, where a trailing "/" could also meet the closing ">"
+_REWRITTEN_META_CHARS = re.compile(r'["&<>$=/\r]')
+_REWRITTEN_ID_CHARS = re.compile(r'["&<>$=/\s]')
+_END_TAG = re.compile(r"</(.+?)>")
+_START_TAG = re.compile(r"<(.+?)>")
 
 
 def get_tree_repr(
     tree, max_value_length=5, max_length=20, id_mapping={}, keep_html_brackets=False
 ):
+    """
+    Compact text representation of `tree`: elements keep only their backend_node_id (as id) and a
+    meta string of their informative attribute values, <text> wrappers are dropped, and brackets
+    become parentheses unless keep_html_brackets. New backend_node_ids are added to id_mapping.
+    The tree is not modified.
+    """
     if isinstance(tree, str):
         tree = etree.fromstring(tree)
+    if not _is_streamable(tree):
+        return _get_tree_repr_by_rewriting(tree, max_value_length, max_length, id_mapping, keep_html_brackets)
+    pieces = []
+    _write_tree_repr(tree, pieces, max_value_length, max_length, id_mapping, keep_html_brackets)
+    tree_repr = "".join(pieces)
+    if "&" in tree_repr or "$" in tree_repr:
+        tree_repr = _unescape(tree_repr, keep_html_brackets)
+    tree_repr = re.sub(r"\s+", " ", tree_repr).strip()
+
+    return tree_repr, id_mapping
+
+
+def _is_streamable(tree) -> bool:
+    """
+    Whether _write_tree_repr reproduces the serialize-then-rewrite output for `tree`. The
+    rewrites before unescaping act within single tags and texts as long as text elements are
+    leaves with text (for the <text>...</text> unwrapping) and comments hold no brackets.
+    """
+    for node in tree.iter("text", etree.Comment, etree.ProcessingInstruction):
+        if node.tag == "text":
+            if node.text is None or len(node):
+                return False
+        elif "<" in (node.text or "") or ">" in (node.text or ""):
+            return False
+    return True
+
+
+def _rewrite_markup(piece: str) -> str:
+    return piece.replace('"', " ").replace("meta= ", "").replace("id= ", "id=").replace(" >", ">")
+
+
+def _rewrite_brackets(piece: str, keep_html_brackets: bool) -> str:
+    if not keep_html_brackets:
+        piece = piece.replace("/>", "$/$>")
+        piece = _END_TAG.sub(r")", piece)
+        piece = _START_TAG.sub(r"(\1", piece)
+    return piece
+
+
+def _unescape(tree_repr: str, keep_html_brackets: bool) -> str:
+    if not keep_html_brackets:
+        tree_repr = tree_repr.replace("$/$", ")")
+    for k, v in HTML_ESCAPE_TABLE:
+        tree_repr = tree_repr.replace(k, v)
+    return tree_repr
+
+
+def _escape_text(text: str) -> str:
+    """Text as lxml serializes it."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\r", "&#13;")
+
+
+def _escape_attribute(value: str) -> str:
+    """Attribute value as lxml serializes it."""
+    value = _escape_text(value).replace('"', "&quot;")
+    return value.replace("\n", "&#10;").replace("\t", "&#9;")
+
+
+def _tag_markup(tag: str, attributes, is_empty: bool) -> str:
+    """The start tag (the whole element if `is_empty`) as lxml serializes it."""
+    attrs = "".join(f' {k}="{_escape_attribute(v)}"' for k, v in attributes)
+    return f"<{tag}{attrs}{'/>' if is_empty else '>'}"
+
+
+def _write_text(pieces: list, text):
+    if not text:
+        return
+    if _REWRITTEN_TEXT_CHARS.search(text):
+        # Escaped text has no brackets left to rewrite
+        text = _rewrite_markup(_escape_text(text))
+    pieces.append(text)
+
+
+def _write_tree_repr(node, pieces, max_value_length, max_length, id_mapping, keep_html_brackets):
+    """
+    Append the representation of `node` and its tail to `pieces` in one walk of the tree, before
+    unescaping. Each tag and text goes through the same rewrites as in the full serialized string
+    (which never span two of them), and plain ids, meta values and texts are written directly.
+    """
+    tag = node.tag
+    if not isinstance(tag, str):
+        # Comments and processing instructions
+        piece = etree.tostring(node, encoding="unicode", with_tail=False)
+        pieces.append(_rewrite_brackets(_rewrite_markup(piece), keep_html_brackets))
+    elif tag == "text":
+        text = " ".join(node.text.split()[:max_length])
+        start = _rewrite_markup(_tag_markup(tag, node.attrib.items(), False)) if len(node.attrib) else "<text>"
+        if start == "<text>":
+            # Unwrapped
+            _write_text(pieces, text)
+        else:
+            pieces.append(_rewrite_brackets(start, keep_html_brackets))
+            _write_text(pieces, text)
+            pieces.append("</text>" if keep_html_brackets else ")")
     else:
-        tree = copy.deepcopy(tree)
+        attrib = node.attrib
+        if "backend_node_id" in attrib and attrib["backend_node_id"] not in id_mapping:
+            id_mapping[attrib["backend_node_id"]] = len(id_mapping)
+        uid = attrib.get("backend_node_id", "")
+        meta = _attribute_meta(attrib, max_value_length, max_length)
+        is_empty = node.text is None and len(node) == 0
+        if _REWRITTEN_ID_CHARS.search(uid) or _REWRITTEN_META_CHARS.search(meta):
+            attributes = ([("id", uid)] if uid else []) + ([("meta", meta)] if meta else [])
+            start = _rewrite_markup(_tag_markup(tag, attributes, is_empty))
+            pieces.append(_rewrite_brackets(start, keep_html_brackets))
+        else:
+            # <tag id="uid" meta="meta"> rewrites to <tag id=uid meta>
+            start = tag + (f" id={uid}" if uid else "") + (f" {meta}" if meta else "")
+            if not is_empty:
+                pieces.append(f"<{start}>" if keep_html_brackets else f"({start}")
+            elif start == tag:
+                pieces.append(f"<{tag}/>" if keep_html_brackets else f"({tag})")
+            else:
+                pieces.append(f"<{start} />" if keep_html_brackets else f"({start} )")
+        if not is_empty:
+            _write_text(pieces, node.text)
+            for child in node:
+                _write_tree_repr(child, pieces, max_value_length, max_length, id_mapping, keep_html_brackets)
+            pieces.append(f"</{tag}>" if keep_html_brackets else ")")
+    _write_text(pieces, node.tail)
+
+
+def _get_tree_repr_by_rewriting(tree, max_value_length, max_length, id_mapping, keep_html_brackets):
+    """get_tree_repr by serializing a simplified copy of the tree and rewriting the string."""
+    tree = copy.deepcopy(tree)
     for node in tree.xpath("//*"):
         if node.tag != "text":
             if "backend_node_id" in node.attrib:
                 if node.attrib["backend_node_id"] not in id_mapping:
                     id_mapping[node.attrib["backend_node_id"]] = len(id_mapping)
-                # node.attrib["backend_node_id"] = str(
-                #     id_mapping[node.attrib["backend_node_id"]]
-                # )
             get_attribute_repr(node, max_value_length, max_length)
         else:
             node.text = " ".join(node.text.split()[:max_length])
     tree_repr = etree.tostring(tree, encoding="unicode")
 
-    tree_repr = tree_repr.replace('"', " ")
-    tree_repr = (
-        tree_repr.replace("meta= ", "").replace("id= ", "id=").replace(" >", ">")
-    )
+    tree_repr = _rewrite_markup(tree_repr)
     tree_repr = re.sub(r"<text>(.*?)</text>", r"\1", tree_repr)
-    if not keep_html_brackets:
-        tree_repr = tree_repr.replace("/>", "$/$>")
-        tree_repr = re.sub(r"</(.+?)>", r")", tree_repr)
-        tree_repr = re.sub(r"<(.+?)>", r"(\1", tree_repr)
-        tree_repr = tree_repr.replace("$/$", ")")
-
-    html_escape_table = [
-        ("&quot;", '"'),
-        ("&amp;", "&"),
-        ("&lt;", "<"),
-        ("&gt;", ">"),
-        ("&nbsp;", " "),
-        ("&ndash;", "-"),
-        ("&rsquo;", "'"),
-        ("&lsquo;", "'"),
-        ("&ldquo;", '"'),
-        ("&rdquo;", '"'),
-        ("&#39;", "'"),
-        ("&#40;", "("),
-        ("&#41;", ")"),
-    ]
-    for k, v in html_escape_table:
-        tree_repr = tree_repr.replace(k, v)
+    tree_repr = _unescape(_rewrite_brackets(tree_repr, keep_html_brackets), keep_html_brackets)
     tree_repr = re.sub(r"\s+", " ", tree_repr).strip()
 
     return tree_repr, id_mapping
+
+
+def get_element_repr(node, max_depth=5, max_children=50, max_sibling=3) -> str:
+    """
+    Representation of `node` and its subtree as it appears in get_target_obs(tree, [its id]),
+    built from the node's own pruned subtree instead of pruning and serializing the whole tree.
+    """
+    node_id = node.get("backend_node_id")
+    nodes_to_keep = get_keep_set({node_id: node}, [node_id], max_depth, max_children, max_sibling)
+    parent = node.getparent()
+    parent_id = None if parent is None else parent.get("backend_node_id", "")
+    pruned_node = _copy_kept(node, nodes_to_keep, {node_id}, parent_id)[0]
+    pruned_node.tail = None
+    tree_repr, _ = get_tree_repr(pruned_node, id_mapping={}, keep_html_brackets=True)
+    return tree_repr
+
+
+@lru_cache(maxsize=16)
+def get_raw_target(raw_html: str, action_uid: str) -> tuple[str, str]:
+    """
+    (backend_node_id, repr) of a step's ground-truth element in raw_html, for steps whose target
+    is missing from cleaned_html. Cached, so the target and top-k observations of a step share it.
+    Raises ValueError if the element has no backend_node_id, which no action can refer to.
+    """
+    element = DOMContext(raw_html).find("data_pw_testid_buckeye", action_uid)
+    element_id = element.get("backend_node_id")
+    if element_id is None:
+        raise ValueError(f"Target element of action {action_uid} has no backend_node_id")
+    return element_id, get_element_repr(element)
+
+
+class DOMContext:
+    """
+    One parsed HTML document and its element indexes, each built on first use and shared by
+    every pruned view of it (prune_tree never modifies the parsed tree).
+    """
+
+    def __init__(self, html: str):
+        self.tree = etree.fromstring(html)
+        self._index = None
+        self._attribute_indexes = {}
+
+    @property
+    def index(self) -> dict:
+        """backend_node_id -> element (see build_node_index)."""
+        if self._index is None:
+            self._index = build_node_index(self.tree)
+        return self._index
+
+    def find(self, attribute: str, value: str):
+        """The first element whose `attribute` is `value` (KeyError if there is none)."""
+        if attribute not in self._attribute_indexes:
+            attribute_index = {}
+            # Only elements carrying the attribute reach Python
+            for node in self.tree.xpath(f"//*[@{attribute}]"):
+                attribute_index.setdefault(node.get(attribute), node)
+            self._attribute_indexes[attribute] = attribute_index
+        return self._attribute_indexes[attribute][value]
+
+    def prune(self, candidate_set, max_depth=5, max_children=50, max_sibling=3):
+        return prune_tree(self.tree, candidate_set, max_depth, max_children, max_sibling, node_index=self.index)
+
+    def obs(self, candidate_set) -> str:
+        """Same as get_target_obs(self.tree, candidate_set)."""
+        tree_repr, _ = get_tree_repr(self.prune(candidate_set), id_mapping={}, keep_html_brackets=True)
+        return tree_repr
+
+
+class StepObservations:
+    """
+    The observations eval_sample needs for one step, equal to get_target_obs_and_act(s) and
+    get_top_k_obs(s, k), computed from a single parse of cleaned_html (and of raw_html, only
+    when the target is missing from it). Documents are parsed on first use.
+    """
+
+    def __init__(self, s: dict):
+        self.s = s
+        self._cleaned = None
+
+    @property
+    def cleaned(self) -> DOMContext:
+        if self._cleaned is None:
+            self._cleaned = DOMContext(self.s["cleaned_html"])
+        return self._cleaned
+
+    def raw_target(self) -> tuple[str, str]:
+        """(backend_node_id, repr) of the ground-truth element located in raw_html."""
+        return get_raw_target(self.s["raw_html"], self.s["action_uid"])
+
+    def target_obs_and_act(self) -> tuple[str, str]:
+        if len(self.s["pos_candidates"]) == 0:
+            element_id, target_element = self.raw_target()
+            o = f"<html> {target_element} </html>"
+        else:
+            element_id = self.s["pos_candidates"][0]["backend_node_id"]
+            o = self.cleaned.obs([element_id])
+        return o, get_target_act(self.s, element_id)
+
+    def top_k_obs(self, top_k: int, use_raw: bool = True) -> tuple[str, list]:
+        all_candidates = get_top_k_candidates(self.s, top_k)
+        obs = self.cleaned.obs(all_candidates)
+        if len(self.s["pos_candidates"]) == 0:
+            assert use_raw
+            _, target_element = self.raw_target()
+            obs = obs.replace("</html>", f"{target_element} </html>")
+        return obs, all_candidates
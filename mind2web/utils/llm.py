@@ -2,69 +2,68 @@ import logging
 import re
 import os
 import inspect
-import tiktoken
 
 logger = logging.getLogger("main")
 
 import openai
 openai.api_key = os.environ["OPENAI_API_KEY"]
-from openai import OpenAI, BadRequestError
+from openai import OpenAI, BadRequestError, RateLimitError
 client = OpenAI()
 
+from utils.embedding_service import EmbeddingService, EmbeddingCache
+from utils.rate_limiter import RateLimiter
+from utils.token_counter import get_token_counter
+
+# Shared by every thread that calls generate_response; see set_rate_limit
+rate_limiter = RateLimiter()
+
+
+def set_rate_limit(requests_per_minute: int | None = None, tokens_per_minute: int | None = None):
+    """Limit generate_response calls process-wide (e.g. to the account's RPM/TPM limits)."""
+    global rate_limiter
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+
+
+def _openai_embed(texts: list[str], model: str) -> list[list[float]]:
+    """One batched embeddings request; results are returned in input order."""
+    response = client.embeddings.create(input=texts, model=model)
+    return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+
+# Batched, deduplicated embedding calls backed by a persistent content-hash cache, which is
+# opened on the first embedding request. Set EMBEDDING_CACHE_PATH="" to disable the on-disk cache.
+_embedding_cache_path = os.environ.get("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite")
+embedding_service = EmbeddingService(
+    _openai_embed,
+    open_cache=lambda: EmbeddingCache(_embedding_cache_path) if _embedding_cache_path else None,
+)
+
 
 def get_embedding(text: str, model: str = "text-embedding-3-small") -> list[float]:
-    """Get embedding from OpenAI."""
+    """Get embedding from OpenAI (served from the embedding cache when possible)."""
     try:
-        text = text.replace("\n", " ")
-        return client.embeddings.create(input=[text], model=model).data[0].embedding
+        return embedding_service.embed(text, model)
     except Exception as e:
         logger.error(f"Error getting embedding: {e}")
         return []
 
 
+def get_embeddings(texts: list[str], model: str = "text-embedding-3-small") -> list[list[float]]:
+    """Get embeddings for many texts with batched requests. Failed lookups yield empty lists."""
+    if not texts:
+        return []
+    try:
+        return embedding_service.embed_many(texts, model)
+    except Exception as e:
+        logger.error(f"Error getting embeddings: {e}")
+        return [[] for _ in texts]
+
+
 def num_tokens_from_messages(messages, model):
     """Return the number of tokens used by a list of messages.
     Borrowed from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        # print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "GPT-3-5-turbo-chat",
-        "GPT-3-5-16k-turbo-chat",
-        "gpt-3.5-16k-turbo-chat",
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-3.5-turbo-1106",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-        "gpt-4o",
-        "gpt-5-mini",
-    }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = (
-            4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        )
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    return get_token_counter(model).count(messages)
 
 
 MAX_TOKENS = {
@@ -117,6 +116,27 @@ def get_mode(model: str) -> str:
         raise ValueError(f"Unknown model: {model}")
 
 
+def _retry_after(error: RateLimitError) -> float | None:
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _rate_limited(request, estimated_tokens: int):
+    """Run `request()` under the rate limiter, pausing all threads and retrying on rate-limit errors."""
+    for attempt in range(rate_limiter.max_retries + 1):
+        rate_limiter.acquire(estimated_tokens)
+        try:
+            return request()
+        except RateLimitError as e:
+            if attempt == rate_limiter.max_retries:
+                raise
+            delay = _retry_after(e) or 2 ** attempt
+            logger.warning(f"Rate limited, retrying in {delay:.1f}s ({attempt + 1}/{rate_limiter.max_retries})")
+            rate_limiter.pause(delay)
+
+
 # @backoff.on_exception(
 #     backoff.constant,
 #     (APIError, RateLimitError, APIConnectionError),
@@ -137,26 +157,27 @@ def generate_response(
     gen_kwargs = {}
     if temperature != 0.0:
         gen_kwargs["temperature"] = temperature
+    estimated_tokens = rate_limiter.estimate_tokens(messages)
 
     if get_mode(model) == "chat":
         # Proactively remove stop tokens for models that don't support them
         effective_stop = stop_tokens if (stop_tokens and model not in MODELS_WITHOUT_STOP_SUPPORT) else None
         
         try:
-            response = client.chat.completions.create(
+            response = _rate_limited(lambda: client.chat.completions.create(
                 model=model,
                 messages=messages,
                 stop=effective_stop,
                 **gen_kwargs
-            )
+            ), estimated_tokens)
         except BadRequestError as e:
             if "Unsupported parameter: 'stop'" in str(e) or "'stop' is not supported" in str(e):
                 logger.warning(f"Model {model} does not support 'stop' parameter. Retrying without it.")
-                response = client.chat.completions.create(
+                response = _rate_limited(lambda: client.chat.completions.create(
                     model=model,
                     messages=messages,
                     **gen_kwargs
-                )
+                ), estimated_tokens)
             else:
                 raise e
         message = response.choices[0].message.content
@@ -165,18 +186,21 @@ def generate_response(
         effective_stop = stop_tokens if (stop_tokens and model not in MODELS_WITHOUT_STOP_SUPPORT) else None
         
         prompt = "\n\n".join(m["content"] for m in messages) + "\n\n"
-        response = openai.Completion.create(
+        response = _rate_limited(lambda: openai.Completion.create(
             prompt=prompt,
             engine=model,
             temperature=temperature,
             stop=effective_stop,
-        )
+        ), estimated_tokens)
         message = response["choices"][0]["text"]
     info = {
         "prompt_tokens": response.usage.prompt_tokens,
         "completion_tokens": response.usage.completion_tokens,
         "total_tokens": response.usage.total_tokens,
+        # Prompt tokens served from the provider's prompt cache
+        "cached_tokens": getattr(getattr(response.usage, "prompt_tokens_details", None), "cached_tokens", None) or 0,
     }
+    rate_limiter.settle(estimated_tokens, info["total_tokens"])
     if message is None: message = ""
 
     return message, info
@@ -0,0 +1,137 @@
+import os
+import json
+import zlib
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+from utils.env import StepObservations, get_top_k_candidates
+
+# Part of every key; bump it when the observations themselves change so old entries stop matching
+OBSERVATION_VERSION = 2
+
+
+class ObservationCache:
+    """
+    On-disk cache of the model-independent step observations used by eval_sample, in a single
+    SQLite file of zlib-compressed JSON values.
+
+    Keys are per (annotation_id, action_uid): the target observation/action, and the top-k
+    observation for each k. Top-k keys also hash the selected candidate ids, so a change in
+    candidate ranks (e.g. a different scores file) is a miss rather than a stale hit.
+    Misses are computed with utils.env.StepObservations and written back, so the first run fills the cache.
+    """
+
+    def __init__(self, path: str, write_back: bool = True):
+        self.path = path
+        self.write_back = write_back
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS observations (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        self._conn.commit()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM observations").fetchone()[0]
+
+    @staticmethod
+    def target_key(annotation_id: str, s: dict) -> str:
+        return f"v{OBSERVATION_VERSION}/{annotation_id}/{s['action_uid']}/target"
+
+    @staticmethod
+    def top_k_key(annotation_id: str, s: dict, top_k: int) -> str:
+        candidates = hashlib.md5(json.dumps(get_top_k_candidates(s, top_k)).encode("utf-8")).hexdigest()[:12]
+        return f"v{OBSERVATION_VERSION}/{annotation_id}/{s['action_uid']}/top{top_k}/{candidates}"
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM observations WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def contains(self, keys: Iterable[str]) -> set:
+        """The subset of `keys` already cached."""
+        keys = list(keys)
+        found = set()
+        with self._lock:
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(k for (k,) in self._conn.execute(
+                    f"SELECT key FROM observations WHERE key IN ({placeholders})", chunk
+                ))
+        return found
+
+    def put_many(self, items: Dict[str, Any]):
+        if not items:
+            return
+        rows = [(k, zlib.compress(json.dumps(v, ensure_ascii=False).encode("utf-8"))) for k, v in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO observations (key, value) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def cached(self, key: str, compute):
+        """The cached value for `key`, or `compute()` (written back unless disabled)."""
+        value = self.get(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+        self.stats["misses"] += 1
+        value = compute()
+        if self.write_back:
+            self.put_many({key: value})
+        return value
+
+    def step(self, annotation_id: str, s: dict) -> "CachedStepObservations":
+        """StepObservations for `s` that are served from this cache where possible."""
+        return CachedStepObservations(self, annotation_id, s)
+
+
+class CachedStepObservations:
+    """Same interface as utils.env.StepObservations; the step's HTML is only parsed on a cache miss."""
+
+    def __init__(self, cache: ObservationCache, annotation_id: str, s: dict):
+        self.cache = cache
+        self.annotation_id = annotation_id
+        self.s = s
+        self._step = None
+
+    @property
+    def step(self) -> StepObservations:
+        if self._step is None:
+            self._step = StepObservations(self.s)
+        return self._step
+
+    def target_obs_and_act(self) -> Tuple[str, str]:
+        o, a = self.cache.cached(self.cache.target_key(self.annotation_id, self.s), lambda: list(self.step.target_obs_and_act()))
+        return o, a
+
+    def top_k_obs(self, top_k: int, use_raw: bool = True) -> Tuple[str, list]:
+        if len(self.s["pos_candidates"]) == 0:
+            assert use_raw
+        key = self.cache.top_k_key(self.annotation_id, self.s, top_k)
+        obs, candidates = self.cache.cached(key, lambda: list(self.step.top_k_obs(top_k)))
+        return obs, candidates
+
+
+_CACHE_REGISTRY: Dict[str, ObservationCache] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def get_observation_cache(path: str) -> ObservationCache:
+    """Return the process-wide ObservationCache for this file, opening it on first use."""
+    key = os.path.abspath(path)
+    with _REGISTRY_LOCK:
+        cache = _CACHE_REGISTRY.get(key)
+        if cache is None:
+            cache = ObservationCache(path)
+            _CACHE_REGISTRY[key] = cache
+    return cache
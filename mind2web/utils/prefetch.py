@@ -0,0 +1,101 @@
+import threading
+from typing import Optional
+from concurrent.futures import Future, ProcessPoolExecutor
+from utils.env import StepObservations
+from utils.obs_cache import ObservationCache
+
+
+def step_observations(
+    s: dict, annotation_id: str, previous_top_k: int, top_k: int, obs_cache: Optional[ObservationCache] = None
+) -> dict:
+    """
+    Everything eval_sample needs from the HTML of step `s`. It depends only on the data (the
+    evaluation is teacher-forced), so it can be computed ahead of the LLM calls. `obs` is None
+    when the ground truth is not among the top_k candidates and the step is skipped.
+    """
+    # Each HTML document of the step is parsed at most once, and only if needed
+    step_obs = obs_cache.step(annotation_id, s) if obs_cache is not None else StepObservations(s)
+    _, target_act = step_obs.target_obs_and_act()
+    target_obs, _ = step_obs.top_k_obs(previous_top_k)
+    obs = None
+    if any(c["rank"] < top_k for c in s["pos_candidates"]):
+        obs, _ = step_obs.top_k_obs(top_k, use_raw=False)
+    return {"target_act": target_act, "target_obs": target_obs, "obs": obs}
+
+
+# Set in each worker process by _init_worker
+_worker_examples = None
+_worker_config = None
+
+
+def _init_worker(examples: list, previous_top_k: int, top_k: int, obs_cache_path: Optional[str]):
+    global _worker_examples, _worker_config
+    _worker_examples = examples
+    # A connection of its own: SQLite connections must not be shared across a fork
+    obs_cache = ObservationCache(obs_cache_path) if obs_cache_path else None
+    _worker_config = (previous_top_k, top_k, obs_cache)
+
+
+def _prefetch_step(index: int, step_index: int) -> dict:
+    previous_top_k, top_k, obs_cache = _worker_config
+    sample = _worker_examples[index]
+    return step_observations(sample["actions"][step_index], sample["annotation_id"], previous_top_k, top_k, obs_cache)
+
+
+class StepPrefetcher:
+    """
+    Computes the step observations of upcoming samples in worker processes, so that HTML
+    processing overlaps with the LLM calls of the samples being evaluated. Samples are queued
+    in `indices` order, up to `lookahead` samples past the latest one requested. The examples
+    reach each worker once, through the pool initializer; tasks only carry indices.
+    """
+
+    def __init__(
+        self,
+        examples: list,
+        indices: list,
+        previous_top_k: int,
+        top_k: int,
+        obs_cache_path: Optional[str] = None,
+        workers: int = 2,
+        lookahead: int = 2,
+    ):
+        self.examples = examples
+        self.indices = list(indices)
+        self.lookahead = lookahead
+        self._positions = {index: position for position, index in enumerate(self.indices)}
+        self._futures = {}
+        self._submitted = 0
+        self._lock = threading.Lock()
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(examples, previous_top_k, top_k, obs_cache_path),
+        )
+        # Start the workers right away, before the caller starts any threads of its own
+        with self._lock:
+            self._submit_until(min(lookahead, len(self.indices)))
+
+    def _submit_until(self, end: int):
+        while self._submitted < end:
+            index = self.indices[self._submitted]
+            self._futures[index] = [
+                self._executor.submit(_prefetch_step, index, step_index)
+                for step_index in range(len(self.examples[index]["actions"]))
+            ]
+            self._submitted += 1
+
+    def steps(self, index: int) -> list[Future]:
+        """Futures of step_observations for each step of examples[index], in step order."""
+        with self._lock:
+            self._submit_until(min(self._positions[index] + 1 + self.lookahead, len(self.indices)))
+            return self._futures.pop(index)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
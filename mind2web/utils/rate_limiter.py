@@ -0,0 +1,84 @@
+import time
+import threading
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: `capacity` tokens, refilled at `rate` tokens per second.
+    The level may go negative (debt) when usage turns out higher than what was acquired.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount: float = 1.0):
+        """Block until `amount` tokens are available (a full bucket, if it is larger) and take them."""
+        needed = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._level >= needed:
+                    self._level -= amount
+                    return
+                wait = (needed - self._level) / self.rate
+            time.sleep(wait)
+
+    def consume(self, amount: float):
+        """Take (or, if negative, give back) `amount` tokens without waiting."""
+        with self._lock:
+            self._refill()
+            self._level = min(self.capacity, self._level - amount)
+
+
+class RateLimiter:
+    """
+    Process-wide limits on LLM requests per minute and tokens per minute, shared by every thread.
+    The buckets hold one second's worth, so the budget is spread over the minute instead of spent
+    in a burst (the API also enforces its limits over shorter windows). Requests acquire an
+    estimate of their tokens up front and settle the difference with the reported usage afterwards.
+    A rate-limit error from the API pauses all threads, not just the one that hit it. With no
+    limits set, only the pauses apply.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None, max_retries: int = 5):
+        self.requests = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 60)) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def estimate_tokens(messages: list[dict]) -> int:
+        """Rough prompt size (~4 characters per token); the real usage is settled after the call."""
+        return sum(len(m.get("content") or "") for m in messages) // 4
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            with self._lock:
+                wait = self._paused_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        if self.requests is not None:
+            self.requests.acquire(1)
+        if self.tokens is not None and tokens:
+            self.tokens.acquire(tokens)
+
+    def settle(self, estimated_tokens: int, used_tokens: int):
+        if self.tokens is not None:
+            self.tokens.consume(used_tokens - estimated_tokens)
+
+    def pause(self, seconds: float):
+        """Hold every caller of acquire() for `seconds` (e.g. after a rate-limit error)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
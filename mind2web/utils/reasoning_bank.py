@@ -3,19 +3,29 @@ import numpy as np
 import math
 import uuid
 import re
+import fcntl
+import hashlib
+import heapq
 import nltk
 from nltk.stem import SnowballStemmer # Changed from PorterStemmer
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 from pathlib import Path
 from collections import Counter
 from datetime import datetime
-from utils.llm import get_embedding
+from functools import lru_cache
+from utils.llm import get_embedding, get_embeddings
+from utils.embedding_store import EmbeddingStore
+from utils.ann_index import IVFIndex
+from utils.query_cache import QueryCache
+from utils.consolidation import greedy_clusters, merge_clusters, most_similar, shrink_report
 
 import logging
 logger = logging.getLogger(__name__)
 
 # Initialize Snowball Stemmer globally for English
 stemmer = SnowballStemmer("english") # Initialized SnowballStemmer
+# Stemming dominates tokenization cost and the vocabulary is small, so cache stems
+_stem = lru_cache(maxsize=200_000)(stemmer.stem)
 
 def cosine_similarity(v1, v2):
     if not v1 or not v2:
@@ -66,18 +76,245 @@ class BM25:
 def tokenize(text: str) -> List[str]:
     """Basic tokenizer to split text into words, convert to lowercase, and apply stemming."""
     words = re.findall(r'\w+', text.lower())
-    return [stemmer.stem(word) for word in words]
+    return [_stem(word) for word in words]
+
+def _ranks(scores: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """1-based rank of each valid score (highest first, ties in input order); 0 for invalid entries."""
+    ranks = np.zeros(len(scores), dtype=np.int64)
+    idx = np.flatnonzero(valid)
+    ranks[idx[np.argsort(-scores[idx], kind="stable")]] = np.arange(1, len(idx) + 1)
+    return ranks
+
+def _zscores(scores: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """Standardize the valid scores; invalid entries get the lowest valid z-score."""
+    z = np.zeros(len(scores), dtype=np.float64)
+    if not valid.any():
+        return z
+    values = scores[valid]
+    std = values.std()
+    z[valid] = (values - values.mean()) / std if std > 0 else 0.0
+    z[~valid] = z[valid].min()
+    return z
+
+def fuse_scores(dense: np.ndarray, sparse: np.ndarray, method: str = "rrf", dense_weight: float = 0.5, rrf_k: int = 60) -> np.ndarray:
+    """
+    Fuse aligned embedding (`dense`, NaN where a row has no vector) and BM25 (`sparse`) scores.
+    "rrf": weighted reciprocal rank fusion; rows with no embedding or a zero BM25 score get no
+    contribution from that signal. "zscore": weighted sum of standardized scores.
+    """
+    dense_valid = ~np.isnan(dense)
+    if method == "zscore":
+        return dense_weight * _zscores(dense, dense_valid) + (1 - dense_weight) * _zscores(sparse, np.ones(len(sparse), dtype=bool))
+    if method != "rrf":
+        raise ValueError(f"Unknown fusion method: {method}")
+    fused = np.zeros(len(dense), dtype=np.float64)
+    for weight, ranks in ((dense_weight, _ranks(dense, dense_valid)), (1 - dense_weight, _ranks(sparse, sparse > 0))):
+        ranked = ranks > 0
+        fused[ranked] += weight / (rrf_k + ranks[ranked])
+    return fused
+
+class BM25Index:
+    """
+    Persistent, incrementally maintained inverted index for BM25.
+
+    Rows are positions in the bank's memory list. Postings hold term frequencies, and
+    document frequencies / lengths are also tracked per domain so that domain-filtered
+    queries score exactly like a BM25 built over just that domain's documents.
+    Scoring only touches the postings of the query terms.
+    """
+    VERSION = 1
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[str] = []
+        self.doc_domains: List[str] = []
+        self.doc_len: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.total_len = 0
+        self.domain_df: Dict[str, Counter] = {}
+        self.domain_count: Counter = Counter()
+        self.domain_len: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def add(self, doc_id: str, domain: str, tokens: List[str]):
+        row = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_domains.append(domain)
+        self.doc_len.append(len(tokens))
+        self.total_len += len(tokens)
+        self.domain_count[domain] += 1
+        self.domain_len[domain] += len(tokens)
+        for token, freq in Counter(tokens).items():
+            self.postings.setdefault(token, {})[row] = freq
+            self.domain_df.setdefault(token, Counter())[domain] += 1
+
+    def corpus_stats(self, query: List[str]) -> Tuple[int, int, Dict[str, int]]:
+        """(document count, total length, {query token: document frequency}) over all documents."""
+        return len(self.doc_ids), self.total_len, {token: len(self.postings.get(token, ())) for token in set(query)}
+
+    def get_scores(self, query: List[str], domain: str = None, stats: Tuple[int, int, Dict[str, int]] = None) -> Dict[int, float]:
+        """
+        Sparse BM25 scores {row: score} over all documents, or only those in `domain`
+        (statistics then come from that domain alone). Rows scoring zero are omitted.
+        `stats` (as from corpus_stats) replaces the statistics of an all-document query, e.g. with
+        the totals of several indexes so that their scores are comparable.
+        """
+        if stats is not None:
+            corpus_size, total_len, df = stats
+        elif domain is None:
+            corpus_size, total_len = len(self.doc_ids), self.total_len
+        else:
+            corpus_size, total_len = self.domain_count[domain], self.domain_len[domain]
+        if corpus_size == 0:
+            return {}
+        avgdl = total_len / corpus_size
+
+        scores: Dict[int, float] = {}
+        for token in query:
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            if stats is not None:
+                freq_in_corpus = df.get(token, 0)
+            else:
+                freq_in_corpus = len(postings) if domain is None else self.domain_df[token][domain]
+            if freq_in_corpus == 0:
+                continue
+            idf = math.log(1 + (corpus_size - freq_in_corpus + 0.5) / (freq_in_corpus + 0.5))
+            for row, freq in postings.items():
+                if domain is not None and self.doc_domains[row] != domain:
+                    continue
+                numerator = idf * freq * (self.k1 + 1)
+                denominator = freq + self.k1 * (1 - self.b + self.b * self.doc_len[row] / avgdl)
+                scores[row] = scores.get(row, 0.0) + numerator / denominator
+        return scores
+
+    def save(self, path: str):
+        data = {
+            "version": self.VERSION,
+            "k1": self.k1,
+            "b": self.b,
+            "doc_ids": self.doc_ids,
+            "doc_domains": self.doc_domains,
+            "doc_len": self.doc_len,
+            "postings": {t: [[row, freq] for row, freq in p.items()] for t, p in self.postings.items()},
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Load a saved index. Returns None if the file is missing, corrupt, or from another version."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return None
+        if data.get("version") != cls.VERSION:
+            return None
+        index = cls(k1=data["k1"], b=data["b"])
+        index.doc_ids = data["doc_ids"]
+        index.doc_domains = data["doc_domains"]
+        index.doc_len = data["doc_len"]
+        index.total_len = sum(index.doc_len)
+        for domain, length in zip(index.doc_domains, index.doc_len):
+            index.domain_count[domain] += 1
+            index.domain_len[domain] += length
+        for token, postings in data["postings"].items():
+            index.postings[token] = {row: freq for row, freq in postings}
+            index.domain_df[token] = Counter(index.doc_domains[row] for row, _ in postings)
+        return index
+
+    def matches_prefix(self, doc_ids: List[str]) -> bool:
+        """True if this index covers exactly the first len(self) of `doc_ids`, in order."""
+        return len(self.doc_ids) <= len(doc_ids) and self.doc_ids == doc_ids[:len(self.doc_ids)]
+
 
 class ReasoningBank:
-    def __init__(self, storage_path: str = "data/reasoning_bank.json", embedding_path: str = "data/reasoning_bank_embeddings.json"):
+    # Utility = score * w["score"] + log(1 + hits) * w["hits"] + last use (days) / w["recency_days"]
+    EVICTION_WEIGHTS = {"score": 1.0, "hits": 1.0, "recency_days": 7.0}
+
+    def __init__(self, storage_path: str = "data/reasoning_bank.json", embedding_path: str = "data/reasoning_bank_embeddings.json", compact_every: int = 500,
+                 index_type: str = "exact", ann_nprobe: int = 8, ann_min_size: int = 10_000,
+                 hybrid_fusion: str = "rrf", hybrid_dense_weight: float = 0.5, dedup_threshold: float = None,
+                 capacity: int = None, eviction_weights: Dict[str, float] = None, query_cache_size: int = 1024):
         # nltk.download('punkt') # Download necessary NLTK data for tokenization
         self.storage_path = storage_path
+        # Append-only journal of changes since the last snapshot (storage_path)
+        self.journal_path = f"{os.path.splitext(storage_path)[0]}.journal.jsonl"
+        # Legacy JSON embedding path; vectors are kept in a binary store derived from it
         self.embedding_path = embedding_path
+        self.embedding_store = EmbeddingStore(embedding_path)
+        # Compact the journal into a new snapshot after this many journaled records
+        self.compact_every = compact_every
+        self._journal_records = 0
+        # BM25 inverted index, persisted beside the snapshot; loaded on first BM25 query
+        self.bm25_index_path = f"{os.path.splitext(storage_path)[0]}.bm25.json"
+        self._bm25_index = None
+        # Embedding search: "exact" scans every candidate; "ivf" uses the approximate index
+        # (also selectable per query with retrieve_type="ann"). Banks smaller than
+        # ann_min_size are always searched exactly. ann_nprobe trades recall for latency.
+        self.index_type = index_type
+        self.ann_nprobe = ann_nprobe
+        self.ann_min_size = ann_min_size
+        self.ann_index_path = f"{os.path.splitext(storage_path)[0]}.ivf.npz"
+        self._ann_index = None
+        self._ann_dirty = True
+        # retrieve_type="hybrid": how embedding and BM25 scores are fused (see fuse_scores)
+        self.hybrid_fusion = hybrid_fusion
+        self.hybrid_dense_weight = hybrid_dense_weight
+        # Reject new items whose embedding is at least this similar to an existing item with the
+        # same domain and score (None disables the check). See also consolidate().
+        self.dedup_threshold = dedup_threshold
+        # Keep at most `capacity` items (None = unbounded). The lowest-utility items (see _utility)
+        # are evicted to an append-only archive beside the snapshot rather than dropped.
+        self.capacity = capacity
+        self.eviction_weights = {**self.EVICTION_WEIGHTS, **(eviction_weights or {})}
+        self.archive_path = f"{os.path.splitext(storage_path)[0]}.archive.jsonl"
+        self._heap: List[Tuple[float, int]] = []  # (utility, row); stale pairs are skipped on pop
+        self._heap_utility: Dict[int, float] = {}
+        # LRU cache of retrieval results (0 disables); bumping _version on any change to the rows
+        # or their liveness invalidates it
+        self.query_cache = QueryCache(query_cache_size) if query_cache_size else None
+        self._version = 0
         self.memories = []
+        # Vectorized index over self.memories (row i <-> self.memories[i]).
+        # Backing buffers grow geometrically so appends are amortized O(1).
+        self._matrix_buf = np.zeros((0, 0), dtype=np.float32)  # pre-normalized embeddings
+        self._has_vec_buf = np.zeros(0, dtype=bool)
+        self._alive_buf = np.zeros(0, dtype=bool)  # False once a row is evicted (until the next snapshot)
+        self._ids_buf = np.array([], dtype=object)
+        self._domains_buf = np.array([], dtype=object)
+        self._set_views(0)
         self._load_bank()
+        self._build_index()
+        self._build_heap()
+        self._disk_signature = self._current_signature()
+
+    def _current_signature(self) -> tuple:
+        """(mtime, size) of every backing file, used to detect writes by other processes."""
+        signature = []
+        for path in (self.storage_path, self.journal_path, self.embedding_store.ids_path):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def is_stale(self) -> bool:
+        """True if the files on disk changed since this instance last loaded or wrote them."""
+        return self._current_signature() != self._disk_signature
 
     def _load_bank(self):
-        """Load the reasoning bank content and embeddings from disk, merging them."""
+        """Load the reasoning bank snapshot, replay the journal, and migrate legacy embeddings."""
         # 1. Load Content
         if not os.path.exists(self.storage_path):
             os.makedirs(os.path.dirname(self.storage_path), exist_ok=True)
@@ -90,42 +327,306 @@ class ReasoningBank:
                 logger.warning(f"Failed to decode {self.storage_path}. Starting with empty bank.")
                 self.memories = []
 
-        # 2. Load Embeddings
-        embeddings_map = {}
-        if os.path.exists(self.embedding_path):
-            try:
-                with open(self.embedding_path, 'r', encoding='utf-8') as f:
-                    embeddings_map = json.load(f)
-            except json.JSONDecodeError:
-                embeddings_map = {}
+        # 2. Replay journaled changes made after the snapshot (crash recovery)
+        self._replay_journal()
+
+        # 3. Load Embeddings (binary store; migrate the legacy JSON map on first open)
+        self.embedding_store.migrate_from_json()
 
-        # 3. Merge and Migrate (Assign IDs if missing, move inline embeddings to map)
+        # 4. Migrate (Assign IDs if missing, move inline embeddings to the store)
         data_dirty = False
+        inline_ids, inline_embeddings = [], []
         for entry in self.memories:
             # Ensure ID exists
             if "id" not in entry:
                 entry["id"] = str(uuid.uuid4())
                 data_dirty = True
-            
+
             # Check for inline embedding (legacy migration)
             if "embedding" in entry:
-                if entry["embedding"]:
-                    embeddings_map[entry["id"]] = entry["embedding"]
-                # We don't delete it here effectively, but the save_bank logic 
-                # will strip it from the content file.
+                embedding = entry.pop("embedding")
+                if embedding and entry["id"] not in self.embedding_store:
+                    inline_ids.append(entry["id"])
+                    inline_embeddings.append(embedding)
                 data_dirty = True
-            else:
-                # Load from external map
-                entry["embedding"] = embeddings_map.get(entry["id"])
-        
+        self.embedding_store.append(inline_ids, inline_embeddings)
+
         # If migration happened or IDs were generated, save immediately to normalize files
         if data_dirty:
             self.save_bank()
 
+    def _replay_journal(self):
+        """Apply journal records on top of the loaded snapshot, skipping ones it already contains."""
+        self._journal_records = 0
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                # A torn final line from an interrupted append; everything before it is intact
+                logger.warning(f"Truncating incomplete trailing record in {self.journal_path}")
+                data = data[:data.rfind(b"\n") + 1]
+                f.truncate(len(data))
+
+        known_ids = {m.get("id") for m in self.memories}
+        evicted = set()
+        for line_no, line in enumerate(data.decode('utf-8').splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Ignoring corrupt journal record at {self.journal_path}:{line_no}")
+                continue
+            self._journal_records += 1
+            if record.get("op") == "add":
+                entry = record["entry"]
+                if entry.get("id") not in known_ids:
+                    known_ids.add(entry.get("id"))
+                    self.memories.append(entry)
+            elif record.get("op") == "evict":
+                evicted.update(record["ids"])
+        if evicted:
+            self.memories = [m for m in self.memories if m.get("id") not in evicted]
+
+    def _append_journal(self, records: List[Dict[str, Any]]):
+        """Durably append records to the journal with a single write and fsync."""
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_records += len(records)
+
+    @staticmethod
+    def _normalize(vec) -> np.ndarray:
+        """Return a float32 unit vector (all zeros if the norm is zero)."""
+        arr = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(arr)
+        if norm == 0:
+            return np.zeros_like(arr)
+        return arr / norm
+
+    def _build_index(self):
+        """Build the contiguous embedding matrix and parallel id/domain arrays from self.memories."""
+        n = len(self.memories)
+        self._ids_buf = np.array([m.get("id") for m in self.memories], dtype=object)
+        self._domains_buf = np.array([m.get("domain") for m in self.memories], dtype=object)
+        store_rows = self.embedding_store.rows(list(self._ids_buf))
+        self._has_vec_buf = store_rows >= 0
+        self._alive_buf = np.ones(n, dtype=bool)
+        self._matrix_buf = np.zeros((n, self.embedding_store.dim), dtype=np.float32)
+        if self._has_vec_buf.any():
+            vectors = self.embedding_store.vectors[store_rows[self._has_vec_buf]]
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self._matrix_buf[self._has_vec_buf] = vectors / norms
+        self._set_views(n)
+        self._version += 1
+
+    def _set_views(self, n: int):
+        """Point the public-facing index arrays at the first n rows of the backing buffers."""
+        self._matrix = self._matrix_buf[:n]
+        self._has_vec = self._has_vec_buf[:n]
+        self._alive = self._alive_buf[:n]
+        self._ids = self._ids_buf[:n]
+        self._domains = self._domains_buf[:n]
+
+    def _reserve(self, capacity: int, dim: int = None):
+        """Reallocate the backing buffers to hold `capacity` rows of dimension `dim`."""
+        n = len(self._ids)
+        dim = self._matrix_buf.shape[1] if dim is None else dim
+        matrix = np.zeros((capacity, dim), dtype=np.float32)
+        if dim == self._matrix_buf.shape[1]:
+            matrix[:n] = self._matrix
+        has_vec = np.zeros(capacity, dtype=bool)
+        has_vec[:n] = self._has_vec
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:n] = self._alive
+        ids = np.empty(capacity, dtype=object)
+        ids[:n] = self._ids
+        domains = np.empty(capacity, dtype=object)
+        domains[:n] = self._domains
+        self._matrix_buf, self._has_vec_buf, self._ids_buf, self._domains_buf = matrix, has_vec, ids, domains
+        self._alive_buf = alive
+        self._set_views(n)
+
+    def _set_row(self, row: int, embedding):
+        """Write a (normalized) embedding into the matrix row, growing the dimension on first use."""
+        if not embedding:
+            return
+        if self._matrix_buf.shape[1] == 0:
+            self._reserve(len(self._ids_buf), dim=len(embedding))
+        if len(embedding) != self._matrix.shape[1]:
+            logger.warning(f"Embedding dimension mismatch for memory {self._ids[row]}; skipping.")
+            return
+        self._matrix[row] = self._normalize(embedding)
+        self._has_vec[row] = True
+
+    def _append_to_index(self, entries: List[Dict[str, Any]], embeddings: List[List[float]]):
+        """Append newly added memories (already in self.memories) to the vectorized index."""
+        n, m = len(self._ids), len(entries)
+        if n + m > len(self._ids_buf):
+            self._reserve(max(n + m, 2 * len(self._ids_buf), 64))
+        self._ids_buf[n:n + m] = [entry.get("id") for entry in entries]
+        self._domains_buf[n:n + m] = [entry.get("domain") for entry in entries]
+        self._alive_buf[n:n + m] = True
+        self._set_views(n + m)
+        for offset, embedding in enumerate(embeddings):
+            self._set_row(n + offset, embedding)
+        self._ann_dirty = True
+        self._version += 1
+
+    def _candidate_mask(self, domain: str = None) -> np.ndarray:
+        """Boolean mask of (non-evicted) rows to consider; falls back to all rows if the domain has no memories."""
+        mask = self._alive.copy()
+        if domain:
+            domain_mask = (self._domains == domain) & self._alive
+            if domain_mask.any():
+                mask = domain_mask
+        return mask
+
+    def _fill_missing_embeddings(self, mask: np.ndarray):
+        """Lazily embed candidate memories that have no embedding yet and persist them to the store."""
+        missing_rows = np.flatnonzero(mask & ~self._has_vec)
+        if len(missing_rows) == 0:
+            return
+        # Try both source_task (new) and task_query (legacy) for embedding generation
+        task_texts = [self.memories[row].get("source_task") or self.memories[row].get("task_query", "") for row in missing_rows]
+        new_embeddings = get_embeddings(task_texts)
+        for row, mem_embedding in zip(missing_rows, new_embeddings):
+            self._set_row(row, mem_embedding)
+        self._ann_dirty = True
+        self.embedding_store.append([self.memories[row]["id"] for row in missing_rows], new_embeddings)
+        self._disk_signature = self._current_signature()
+
+    @staticmethod
+    def _top_rows(scores: np.ndarray, rows: np.ndarray, k: int):
+        """Return the rows with the k highest scores and their scores, by descending score (ties keep row order)."""
+        if k < len(rows):
+            kth = np.partition(-scores, k - 1)[k - 1]
+            above = np.flatnonzero(-scores < kth)
+            ties = np.flatnonzero(-scores == kth)[:k - len(above)]
+            keep = np.sort(np.concatenate([above, ties]))
+            rows, scores = rows[keep], scores[keep]
+        order = np.argsort(-scores, kind="stable")
+        return rows[order], scores[order]
+
+    @staticmethod
+    def _bm25_tokens(entry: Dict[str, Any]) -> List[str]:
+        # Combine relevant text fields for BM25
+        return tokenize(f"{entry.get('title', '')} {entry.get('description', '')} {entry.get('content', '')}")
+
+    def _get_bm25_index(self) -> BM25Index:
+        """
+        Load the persisted BM25 index (or start a new one) and index any memories it does not cover yet.
+        A freshly built index is saved at once; rows added later are saved with the next snapshot, so
+        inserts never rewrite the index (a reloading process indexes the journaled tail itself).
+        """
+        if self._bm25_index is None:
+            ids = [m.get("id") for m in self.memories]
+            index = BM25Index.load(self.bm25_index_path)
+            rebuilt = index is None or not index.matches_prefix(ids)
+            self._bm25_index = BM25Index() if rebuilt else index
+            for entry in self.memories[len(self._bm25_index):]:
+                self._bm25_index.add(entry.get("id"), entry.get("domain"), self._bm25_tokens(entry))
+            if rebuilt and len(self._bm25_index):
+                self._save_bm25_index()
+        return self._bm25_index
+
+    def _save_bm25_index(self):
+        try:
+            self._bm25_index.save(self.bm25_index_path)
+        except Exception as e:
+            logger.error(f"Failed to save BM25 index to {self.bm25_index_path}: {e}")
+
+    def _get_ann_index(self) -> IVFIndex:
+        """
+        Load the persisted IVF index (or train a new one) and insert any embedded rows it does not cover yet.
+        The quantizer is retrained once the bank has grown well past the size it was trained on.
+        """
+        if self._ann_index is None:
+            # Rows beyond the current bank make load() fail, which discards the stale index
+            index = IVFIndex.load(self.ann_index_path, lambda rows: self._matrix[rows])
+            if index is not None and (
+                index.dim != self._matrix.shape[1]
+                or not np.array_equal(self._ids[index.rows], np.array(index.doc_ids, dtype=object))
+            ):
+                index = None
+            self._ann_index = index
+            self._ann_dirty = True
+
+        if self._ann_dirty:
+            index = self._ann_index
+            if index is None or index.needs_retrain():
+                index = IVFIndex(self._matrix.shape[1], nprobe=self.ann_nprobe)
+                index.train(self._matrix[self._has_vec])
+                index.reset()
+            indexed = np.zeros(len(self._ids), dtype=bool)
+            indexed[index.rows] = True
+            new_rows = np.flatnonzero(self._has_vec & ~indexed)
+            index.add(list(self._ids[new_rows]), new_rows, self._matrix[new_rows])
+            if index is not self._ann_index:
+                # Persist freshly trained indexes; incremental inserts are saved on compaction
+                self._ann_index = index
+                self._save_ann_index()
+            self._ann_dirty = False
+        self._ann_index.nprobe = self.ann_nprobe
+        return self._ann_index
+
+    def _save_ann_index(self):
+        try:
+            self._ann_index.save(self.ann_index_path)
+        except Exception as e:
+            logger.error(f"Failed to save ANN index to {self.ann_index_path}: {e}")
+
+    def _ann_search(self, query_vec: np.ndarray, candidates: np.ndarray, k: int):
+        """Approximate top-k rows among `candidates`, or None if the exact path should be used instead."""
+        num_candidates = int(candidates.sum())
+        if int(self._has_vec.sum()) < self.ann_min_size:
+            return None
+        top_rows = self._get_ann_index().search(query_vec, self._matrix, k, row_mask=candidates)
+        if len(top_rows) < min(k, num_candidates):
+            # Probed lists held too few candidates (e.g. a small domain); fall back to the exact scan
+            return None
+        return top_rows
+
+    def _bm25_scores(self, query: str, domain: str, rows: np.ndarray, stats: Tuple[int, int, Dict[str, int]] = None) -> np.ndarray:
+        """
+        BM25 scores aligned with `rows` (the candidate rows for `domain`), touching only the query terms' postings.
+        `stats` overrides the corpus statistics of all-domain queries (see BM25Index.get_scores).
+        """
+        index = self._get_bm25_index()
+        scope = domain if (domain and index.domain_count[domain]) else None
+        sparse = index.get_scores(tokenize(query), domain=scope, stats=stats if scope is None else None)
+
+        scores = np.zeros(len(rows), dtype=np.float64)
+        if sparse:
+            hit_rows = np.fromiter(sparse.keys(), dtype=np.int64, count=len(sparse))
+            hit_scores = np.fromiter(sparse.values(), dtype=np.float64, count=len(sparse))
+            # Evicted rows stay in the index until the next snapshot; they are never candidates
+            live = self._alive[hit_rows]
+            scores[np.searchsorted(rows, hit_rows[live])] = hit_scores[live]
+        return scores
+
+    def _dense_scores(self, query_embedding: List[float], mask: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Cosine scores aligned with `rows` (NaN where a row has no embedding), embedding missing candidates first."""
+        dense = np.full(len(rows), np.nan)
+        if query_embedding:
+            self._fill_missing_embeddings(mask)
+            if len(query_embedding) == self._matrix.shape[1]:
+                embedded = self._has_vec[rows]
+                dense[embedded] = self._matrix[rows[embedded]] @ self._normalize(query_embedding)
+        return dense
+
     def save_bank(self):
-        """Save content and embeddings to separate files."""
+        """Write a full content snapshot and reset the journal (compaction).
+
+        Embeddings are appended to the binary store as they are added and are not rewritten here.
+        Evicted rows are dropped from the snapshot (and the in-memory index) here.
+        """
+        if len(self._alive) == len(self.memories) and not self._alive.all():
+            self._purge_evicted()
         content_data = []
-        embedding_data = {}
 
         for entry in self.memories:
             # Create a clean copy for content file (exclude embedding)
@@ -133,22 +634,149 @@ class ReasoningBank:
             if "embedding" in item_copy:
                 del item_copy["embedding"]
             content_data.append(item_copy)
-            
-            # Store embedding separately if it exists
-            if entry.get("embedding"):
-                embedding_data[entry["id"]] = entry.get("embedding")
 
         try:
-            with open(self.storage_path, 'w', encoding='utf-8') as f:
+            # Write to a temp file and rename so a crash never leaves a half-written snapshot
+            tmp_path = f"{self.storage_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
                 json.dump(content_data, f, indent=2, ensure_ascii=False)
-            
-            with open(self.embedding_path, 'w', encoding='utf-8') as f:
-                json.dump(embedding_data, f) # Embeddings file can be compact
-            
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.storage_path)
+
+            # The snapshot now covers every journaled record
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self._journal_records = 0
+            if self._bm25_index is not None:
+                self._save_bm25_index()
+            if self._ann_index is not None:
+                self._save_ann_index()
+            self._disk_signature = self._current_signature()
+
             logger.info(f"Reasoning Bank saved: {len(self.memories)} items.")
         except Exception as e:
             logger.error(f"Failed to save Reasoning Bank: {e}")
 
+    def compact(self):
+        """Fold the journal into a new snapshot."""
+        self.save_bank()
+
+    def _commit_entries(self, entries: List[Dict[str, Any]], embeddings: List[List[float]]):
+        """Persist new entries (vectors to the store, content to the journal) and index them."""
+        self.embedding_store.append([e["id"] for e in entries], embeddings)
+        self._append_journal([{"op": "add", "entry": e} for e in entries])
+        self.memories.extend(entries)
+        self._append_to_index(entries, embeddings)
+        if self._bm25_index is not None:
+            # Saved with the next snapshot
+            for entry in entries:
+                self._bm25_index.add(entry["id"], entry.get("domain"), self._bm25_tokens(entry))
+        if self.capacity is not None:
+            for row in range(len(self.memories) - len(entries), len(self.memories)):
+                self._push_utility(row)
+            self._evict_over_capacity()
+        self._disk_signature = self._current_signature()
+        if self.compact_every and self._journal_records >= self.compact_every:
+            self.compact()
+
+    @staticmethod
+    def _epoch_seconds(timestamp) -> float:
+        try:
+            return datetime.fromisoformat(timestamp).timestamp()
+        except (TypeError, ValueError):
+            return 0.0
+
+    def _utility(self, entry: Dict[str, Any]) -> float:
+        """
+        Eviction priority of an entry (lowest is evicted first). Recency enters as the absolute time
+        of last use (added or retrieved) rather than an age, so utilities never change as the clock
+        advances and the heap stays valid; only a retrieval hit changes an entry's utility.
+        """
+        w = self.eviction_weights
+        last_used = max(self._epoch_seconds(entry.get("timestamp")), self._epoch_seconds(entry.get("last_retrieved")))
+        return (w["score"] * float(entry.get("score") or 0.0)
+                + w["hits"] * math.log1p(entry.get("hits", 0))
+                + last_used / (86400.0 * w["recency_days"]))
+
+    def live_memories(self) -> List[Dict[str, Any]]:
+        """self.memories without items evicted since the last snapshot."""
+        return [entry for entry, alive in zip(self.memories, self._alive) if alive]
+
+    def _build_heap(self):
+        """Heapify the utilities of all live rows (only with a capacity), evicting down to capacity."""
+        self._heap, self._heap_utility = [], {}
+        if self.capacity is None:
+            return
+        for row in np.flatnonzero(self._alive):
+            row = int(row)
+            self._heap_utility[row] = self._utility(self.memories[row])
+            self._heap.append((self._heap_utility[row], row))
+        heapq.heapify(self._heap)
+        self._evict_over_capacity()
+
+    def _push_utility(self, row: int):
+        """(Re)insert a row with its current utility; any older heap pair for it becomes stale."""
+        self._heap_utility[row] = self._utility(self.memories[row])
+        heapq.heappush(self._heap, (self._heap_utility[row], row))
+        if len(self._heap) > 2 * len(self._heap_utility) + 64:
+            # Too many stale pairs from repeated hits; rebuild from the live utilities
+            self._heap = [(u, r) for r, u in self._heap_utility.items()]
+            heapq.heapify(self._heap)
+
+    def _record_hits(self, rows):
+        """
+        Count a retrieval of each row (only with a capacity, since hits only matter for eviction).
+        The statistics live on the entries, so they are persisted with the next snapshot (a crash
+        before then only loses recent hit counts).
+        """
+        if self.capacity is None:
+            return
+        now = datetime.now().isoformat()
+        for row in rows:
+            row = int(row)
+            entry = self.memories[row]
+            entry["hits"] = entry.get("hits", 0) + 1
+            entry["last_retrieved"] = now
+            if row in self._heap_utility:
+                self._push_utility(row)
+
+    def _evict_over_capacity(self):
+        """Pop the lowest-utility live rows until the bank is within capacity, O(log N) each."""
+        victims = []
+        while len(self._heap_utility) > self.capacity and self._heap:
+            utility, row = heapq.heappop(self._heap)
+            if self._heap_utility.get(row) != utility:
+                continue  # stale pair (superseded by a later hit)
+            del self._heap_utility[row]
+            victims.append(row)
+        if not victims:
+            return
+
+        # Archive first, then journal the eviction: a crash in between leaves the item both
+        # archived and live, never lost
+        entries = [self.memories[row] for row in victims]
+        evicted_at = datetime.now().isoformat()
+        with open(self.archive_path, 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps({"evicted_at": evicted_at, "entry": e}, ensure_ascii=False) + "\n" for e in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self._append_journal([{"op": "evict", "ids": [e["id"] for e in entries]}])
+        self._alive[victims] = False
+        self._version += 1
+        logger.info(f"Evicted {len(victims)} items from Reasoning Bank {self.storage_path} to {self.archive_path} (capacity {self.capacity}).")
+
+    def _purge_evicted(self):
+        """Physically drop evicted rows. Row positions change, so the derived indexes are rebuilt."""
+        self.memories = [self.memories[row] for row in np.flatnonzero(self._alive)]
+        self._bm25_index = None
+        self._ann_index = None
+        for path in (self.bm25_index_path, self.ann_index_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._build_index()
+        self._build_heap()
+
     def add_memory(self, task_query: str, trajectory_summary: str, memory_items: List[Dict[str, str]], score: float, outcome: str, domain: str = ""):
         """Add a new entry to the bank (legacy - multiple items)."""
         embedding = get_embedding(task_query)
@@ -161,11 +789,9 @@ class ReasoningBank:
             "memory_items": memory_items,
             "score": score,
             "outcome": outcome,
-            "embedding": embedding,
             "timestamp": datetime.now().isoformat()
         }
-        self.memories.append(entry)
-        self.save_bank()
+        self._commit_entries([entry], [embedding])
 
     def add_memory_item(self, task_query: str, memory_item: Dict[str, str], outcome: str, domain: str = "", context: str = ""):
         """
@@ -178,124 +804,192 @@ class ReasoningBank:
             domain: Website domain
             context: Additional context (e.g., "Successful steps from task")
         """
+        self.add_memory_items(task_query, [memory_item], outcome, domain=domain, context=context)
+
+    def add_memory_items(self, task_query: str, memory_items: List[Dict[str, str]], outcome: str, domain: str = "", context: str = ""):
+        """
+        Add several memory items from the same task as independent entries in one journal write.
+
+        Args:
+            task_query: The original task description
+            memory_items: Memory item dicts with 'title', 'description', 'content'
+            outcome: "SUCCESS" or "FAILURE"
+            domain: Website domain
+            context: Additional context (e.g., "Successful steps from task")
+        """
+        if not memory_items:
+            return
+
         # Create embedding text: task + context + item title & description
-        embedding_text = f"Task: {task_query}\n"
+        prefix = f"Task: {task_query}\n"
         if domain:
-            embedding_text += f"Domain: {domain}\n"
+            prefix += f"Domain: {domain}\n"
         if outcome:
-            embedding_text += f"Type: {outcome}\n"
+            prefix += f"Type: {outcome}\n"
         if context:
-            embedding_text += f"Context: {context}\n"
+            prefix += f"Context: {context}\n"
 
-        embedding_text += f"\nStrategy: {memory_item.get('title', '')}\n{memory_item.get('description', '')}"
+        embeddings = get_embeddings([
+            prefix + f"\nStrategy: {memory_item.get('title', '')}\n{memory_item.get('description', '')}"
+            for memory_item in memory_items
+        ])
 
-        embedding = get_embedding(embedding_text)
-        new_id = str(uuid.uuid4())
+        score = 1.0 if outcome == "SUCCESS" else 0.0
+        entries, entry_embeddings = [], []
+        for memory_item, embedding in zip(memory_items, embeddings):
+            if self.dedup_threshold is not None and self._is_duplicate(embedding, domain, score, entry_embeddings):
+                logger.info(f"Skipping near-duplicate memory item: {memory_item.get('title', '')[:50]}")
+                continue
+            entry_embeddings.append(embedding)
+            # Flat structure: flatten memory_item fields to top level
+            entries.append({
+                "id": str(uuid.uuid4()),
+                "source_task": task_query,
+                "domain": domain,
+                "title": memory_item.get("title", ""),
+                "description": memory_item.get("description", ""),
+                "content": memory_item.get("content", ""),
+                "score": score,
+                "timestamp": datetime.now().isoformat()
+            })
+        if entries:
+            self._commit_entries(entries, entry_embeddings)
 
-        # Flat structure: flatten memory_item fields to top level
-        entry = {
-            "id": new_id,
-            "source_task": task_query,
-            "domain": domain,
-            "title": memory_item.get("title", ""),
-            "description": memory_item.get("description", ""),
-            "content": memory_item.get("content", ""),
-            "score": 1.0 if outcome == "SUCCESS" else 0.0,
-            "embedding": embedding,
-            "timestamp": datetime.now().isoformat()
-        }
-        self.memories.append(entry)
+    def _is_duplicate(self, embedding, domain: str, score: float, pending: List[List[float]]) -> bool:
+        """True if `embedding` is within dedup_threshold of a stored item (same domain and score) or of `pending`."""
+        if not embedding:
+            return False
+        if pending:
+            _, best = most_similar(embedding, np.asarray(pending, dtype=np.float32))
+            if best >= self.dedup_threshold:
+                return True
+        if not len(self._ids) or len(embedding) != self._matrix.shape[1]:
+            return False
+        rows = np.flatnonzero((self._domains == domain) & self._has_vec & self._alive)
+        rows = [row for row in rows if self.memories[row].get("score") == score]
+        _, best = most_similar(embedding, self._matrix, rows)
+        return best >= self.dedup_threshold
+
+    def consolidate(self, threshold: float = 0.95, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Merge near-duplicate memories: items of the same domain and score whose embeddings have cosine
+        similarity >= threshold are clustered (greedy, oldest item leads) and only the leader is kept,
+        with "support" counting the items it absorbed. Writes a new snapshot unless dry_run.
+        Returns a report of how much the bank shrank.
+        """
+        if not self._alive.all():
+            self._purge_evicted()
+        self._fill_missing_embeddings(np.ones(len(self.memories), dtype=bool))
+        groups = [(m.get("domain"), m.get("score")) for m in self.memories]
+        leader_of = greedy_clusters(self._matrix, threshold, groups)
+        kept = merge_clusters(self.memories, leader_of)
+        report = shrink_report(len(self.memories), len(kept))
+        if dry_run or not report["removed"]:
+            return report
+
+        self.memories = kept
+        # Row positions change, so the derived indexes are rebuilt from scratch
+        self._bm25_index = None
+        self._ann_index = None
+        for path in (self.bm25_index_path, self.ann_index_path):
+            if os.path.exists(path):
+                os.remove(path)
         self.save_bank()
+        self._build_index()
+        self._build_heap()
+        logger.info(f"Consolidated Reasoning Bank {self.storage_path}: {report['before']} -> {report['after']} items.")
+        return report
+
+    def query_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the retrieval cache (empty if disabled)."""
+        return self.query_cache.stats() if self.query_cache is not None else {}
 
     def retrieve(self, query: str, top_k: int = 3, domain: str = None, retrieve_type: str = "embedding") -> List[Dict[str, Any]]:
         """
-        Retrieve relevant memory items based on query similarity using either embedding or BM25.
+        Retrieve relevant memory items based on query similarity using embedding, BM25,
+        approximate embedding ("ann"), or fused embedding + BM25 ("hybrid") search.
         Optionally filter by domain.
         Returns list of memory items in format: {"title": ..., "description": ..., "content": ...}
         """
-        if not self.memories:
+        scored = self.retrieve_scored(query, top_k=top_k, domain=domain, retrieve_type=retrieve_type)
+        return self._format_items(entry for _, entry in scored)[:top_k]
+
+    def retrieve_scored(self, query: str, top_k: int = 3, domain: str = None, retrieve_type: str = "embedding") -> List[Tuple[float, Dict[str, Any]]]:
+        """Like retrieve(), but return the top-k raw bank entries with their scores, best first."""
+        if not self.memories or top_k <= 0:
             return []
 
-        # 1. Filter candidates by domain
-        candidates = self.memories
-        if domain:
-            filtered_candidates = [m for m in self.memories if m.get("domain") == domain]
-            if filtered_candidates:
-                candidates = filtered_candidates
+        # 1. Filter candidates by domain (boolean mask over the index rows)
+        mask = self._candidate_mask(domain)
 
-        if not candidates:
-            return []
+        if retrieve_type not in ("embedding", "bm25", "ann", "hybrid"):
+            logger.warning(f"Unknown retrieve_type: {retrieve_type}. Defaulting to embedding retrieval.")
+            retrieve_type = "embedding"
 
-        scored_items = []
-        updates_made = False
+        # Repeated queries are answered from the cache until the bank changes
+        cache_key = (QueryCache.normalize(query), domain, top_k, retrieve_type,
+                     self.index_type, self.ann_nprobe, self.hybrid_fusion, self.hybrid_dense_weight)
+        cached = self.query_cache.get(cache_key, self._version) if self.query_cache is not None else None
+        if cached is not None:
+            top_rows, top_scores = cached
+            self._record_hits(top_rows)
+            return [(float(score), self.memories[row]) for row, score in zip(top_rows, top_scores)]
 
-        if retrieve_type == "embedding":
+        top_rows = None
+        if retrieve_type in ("embedding", "ann"):
             # 2. Compute query embedding
             query_embedding = get_embedding(query)
             if not query_embedding:
                 return []
 
-            # 3. Calculate similarity for each memory item
-            for entry in candidates:
-                # Recompute embedding if not present
-                mem_embedding = entry.get("embedding")
-                if not mem_embedding:
-                    # Try both source_task (new) and task_query (legacy) for embedding generation
-                    task_text = entry.get("source_task") or entry.get("task_query", "")
-                    mem_embedding = get_embedding(task_text)
-                    entry["embedding"] = mem_embedding
-                    updates_made = True
-
-                if mem_embedding:
-                    similarity = cosine_similarity(query_embedding, mem_embedding)
-                    scored_items.append((similarity, entry))
-        
-        elif retrieve_type == "bm25":
-            # Prepare BM25 corpus and tokenize query
-            corpus_docs = []
-            for entry in candidates:
-                # Combine relevant text fields for BM25
-                combined_text = f"{entry.get('title', '')} {entry.get('description', '')} {entry.get('content', '')}"
-                corpus_docs.append(tokenize(combined_text))
-            
-            if not corpus_docs:
+            # Lazily embed (and persist) candidates that have no embedding yet
+            self._fill_missing_embeddings(mask)
+
+            candidates = mask & self._has_vec
+            if not candidates.any() or len(query_embedding) != self._matrix.shape[1]:
                 return []
+            query_vec = self._normalize(query_embedding)
+
+            # 3a. Approximate search (probe a few IVF lists, then re-rank exactly)
+            if retrieve_type == "ann" or self.index_type == "ivf":
+                top_rows = self._ann_search(query_vec, candidates, top_k)
+                if top_rows is not None:
+                    top_scores = self._matrix[top_rows] @ query_vec
+
+            # 3b. Exact search: score all candidates with a single matrix-vector product
+            if top_rows is None:
+                rows = np.flatnonzero(candidates)
+                scores = self._matrix[rows] @ query_vec
 
-            bm25 = BM25(corpus_docs)
-            tokenized_query = tokenize(query)
-            bm25_scores = bm25.get_scores(tokenized_query)
+        elif retrieve_type == "bm25":
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
+                return []
+            scores = self._bm25_scores(query, domain, rows)
 
-            for i, score in enumerate(bm25_scores):
-                scored_items.append((score, candidates[i]))
         else:
-            logger.warning(f"Unknown retrieve_type: {retrieve_type}. Defaulting to embedding retrieval.")
-            # Fallback to embedding if an unknown type is provided
-            query_embedding = get_embedding(query)
-            if not query_embedding:
+            # Hybrid: both signals over the same candidate rows, fused into one ranking
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
                 return []
-            for entry in candidates:
-                mem_embedding = entry.get("embedding")
-                if not mem_embedding:
-                    task_text = entry.get("source_task") or entry.get("task_query", "")
-                    mem_embedding = get_embedding(task_text)
-                    entry["embedding"] = mem_embedding
-                    updates_made = True
-                if mem_embedding:
-                    similarity = cosine_similarity(query_embedding, mem_embedding)
-                    scored_items.append((similarity, entry))
-
-
-        # Save updates if any lazy loading occurred
-        if updates_made:
-            self.save_bank()
+            sparse = self._bm25_scores(query, domain, rows)
+            dense = self._dense_scores(get_embedding(query), mask, rows)
+            scores = fuse_scores(dense, sparse, method=self.hybrid_fusion, dense_weight=self.hybrid_dense_weight)
 
-        # 4. Sort by similarity/score and select top-k items
-        scored_items.sort(key=lambda x: x[0], reverse=True)
+        # 4. Select top-k rows by score
+        if top_rows is None:
+            top_rows, top_scores = self._top_rows(scores, rows, top_k)
 
-        # 5. Return top-k items in correct format
-        # Support multiple formats for backward compatibility
+        if self.query_cache is not None:
+            self.query_cache.put(cache_key, self._version, (top_rows, top_scores))
+        self._record_hits(top_rows)
+        return [(float(score), self.memories[row]) for row, score in zip(top_rows, top_scores)]
+
+    @staticmethod
+    def _format_items(entries) -> List[Dict[str, Any]]:
+        """Convert bank entries into memory items, supporting multiple formats for backward compatibility."""
         top_items = []
-        for sim, entry in scored_items[:top_k]:
+        for entry in entries:
             # New flat format: title, description, content at top level
             if "title" in entry and "description" in entry and "content" in entry:
                 top_items.append({
@@ -309,8 +1003,262 @@ class ReasoningBank:
             # Legacy format: memory_items array
             elif "memory_items" in entry and entry["memory_items"]:
                 top_items.extend(entry["memory_items"])
+        return top_items
+
+
+class ShardedReasoningBank:
+    """
+    Reasoning bank stored as one ReasoningBank shard (content + vectors) per domain, plus a manifest.
+
+    Given `storage_path="data/reasoning_bank.json"` the files are:
+        data/reasoning_bank.shards/manifest.json   {"version": 1, "shards": {domain: file stem}}
+        data/reasoning_bank.shards/<stem>.json     an ordinary ReasoningBank per domain (with its
+                                                   own journal, embedding store and indexes)
+    Shards are loaded on first use. A query for a known domain goes straight to that shard; any other
+    query spans all shards: embedding search merges the per-shard top-k by cosine score, while BM25 and
+    hybrid search score every shard's rows together, as a single bank would (see _retrieve_all_shards).
+    An existing unsharded bank at `storage_path` is split into shards the first time it is opened.
+    """
+    MANIFEST_VERSION = 1
+
+    def __init__(self, storage_path: str = "data/reasoning_bank.json", embedding_path: str = "data/reasoning_bank_embeddings.json", **bank_kwargs):
+        self.storage_path = storage_path
+        self.embedding_path = embedding_path
+        self.shard_dir = f"{os.path.splitext(storage_path)[0]}.shards"
+        self.manifest_path = os.path.join(self.shard_dir, "manifest.json")
+        # Marks that an unsharded bank at storage_path has been fully split
+        self.split_marker_path = os.path.join(self.shard_dir, "split.done")
+        # Passed through to every shard's ReasoningBank
+        self.bank_kwargs = bank_kwargs
+        self.shards: Dict[str, str] = {}
+        self._manifest_signature = None
+        self._banks: Dict[str, ReasoningBank] = {}
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self._load_manifest()
+        # An unsharded bank may exist as a snapshot, a journal (no snapshot yet), or both
+        unsharded_files = (storage_path, f"{os.path.splitext(storage_path)[0]}.journal.jsonl")
+        if any(os.path.exists(path) for path in unsharded_files) and not os.path.exists(self.split_marker_path):
+            self._split_unsharded()
+
+    def _load_manifest(self):
+        """(Re)read the manifest if it changed on disk (another process may have added a shard)."""
+        try:
+            st = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return
+        signature = (st.st_mtime_ns, st.st_size)
+        if signature == self._manifest_signature:
+            return
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except json.JSONDecodeError:
+            logger.warning(f"Failed to decode {self.manifest_path}. Keeping the known shards.")
+            return
+        self.shards = manifest.get("shards", {})
+        self._manifest_signature = signature
+
+    @staticmethod
+    def _shard_stem(domain: str) -> str:
+        """Filesystem-safe, collision-free file stem for a domain."""
+        safe = re.sub(r'[^A-Za-z0-9_.-]+', '_', domain)[:64] or "_"
+        return f"{safe}-{hashlib.md5(domain.encode('utf-8')).hexdigest()[:8]}"
+
+    def _register_shard(self, domain: str):
+        """Add a domain to the manifest (read-modify-write under an exclusive lock)."""
+        with open(f"{self.manifest_path}.lock", 'a') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                self._manifest_signature = None
+                self._load_manifest()
+                if domain in self.shards:
+                    return
+                self.shards[domain] = self._shard_stem(domain)
+                tmp_path = f"{self.manifest_path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"version": self.MANIFEST_VERSION, "shards": self.shards}, f, indent=2, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.manifest_path)
+                self._manifest_signature = None
+                self._load_manifest()
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _shard(self, domain: str, create: bool = False) -> ReasoningBank:
+        """The (resident) bank for `domain`, or None if there is no such shard and `create` is False."""
+        if domain not in self.shards:
+            self._load_manifest()
+            if domain not in self.shards:
+                if not create:
+                    return None
+                self._register_shard(domain)
+        bank = self._banks.get(domain)
+        if bank is None or bank.is_stale():
+            stem = os.path.join(self.shard_dir, self.shards[domain])
+            bank = ReasoningBank(storage_path=f"{stem}.json", embedding_path=f"{stem}_embeddings.json", **self.bank_kwargs)
+            self._banks[domain] = bank
+        return bank
+
+    def _split_unsharded(self):
+        """
+        One-time migration of a monolithic bank into per-domain shards (the original files are left in place).
+        Resumable: entries already present in a shard are skipped.
+        """
+        # Capacity applies per shard; the source bank must not evict anything before it is split
+        source_kwargs = {k: v for k, v in self.bank_kwargs.items() if k != "capacity"}
+        bank = ReasoningBank(storage_path=self.storage_path, embedding_path=self.embedding_path, **source_kwargs)
+        by_domain: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in bank.memories:
+            by_domain.setdefault(entry.get("domain") or "", []).append(entry)
+        for domain, entries in by_domain.items():
+            shard = self._shard(domain, create=True)
+            present = {m.get("id") for m in shard.memories}
+            entries = [entry for entry in entries if entry["id"] not in present]
+            if not entries:
+                continue
+            embeddings = []
+            for entry in entries:
+                vec = bank.embedding_store.get(entry["id"])
+                embeddings.append(vec.tolist() if vec is not None else [])
+            shard._commit_entries(entries, embeddings)
+            shard.save_bank()
+        with open(self.split_marker_path, 'w') as f:
+            f.write(f"{self.storage_path}\n")
+        logger.info(f"Split {len(bank.memories)} memories from {self.storage_path} into {len(by_domain)} domain shards.")
+
+    @property
+    def memories(self) -> List[Dict[str, Any]]:
+        """All (non-evicted) memories across shards (loads every shard)."""
+        self._load_manifest()
+        return [entry for domain in self.shards for entry in self._shard(domain).live_memories()]
+
+    def is_stale(self) -> bool:
+        """Shards and the manifest are refreshed on access, so a resident instance never needs reloading."""
+        return False
+
+    def save_bank(self):
+        for bank in self._banks.values():
+            bank.save_bank()
+
+    def compact(self):
+        self.save_bank()
+
+    def consolidate(self, threshold: float = 0.95, dry_run: bool = False) -> Dict[str, Any]:
+        """Consolidate every shard (see ReasoningBank.consolidate) and report the combined shrinkage."""
+        self._load_manifest()
+        before = after = 0
+        for domain in sorted(self.shards):
+            report = self._shard(domain).consolidate(threshold=threshold, dry_run=dry_run)
+            before += report["before"]
+            after += report["after"]
+        return shrink_report(before, after)
+
+    def add_memory(self, task_query: str, trajectory_summary: str, memory_items: List[Dict[str, str]], score: float, outcome: str, domain: str = ""):
+        self._shard(domain, create=True).add_memory(task_query, trajectory_summary, memory_items, score, outcome, domain=domain)
+
+    def add_memory_item(self, task_query: str, memory_item: Dict[str, str], outcome: str, domain: str = "", context: str = ""):
+        self._shard(domain, create=True).add_memory_item(task_query, memory_item, outcome, domain=domain, context=context)
+
+    def add_memory_items(self, task_query: str, memory_items: List[Dict[str, str]], outcome: str, domain: str = "", context: str = ""):
+        self._shard(domain, create=True).add_memory_items(task_query, memory_items, outcome, domain=domain, context=context)
+
+    def query_cache_stats(self) -> Dict[str, Any]:
+        """Retrieval cache counters summed over the loaded shards."""
+        totals = Counter()
+        for bank in self._banks.values():
+            totals.update({k: v for k, v in bank.query_cache_stats().items() if k != "hit_rate"})
+        lookups = totals["hits"] + totals["misses"]
+        return {**totals, "hit_rate": totals["hits"] / lookups if lookups else 0.0} if totals else {}
+
+    def retrieve(self, query: str, top_k: int = 3, domain: str = None, retrieve_type: str = "embedding") -> List[Dict[str, Any]]:
+        """Same contract as ReasoningBank.retrieve."""
+        scored = self.retrieve_scored(query, top_k=top_k, domain=domain, retrieve_type=retrieve_type)
+        return ReasoningBank._format_items(entry for _, entry in scored)[:top_k]
+
+    def retrieve_scored(self, query: str, top_k: int = 3, domain: str = None, retrieve_type: str = "embedding") -> List[Tuple[float, Dict[str, Any]]]:
+        if top_k <= 0:
+            return []
+        if domain:
+            shard = self._shard(domain)
+            if shard is not None and shard.memories:
+                return shard.retrieve_scored(query, top_k=top_k, domain=domain, retrieve_type=retrieve_type)
+
+        # All domains (or an unknown one)
+        self._load_manifest()
+        if retrieve_type in ("bm25", "hybrid"):
+            return self._retrieve_all_shards(query, top_k, retrieve_type)
+        # Cosine scores are comparable across shards, so merge each shard's top-k.
+        # The query embedding is computed once; later shards hit the embedding cache.
+        merged = []
+        for shard_domain in sorted(self.shards):
+            merged.extend(self._shard(shard_domain).retrieve_scored(query, top_k=top_k, retrieve_type=retrieve_type))
+        merged.sort(key=lambda x: x[0], reverse=True)
+        return merged[:top_k]
+
+    def _retrieve_all_shards(self, query: str, top_k: int, retrieve_type: str) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+        BM25 or hybrid search over every shard. Per-shard scores are not comparable (BM25 statistics and
+        fusion ranks are per shard), so all rows are scored together: BM25 with the summed corpus
+        statistics of the shards, then one fusion over the combined candidates.
+        """
+        banks = [bank for bank in (self._shard(d) for d in sorted(self.shards)) if bank.memories]
+        tokens = tokenize(query)
+        size = total_len = 0
+        df = Counter()
+        for bank in banks:
+            bank_size, bank_len, bank_df = bank._get_bm25_index().corpus_stats(tokens)
+            size, total_len = size + bank_size, total_len + bank_len
+            df.update(bank_df)
+        query_embedding = get_embedding(query) if retrieve_type == "hybrid" else None
+
+        owners, sparse, dense = [], [], []
+        for bank in banks:
+            mask = bank._candidate_mask()
+            rows = np.flatnonzero(mask)
+            owners.extend((bank, int(row)) for row in rows)
+            sparse.append(bank._bm25_scores(query, None, rows, stats=(size, total_len, df)))
+            if retrieve_type == "hybrid":
+                dense.append(bank._dense_scores(query_embedding, mask, rows))
+        if not owners:
+            return []
+        scores = np.concatenate(sparse)
+        if retrieve_type == "hybrid":
+            scores = fuse_scores(np.concatenate(dense), scores, method=banks[0].hybrid_fusion, dense_weight=banks[0].hybrid_dense_weight)
+
+        top, top_scores = ReasoningBank._top_rows(scores, np.arange(len(owners)), top_k)
+        results = []
+        for i, score in zip(top, top_scores):
+            bank, row = owners[i]
+            bank._record_hits([row])
+            results.append((float(score), bank.memories[row]))
+        return results
+
+
+# Process-wide registry of loaded banks, keyed by (storage_path, embedding_path, sharded, bank options)
+_BANK_REGISTRY: Dict[tuple, ReasoningBank] = {}
+
+
+def get_reasoning_bank(storage_path: str, embedding_path: str, sharded: bool = False, **bank_kwargs) -> ReasoningBank:
+    """
+    Return the resident ReasoningBank for these files, loading it on first use.
+    The cached instance is reloaded if another process changed the files since it last read or wrote them.
+    With `sharded=True` the bank is a ShardedReasoningBank (one shard per domain).
+    `bank_kwargs` are ReasoningBank options (capacity, index_type, dedup_threshold, ...; per shard when
+    sharded); banks opened with different options are separate instances.
+    """
+    options = json.dumps(bank_kwargs, sort_keys=True)
+    key = (os.path.abspath(storage_path), os.path.abspath(embedding_path), sharded, options)
+    bank = _BANK_REGISTRY.get(key)
+    if bank is None or bank.is_stale():
+        if bank is not None:
+            logger.info(f"Reasoning Bank {storage_path} changed on disk. Reloading.")
+        bank_cls = ShardedReasoningBank if sharded else ReasoningBank
+        bank = bank_cls(storage_path=storage_path, embedding_path=embedding_path, **bank_kwargs)
+        _BANK_REGISTRY[key] = bank
+    return bank
 
-            if len(top_items) >= top_k:
-                break
 
-        return top_items[:top_k]
\ No newline at end of file
+def query_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Retrieval cache counters of every resident bank, by storage path."""
+    return {key[0]: bank.query_cache_stats() for key, bank in _BANK_REGISTRY.items()}
@@ -0,0 +1,85 @@
+import threading
+from bisect import bisect_right
+from itertools import accumulate
+
+from utils.tokenization import TokenizationService, get_tokenization_service
+
+# Chat formatting overhead per message / per `name` field, by model
+CHAT_FORMAT = {
+    **{
+        model: (3, 1)
+        for model in [
+            "GPT-3-5-turbo-chat",
+            "GPT-3-5-16k-turbo-chat",
+            "gpt-3.5-16k-turbo-chat",
+            "gpt-3.5-turbo-0613",
+            "gpt-3.5-turbo-16k-0613",
+            "gpt-3.5-turbo-1106",
+            "gpt-4-0314",
+            "gpt-4-32k-0314",
+            "gpt-4-0613",
+            "gpt-4-32k-0613",
+            "gpt-4o",
+            "gpt-5-mini",
+        ]
+    },
+    # every message follows <|start|>{role/name}\n{content}<|end|>\n; if there's a name, the role is omitted
+    "gpt-3.5-turbo-0301": (4, -1),
+}
+REPLY_PRIMING_TOKENS = 3  # every reply is primed with <|start|>assistant<|message|>
+
+
+class TokenCounter:
+    """
+    Token counts of chat messages for one model, as in the OpenAI cookbook recipe.
+    The count of a message list is the sum of its per-message counts (plus the reply priming),
+    so each string is counted once by the shared tokenization service; prompts that share
+    messages across steps and exemplars only pay for the new ones.
+    """
+
+    def __init__(self, model: str, encoding=None):
+        if model not in CHAT_FORMAT:
+            raise NotImplementedError(
+                f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
+            )
+        self.model = model
+        self.tokens_per_message, self.tokens_per_name = CHAT_FORMAT[model]
+        if encoding is not None:
+            self.tokens = TokenizationService(encoding)
+        else:
+            self.tokens = get_tokenization_service(model, default="cl100k_base")
+
+    def messages_tokens(self, messages: list[dict]) -> int:
+        """Tokens of `messages` as prompt content, without the reply priming."""
+        num_tokens = self.tokens_per_message * len(messages)
+        num_tokens += sum(self.tokens.count_many([value for m in messages for value in m.values()]))
+        num_tokens += self.tokens_per_name * sum("name" in m for m in messages)
+        return num_tokens
+
+    def count(self, messages: list[dict]) -> int:
+        """Prompt tokens of a request with these messages (same as num_tokens_from_messages)."""
+        return self.messages_tokens(messages) + REPLY_PRIMING_TOKENS
+
+    def prefix_tokens(self, groups: list[list[dict]]) -> list[int]:
+        """Cumulative tokens of the leading groups (e.g. exemplars): entry i covers groups[:i + 1]."""
+        return list(accumulate(self.messages_tokens(group) for group in groups))
+
+    @staticmethod
+    def fit(prefix_tokens: list[int], budget: int) -> int:
+        """
+        Number of leading groups that fit in `budget` tokens when added one at a time, stopping at
+        the first that does not fit (counts are non-negative, so the prefix sums are sorted).
+        """
+        return bisect_right(prefix_tokens, budget)
+
+
+_COUNTERS = {}
+_COUNTERS_LOCK = threading.Lock()
+
+
+def get_token_counter(model: str) -> TokenCounter:
+    """Process-wide TokenCounter for `model`, shared so memoized counts carry across samples."""
+    with _COUNTERS_LOCK:
+        if model not in _COUNTERS:
+            _COUNTERS[model] = TokenCounter(model)
+        return _COUNTERS[model]
@@ -124,6 +124,12 @@ does not support vision. Disabling use_screenshot."""
                  # heuristic for embedding path
                  base, ext = os.path.splitext(self.flags.reasoning_bank_path)
                  kwargs["embedding_path"] = f"{base}_embeddings{ext}"
+            # With a capacity, retrievals are logged as hits that protect items from eviction
+            kwargs["capacity"] = self.flags.memory_capacity
+            kwargs["backend"] = self.flags.bank_backend
+            for option in ("dedup_threshold", "index_type", "ann_nprobe", "ann_min_size", "hybrid_fusion", "hybrid_dense_weight"):
+                if getattr(self.flags, option) is not None:
+                    kwargs[option] = getattr(self.flags, option)
 
             self.reasoning_bank = ReasoningBank(**kwargs)
 
@@ -57,6 +57,15 @@ class Flags:
     enable_reasoning_bank: bool = False
     reasoning_bank_path: str = None
     retrieve_type: str = "embedding"
+    memory_capacity: int = None
+    # Other ReasoningBank options (None = the bank's default)
+    dedup_threshold: float = None
+    bank_backend: str = None
+    index_type: str = None
+    ann_nprobe: int = None
+    ann_min_size: int = None
+    hybrid_fusion: str = None
+    hybrid_dense_weight: float = None
 
     def copy(self):
         return deepcopy(self)
@@ -221,7 +230,7 @@ def fit_tokens(
         dedent(
             f"""\
             After {max_iterations} shrink iterations, the prompt is still
-            {count_tokens(prompt_str)} tokens (greater than {max_prompt_tokens}). Returning the prompt as is."""
+            {count_tokens(prompt_str, model=model_name)} tokens (greater than {max_prompt_tokens}). Returning the prompt as is."""
         )
     )
     return prompt
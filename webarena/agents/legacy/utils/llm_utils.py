@@ -8,7 +8,6 @@ import logging
 
 from functools import cache
 import numpy as np
-import tiktoken
 import yaml
 from langchain_openai import ChatOpenAI
 
@@ -22,6 +21,14 @@ import base64
 from PIL import Image
 from openai import RateLimitError
 
+try:
+    from utils.tokenization import TokenizationService, get_encoding, get_tokenization_service
+except ImportError:
+    import sys
+    import os
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../")))
+    from utils.tokenization import TokenizationService, get_encoding, get_tokenization_service
+
 
 def _extract_wait_time(error_message, min_retry_wait_time=60):
     """Extract the wait time from an OpenAI RateLimitError message."""
@@ -164,25 +171,33 @@ def retry_parallel(chat: ChatOpenAI, messages, n_retry, parser):
 
 def truncate_tokens(text, max_tokens=8000, start=0, model_name="gpt-4"):
     """Use tiktoken to truncate a text to a maximum number of tokens."""
-    enc = tiktoken.encoding_for_model(model_name)
-    tokens = enc.encode(text)
-    if len(tokens) - start > max_tokens:
-        return enc.decode(tokens[start : (start + max_tokens)])
-    else:
+    # Texts that fit are returned from their memoized count, without encoding them
+    if get_tokenization_service(model_name).count(text) - start <= max_tokens:
         return text
+    enc = get_encoding(model_name)
+    tokens = enc.encode(text)
+    return enc.decode(tokens[start : (start + max_tokens)])
 
 
 @cache
 def get_tokenizer(model_name="openai/gpt-4"):
     if model_name.startswith("openai"):
-        return tiktoken.encoding_for_model(model_name.split("/")[-1])
+        return get_encoding(model_name.split("/")[-1])
     else:
         return AutoTokenizer.from_pretrained(model_name)
 
 
+@cache
+def get_token_service(model_name="openai/gpt-4"):
+    """Memoized token counts for get_tokenizer(model_name); OpenAI models share the service of their encoding."""
+    if model_name.startswith("openai"):
+        return get_tokenization_service(model_name.split("/")[-1])
+    else:
+        return TokenizationService(get_tokenizer(model_name))
+
+
 def count_tokens(text, model="openai/gpt-4"):
-    enc = get_tokenizer(model)
-    return len(enc.encode(text))
+    return get_token_service(model).count(text)
 
 
 def count_messages_token(messages, model="openai/gpt-4"):
@@ -196,13 +211,13 @@ def count_messages_token(messages, model="openai/gpt-4"):
     Returns:
         int: the number of tokens.
     """
-    token_count = 0
+    texts = []
     for message in messages:
         if hasattr(message, "content"):
             message = message.content
 
         if isinstance(message, str):
-            token_count += count_tokens(message, model)
+            texts.append(message)
         # handles messages with image content
         elif isinstance(message, (list, tuple)):
             for part in message:
@@ -211,12 +226,13 @@ def count_messages_token(messages, model="openai/gpt-4"):
                         f"The message is expected to be a list of dicts, but got list of {type(message)}"
                     )
                 if part["type"] == "text":
-                    token_count += count_tokens(part["text"], model)
+                    texts.append(part["text"])
         else:
             raise ValueError(
                 f"The message is expected to be a string or a list of dicts, but got {type(message)}"
             )
-    return token_count
+    # One batch for all texts not counted before
+    return sum(get_token_service(model).count_many(texts))
 
 
 def json_parser(message):
@@ -0,0 +1,25 @@
+"""Merge near-duplicate memories in a Reasoning Bank and report how much it shrank."""
+
+import os
+import json
+import argparse
+from utils.reasoning_bank import ReasoningBank
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reasoning_bank_path", type=str, default="reasoning_bank.json",
+                        help="Path to Reasoning Bank storage file.")
+    parser.add_argument("--threshold", type=float, default=0.95,
+                        help="Cosine similarity at or above which items (same domain and score) are merged.")
+    parser.add_argument("--dry_run", action="store_true",
+                        help="Only report what would be merged.")
+    args = parser.parse_args()
+
+    base, ext = os.path.splitext(args.reasoning_bank_path)
+    bank = ReasoningBank(storage_path=args.reasoning_bank_path, embedding_path=f"{base}_embeddings{ext}")
+    report = bank.consolidate(threshold=args.threshold, dry_run=args.dry_run)
+
+    print(json.dumps(report, indent=2))
+    print(f"{'Would remove' if args.dry_run else 'Removed'} {report['removed']} of {report['before']} memories "
+          f"({100 * report['shrink_ratio']:.1f}%).")
@@ -12,8 +12,23 @@ def _log_timeout_task(tid):
     with open("./timeout_tasks.jsonl", "a") as f:
         f.write(json.dumps({"task_id": tid}) + "\n")
 
-def run_task(tid, reasoning_bank_path, website, retrieve_type):
-    """Run a single task: inference + evaluation with reasoning bank"""
+# Reasoning Bank options forwarded (when set) to run.py and to the bank update step
+BANK_OPTIONS = ["memory_capacity", "dedup_threshold", "bank_backend", "index_type", "ann_nprobe",
+                "ann_min_size", "hybrid_fusion", "hybrid_dense_weight"]
+
+
+def bank_cli_args(args) -> list:
+    """Command-line flags for the Reasoning Bank options given to this script."""
+    cli_args = []
+    for option in BANK_OPTIONS:
+        value = getattr(args, option)
+        if value is not None:
+            cli_args.extend([f"--{option}", str(value)])
+    return cli_args
+
+
+def run_task(tid, reasoning_bank_path, website, retrieve_type, bank_args=()):
+    """Run a single task: inference + evaluation with reasoning bank (bank_args: see bank_cli_args)"""
     TASK_TIMEOUT = 1000  # 16 minutes
     start_time = time.time()
 
@@ -30,6 +45,8 @@ def run_task(tid, reasoning_bank_path, website, retrieve_type):
     if retrieve_type:
         cmd.extend(["--retrieve_type", retrieve_type])
 
+    cmd.extend(bank_args)
+
     # Using start_new_session=True to create a new process group
     # This allows us to kill the process and all its children.
     process = Popen(cmd, start_new_session=True)
@@ -83,6 +100,7 @@ def run_task(tid, reasoning_bank_path, website, retrieve_type):
             "--result_dir", f"results/webarena.{tid}",
             "--reasoning_bank_path", reasoning_bank_path
         ]
+        cmd.extend(bank_args)
         process = Popen(cmd, start_new_session=True)
         
         try:
@@ -136,7 +154,7 @@ def main():
         # Run tasks in parallel
         print(f"Running {len(task_ids)} tasks with parallelism={args.parallel} and reasoning_bank={args.reasoning_bank_path}")
         with ProcessPoolExecutor(max_workers=args.parallel) as executor:
-            futures = {executor.submit(run_task, tid, args.reasoning_bank_path, args.website, args.retrieve_type): tid for tid in task_ids}
+            futures = {executor.submit(run_task, tid, args.reasoning_bank_path, args.website, args.retrieve_type, bank_cli_args(args)): tid for tid in task_ids}
             for future in as_completed(futures):
                 tid = futures[future]
                 try:
@@ -150,7 +168,7 @@ def main():
     else:
         # Run tasks sequentially (original behavior)
         for tid in task_ids:
-            run_task(tid, args.reasoning_bank_path, args.website, args.retrieve_type)
+            run_task(tid, args.reasoning_bank_path, args.website, args.retrieve_type, bank_cli_args(args))
             calculate_total_cost()
 
 
@@ -163,8 +181,21 @@ if __name__ == "__main__":
     parser.add_argument("--reasoning_bank_path", type=str, default="data/reasoning_bank.json",
                         help="Path to Reasoning Bank JSON file")
     parser.add_argument("--parallel", type=int, default=1, help="Number of parallel tasks to run (default: 1)")
-    parser.add_argument("--retrieve_type", type=str, default="embedding", choices=["embedding", "bm25"],
+    parser.add_argument("--retrieve_type", type=str, default="embedding", choices=["embedding", "bm25", "ann", "hybrid"],
                         help="Type of retrieval method for reasoning bank")
+    parser.add_argument("--memory_capacity", type=int, default=None,
+                        help="Maximum number of items in the Reasoning Bank (default: unbounded); the lowest-utility items are evicted to an archive file")
+    parser.add_argument("--dedup_threshold", type=float, default=None,
+                        help="Skip new memory items at least this similar to a stored item with the same domain and score (default: off)")
+    parser.add_argument("--bank_backend", type=str, default=None, choices=["json", "sqlite"],
+                        help="Reasoning Bank storage backend (default: from the --reasoning_bank_path extension)")
+    parser.add_argument("--index_type", type=str, default=None, choices=["exact", "ivf"],
+                        help="Embedding search: exact scan or IVF approximate index (default: exact)")
+    parser.add_argument("--ann_nprobe", type=int, default=None, help="IVF lists probed per query")
+    parser.add_argument("--ann_min_size", type=int, default=None, help="Banks smaller than this are always searched exactly")
+    parser.add_argument("--hybrid_fusion", type=str, default=None, choices=["rrf", "zscore"],
+                        help="How retrieve_type=hybrid fuses embedding and BM25 scores (default: rrf)")
+    parser.add_argument("--hybrid_dense_weight", type=float, default=None, help="Weight of the embedding score in z-score fusion")
     args = parser.parse_args()
 
     main()
@@ -158,7 +158,7 @@ if __name__ == "__main__":
                         help="List of task IDs to run")
     parser.add_argument("--reasoning_bank_path", type=str, default="data/reasoning_bank.json",
                         help="Path to Reasoning Bank JSON file")
-    parser.add_argument("--retrieve_type", type=str, default="bm25", choices=["embedding", "bm25"],
+    parser.add_argument("--retrieve_type", type=str, default="bm25", choices=["embedding", "bm25", "ann", "hybrid"],
                         help="Type of retrieval method for reasoning bank")
     args = parser.parse_args()
 
@@ -125,9 +125,60 @@ def parse_args():
         "--retrieve_type",
         type=str,
         default="embedding",
-        choices=["embedding", "bm25"],
+        choices=["embedding", "bm25", "ann", "hybrid"],
         help="Type of retrieval method for reasoning bank"
     )
+    parser.add_argument(
+        "--memory_capacity",
+        type=int,
+        default=None,
+        help="Maximum number of items in the Reasoning Bank; the lowest-utility items are evicted to an archive file.",
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        type=float,
+        default=None,
+        help="Skip new memory items at least this similar to a stored item with the same domain and score (default: off).",
+    )
+    parser.add_argument(
+        "--bank_backend",
+        type=str,
+        default=None,
+        choices=["json", "sqlite"],
+        help="Reasoning Bank storage backend (default: from the --reasoning_bank_path extension).",
+    )
+    parser.add_argument(
+        "--index_type",
+        type=str,
+        default=None,
+        choices=["exact", "ivf"],
+        help="Embedding search: exact scan or IVF approximate index (default: exact).",
+    )
+    parser.add_argument(
+        "--ann_nprobe",
+        type=int,
+        default=None,
+        help="IVF lists probed per query.",
+    )
+    parser.add_argument(
+        "--ann_min_size",
+        type=int,
+        default=None,
+        help="Banks smaller than this are always searched exactly.",
+    )
+    parser.add_argument(
+        "--hybrid_fusion",
+        type=str,
+        default=None,
+        choices=["rrf", "zscore"],
+        help="How retrieve_type=hybrid fuses embedding and BM25 scores (default: rrf).",
+    )
+    parser.add_argument(
+        "--hybrid_dense_weight",
+        type=float,
+        default=None,
+        help="Weight of the embedding score in z-score fusion.",
+    )
 
     return parser.parse_args()
 
@@ -188,6 +239,14 @@ WARNING this demo agent will soon be moved elsewhere. Expect it to be removed at
                 enable_reasoning_bank=args.enable_reasoning_bank,
                 reasoning_bank_path=args.reasoning_bank_path,
                 retrieve_type=args.retrieve_type,
+                memory_capacity=args.memory_capacity,
+                dedup_threshold=args.dedup_threshold,
+                bank_backend=args.bank_backend,
+                index_type=args.index_type,
+                ann_nprobe=args.ann_nprobe,
+                ann_min_size=args.ann_min_size,
+                hybrid_fusion=args.hybrid_fusion,
+                hybrid_dense_weight=args.hybrid_dense_weight,
             ),
         ),
     )
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Tests for the reasoning bank storage backends (JSON files + binary embedding store, and SQLite).
+No API key or network is needed.
+"""
+import sys
+import os
+import json
+import tempfile
+sys.path.insert(0, os.path.dirname(__file__))
+
+import numpy as np
+from utils.bank_storage import JSONBankStorage, SQLiteBankStorage, make_bank_storage
+
+
+def make_entries(n, start=0):
+    return [{"id": f"item-{i}", "domain": ["shopping", "gitlab"][i % 2], "title": f"strategy {i}", "score": 1.0}
+            for i in range(start, start + n)]
+
+
+def make_embeddings(n, start=0):
+    return [[float(i), 1.0, float(i % 3)] for i in range(start, start + n)]
+
+
+def snapshot(storage):
+    """Content and vectors as loaded by `storage`, keyed by id."""
+    memories = storage.load()
+    return memories, {m["id"]: storage.embedding_store.get(m["id"]).tolist() for m in memories}
+
+
+def test_sqlite_round_trip():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bank.sqlite")
+        storage = SQLiteBankStorage(path)
+        storage.append(make_entries(3), make_embeddings(3))
+        storage.append(make_entries(2, start=3), make_embeddings(2, start=3))
+        storage.rewrite({"item-1"}, {"item-2": {**make_entries(1, start=2)[0], "title": "edited"}})
+        expected = snapshot(storage)
+        assert [m["id"] for m in expected[0]] == ["item-0", "item-2", "item-3", "item-4"]
+        assert expected[0][1]["title"] == "edited"
+        assert expected[1]["item-4"] == make_embeddings(1, start=4)[0]
+
+        reopened = SQLiteBankStorage(path)
+        assert snapshot(reopened) == expected
+
+
+def test_sqlite_sees_appends_from_other_connections():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bank.sqlite")
+        reader, writer = SQLiteBankStorage(path), SQLiteBankStorage(path)
+        writer.append(make_entries(2), make_embeddings(2))
+        assert [m["id"] for m in reader.load()] == ["item-0", "item-1"]
+        writer.append(make_entries(1, start=2), make_embeddings(1, start=2))
+        assert [m["id"] for m in reader.load()] == ["item-0", "item-1", "item-2"]
+        assert reader.embedding_store.get("item-2").tolist() == make_embeddings(1, start=2)[0]
+
+
+def test_sqlite_imports_json_bank_once():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path = os.path.join(tmp, "bank.json")
+        embedding_path = os.path.join(tmp, "bank_embeddings.json")
+        JSONBankStorage(storage_path, embedding_path).append(make_entries(3), make_embeddings(3))
+        expected = snapshot(JSONBankStorage(storage_path, embedding_path))
+
+        storage = make_bank_storage(storage_path, embedding_path, backend="sqlite")
+        assert isinstance(storage, SQLiteBankStorage) and storage.storage_path == os.path.join(tmp, "bank.sqlite")
+        assert snapshot(storage) == expected
+
+        # Later opens neither import again nor bring removed rows back
+        storage.rewrite({"item-0"}, {})
+        reopened = make_bank_storage(storage_path, embedding_path, backend="sqlite")
+        assert [m["id"] for m in reopened.load()] == ["item-1", "item-2"]
+
+
+def test_sqlite_imports_legacy_embedding_map():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "bank.json"), 'w') as f:
+            json.dump(make_entries(2), f)
+        embedding_path = os.path.join(tmp, "bank_embeddings.json")
+        with open(embedding_path, 'w') as f:
+            json.dump({"item-0": make_embeddings(1)[0]}, f)
+
+        storage = make_bank_storage(os.path.join(tmp, "bank.sqlite"), embedding_path)
+        memories = storage.load()
+        assert [m["id"] for m in memories] == ["item-0", "item-1"]
+        assert storage.embedding_store.get("item-0").tolist() == make_embeddings(1)[0]
+        assert storage.embedding_store.get("item-1") is None
+
+
+def test_json_round_trip():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path = os.path.join(tmp, "bank.json")
+        embedding_path = os.path.join(tmp, "bank_embeddings.json")
+        storage = JSONBankStorage(storage_path, embedding_path)
+        storage.append(make_entries(3), make_embeddings(3))
+        storage.append(make_entries(2, start=3), make_embeddings(2, start=3))
+        expected = snapshot(storage)
+        assert len(expected[0]) == 5 and np.allclose(expected[1]["item-3"], make_embeddings(1, start=3)[0])
+
+        assert snapshot(JSONBankStorage(storage_path, embedding_path)) == expected
+
+
+def test_json_append_syncs_vectors_before_content():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = JSONBankStorage(os.path.join(tmp, "bank.json"), os.path.join(tmp, "bank_embeddings.json"))
+        storage.append(make_entries(1), make_embeddings(1))  # creates the files
+        synced = []
+        original_fsync = os.fsync
+        os.fsync = lambda fd: synced.append(os.readlink(f"/proc/self/fd/{fd}")) or original_fsync(fd)
+        try:
+            storage.append(make_entries(2, start=1), make_embeddings(2, start=1))
+        finally:
+            os.fsync = original_fsync
+        # An id line (or content entry) never refers to a vector that is not on disk yet
+        store = storage.embedding_store
+        assert [os.path.basename(path) for path in synced] == [os.path.basename(store.vec_path), os.path.basename(store.ids_path), "bank.json"]
+        assert snapshot(JSONBankStorage(storage.storage_path, store.legacy_json_path))[1]["item-2"] == make_embeddings(1, start=2)[0]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✓ {name}")
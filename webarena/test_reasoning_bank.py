@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Tests for the reasoning bank's write path and retrieval.
+Embeddings come from a local bag-of-words fake, so no API key or network is needed.
+"""
+import sys
+import os
+import json
+import tempfile
+import zlib
+sys.path.insert(0, os.path.dirname(__file__))
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
+
+import numpy as np
+from utils import reasoning_bank
+from utils.reasoning_bank import BM25Index, ReasoningBank
+
+
+def fake_embedding(text):
+    """Hashed bag of words, so texts sharing words are similar."""
+    vec = np.zeros(32)
+    for word in text.lower().split():
+        vec[zlib.crc32(word.encode()) % 32] += 1.0
+    return vec.tolist()
+
+
+reasoning_bank.get_embedding = fake_embedding
+reasoning_bank.get_embeddings = lambda texts: [fake_embedding(t) for t in texts]
+
+
+def make_items(n, topic):
+    return [{"title": f"{topic} strategy {i}", "description": f"how to {topic} step {i}",
+             "content": f"to {topic} use the {['search box', 'cart button', 'price filter', 'login form'][i % 4]} first"}
+            for i in range(n)]
+
+
+def paths(tmp, name="bank"):
+    return os.path.join(tmp, f"{name}.json"), os.path.join(tmp, f"{name}_embeddings.json")
+
+
+def test_eviction_archives_lowest_utility_items():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = ReasoningBank(storage_path, embedding_path, capacity=5, query_cache_size=0)
+        bank.add_memory("buy a shirt", "", make_items(4, "add to cart"), 0.0, domain="shopping")
+        bank.add_memory("search flights to paris", "", make_items(3, "search flights"), 1.0, domain="travel")
+        failures = [m["id"] for m in bank.memories if m["score"] == 0.0]
+        successes = [m["id"] for m in bank.memories if m["score"] == 1.0]
+        # Failures score lowest and the oldest of them go first
+        assert len(failures) == 2 and len(successes) == 3
+
+        # A retrieval hit (possibly by another process) raises an item's utility above its peers
+        reader = ReasoningBank(storage_path, embedding_path, capacity=5, query_cache_size=0)
+        assert reader.retrieve("price filter", top_k=1, domain="shopping", retrieve_type="bm25")[0]["title"] == "add to cart strategy 2"
+        hit = next(m["id"] for m in reader.memories if m["title"] == "add to cart strategy 2")
+        bank.add_memory("sign in", "", make_items(1, "sign in"), 1.0, domain="account")
+        live = [m["id"] for m in ReasoningBank(storage_path, embedding_path).memories]
+        assert len(live) == 5 and hit in live and failures[1] not in live
+
+        with open(bank.archive_path, encoding='utf-8') as f:
+            archived = [json.loads(line)["entry"]["title"] for line in f]
+        assert archived == ["add to cart strategy 0", "add to cart strategy 1", "add to cart strategy 3"]
+        # The hits log is folded down to the live items on eviction
+        with open(bank.hits_path, encoding='utf-8') as f:
+            assert [(r["id"], r["hits"]) for r in map(json.loads, f)] == [(hit, 1)]
+
+
+def test_concurrent_writers_stay_within_capacity():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        banks = [ReasoningBank(storage_path, embedding_path, capacity=4) for _ in range(2)]
+        for i in range(3):
+            for bank in banks:
+                bank.add_memory(f"task {i}", "", make_items(2, f"topic {i}"), 1.0, domain="shopping")
+        assert len(ReasoningBank(storage_path, embedding_path).memories) == 4
+        with open(banks[0].archive_path, encoding='utf-8') as f:
+            assert len(f.readlines()) == 8
+
+
+def test_hits_are_only_logged_with_a_capacity():
+    with tempfile.TemporaryDirectory() as tmp:
+        bank = ReasoningBank(*paths(tmp))
+        bank.add_memory("buy a shirt", "", make_items(2, "add to cart"), 1.0, domain="shopping")
+        assert bank.retrieve("add to cart") and not os.path.exists(bank.hits_path)
+
+
+def test_bm25_index_is_saved_once_it_lags():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_path, embedding_path = paths(tmp)
+        bank = ReasoningBank(storage_path, embedding_path, query_cache_size=0)
+        bank.add_memory("buy a shirt", "", make_items(8, "add to cart"), 1.0, domain="shopping")
+        saved = []
+        original_save = BM25Index.save
+        BM25Index.save = lambda self, path: saved.append(len(self)) or original_save(self, path)
+        try:
+            bank.retrieve("cart button", retrieve_type="bm25")
+            assert saved == [8]
+            # Writes never save the index; queries save it only once it lacks over a quarter of its rows
+            for i in range(3):
+                bank.add_memory("sign in", "", make_items(1, f"sign in {i}"), 1.0, domain="account")
+                bank.retrieve("cart button", retrieve_type="bm25")
+            assert saved == [8, 11]
+
+            bank.add_memory("sign in", "", make_items(1, "sign in again"), 1.0, domain="account")
+            reopened = ReasoningBank(storage_path, embedding_path, query_cache_size=0)
+            expected = bank.retrieve("sign in again", top_k=3, retrieve_type="bm25")
+            assert reopened.retrieve("sign in again", top_k=3, retrieve_type="bm25") == expected
+            assert saved == [8, 11] and len(reopened._bm25_index) == 12
+        finally:
+            BM25Index.save = original_save
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"✓ {name}")
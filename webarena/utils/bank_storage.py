@@ -0,0 +1,500 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import threading
+import uuid
+import numpy as np
+from typing import List, Dict, Any, Optional
+from utils.embedding_store import EmbeddingStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class WriteMetrics:
+    """Thread-safe counters for committed write batches: batch sizes and latencies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.entries = 0
+        self.max_batch = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, batch_size: int, latency: float):
+        with self._lock:
+            self.commits += 1
+            self.entries += batch_size
+            self.max_batch = max(self.max_batch, batch_size)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "commits": self.commits,
+                "entries": self.entries,
+                "mean_batch_size": self.entries / self.commits if self.commits else 0.0,
+                "max_batch_size": self.max_batch,
+                "mean_latency_ms": 1000 * self.total_latency / self.commits if self.commits else 0.0,
+                "max_latency_ms": 1000 * self.max_latency,
+            }
+
+
+class JSONBankStorage:
+    """
+    Content in a JSON array file guarded by fcntl locks; vectors in the binary EmbeddingStore.
+
+    Loads are incremental. Nothing is read while the file's (inode, mtime, size) is unchanged, and
+    entries appended by other writers are parsed from the tail of the file only. Writers always
+    rewrite the array with `json.dump(indent=2)`, so an append leaves the earlier bytes untouched.
+    Any rewrite that is not a pure append must call bump_generation(), which forces a full reload.
+    """
+    # Bytes before the end of the last entry that must be unchanged for an incremental load
+    TAIL_CHECK = 64
+
+    def __init__(self, storage_path: str, embedding_path: str):
+        self.storage_path = storage_path
+        self.generation_path = f"{storage_path}.generation"
+        self.embedding_store = EmbeddingStore(embedding_path)
+        self.embedding_store.migrate_from_json()
+        self.memories: List[Dict[str, Any]] = []
+        self.metrics = WriteMetrics()
+        self._lock = threading.RLock()
+        self._signature = None
+        self._generation = None
+        self._content_end = 0   # offset just past the last entry (before "\n]")
+        self._tail = b""        # the TAIL_CHECK bytes before _content_end
+        # Incremented whenever self.memories is replaced rather than extended
+        self.epoch = 0
+
+    def _read_generation(self) -> int:
+        try:
+            with open(self.generation_path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump_generation(self):
+        """Signal readers that the content file was rewritten (not just appended to)."""
+        generation = self._read_generation() + 1
+        tmp_path = f"{self.generation_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(str(generation))
+        os.replace(tmp_path, self.generation_path)
+
+    def _remember(self, f, data: bytes):
+        """Record the file state just read or written (call while holding the lock on `f`)."""
+        st = os.fstat(f.fileno())
+        self._signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        self._content_end = max(len(data) - 2, 0) if self.memories else 0
+        self._tail = data[max(self._content_end - self.TAIL_CHECK, 0):self._content_end]
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Load the reasoning bank content and embeddings, reading only what changed since the last load."""
+        with self._lock:
+            return self._load()
+
+    def _load(self) -> List[Dict[str, Any]]:
+        # Ensure directories exist
+        dir_name = os.path.dirname(self.storage_path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name, exist_ok=True)
+
+        # 1. Load Content
+        try:
+            st = os.stat(self.storage_path)
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            signature = None
+        generation = self._read_generation()
+        if signature is None:
+            if self.memories:
+                self.memories, self._signature = [], None
+                self.epoch += 1
+        elif signature != self._signature or generation != self._generation:
+            try:
+                if generation != self._generation or not self._load_appended():
+                    self._load_full()
+                self._generation = generation
+            except json.JSONDecodeError:
+                logger.warning(f"Failed to decode {self.storage_path}. Starting with empty bank.")
+                self.memories, self._signature = [], None
+                self.epoch += 1
+            except Exception as e:
+                logger.error(f"Error reading {self.storage_path}: {e}")
+
+        # 2. Load Embeddings (memory-mapped; only ids appended since the last load are read)
+        try:
+            self.embedding_store.refresh()
+        except Exception as e:
+            logger.error(f"Error reading embedding store {self.embedding_store.vec_path}: {e}")
+
+        return self.memories
+
+    def _load_full(self):
+        with open(self.storage_path, 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_SH) # Shared lock for reading
+            try:
+                data = f.read()
+                self.memories = json.loads(data.decode('utf-8'))
+                self.epoch += 1
+                self._remember(f, data)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_appended(self) -> bool:
+        """Parse only the entries appended after the last load. Returns False if a full reload is needed."""
+        if not self.memories or self._content_end < len(self._tail):
+            return False
+        start = self._content_end - len(self._tail)
+        with open(self.storage_path, 'rb') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                f.seek(start)
+                data = f.read()
+                # The old last entry must be intact and followed by new entries, not the closing bracket
+                tail, rest = data[:len(self._tail)], data[len(self._tail):]
+                if tail != self._tail or not rest.startswith(b",") or not rest.rstrip().endswith(b"]"):
+                    return False
+                appended = json.loads("[" + rest[1:].decode('utf-8'))
+                self.memories.extend(appended)
+                st = os.fstat(f.fileno())
+                self._signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+                self._content_end = start + len(data) - 2
+                self._tail = data[max(len(data) - 2 - self.TAIL_CHECK, 0):len(data) - 2]
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+    def append(self, entries: List[Dict[str, Any]], embeddings: List[List[float]]) -> List[Dict[str, Any]]:
+        """
+        Append entries and their embeddings (if any) in one critical section under the content file's lock.
+
+        Vectors are written and synced first (EmbeddingStore keeps its own order: rows, then ids), and
+        the content fsync then commits the batch. A crash before it leaves only unreferenced vectors.
+        The content file is still read, extended and rewritten whole, so each append is O(N) in the bank size.
+        Returns the entries that were committed.
+        """
+        if not entries:
+            return []
+        start = time.perf_counter()
+        with self._lock:
+            try:
+                # Ensure file exists
+                if not os.path.exists(self.storage_path):
+                    with open(self.storage_path, 'w') as f: json.dump([], f)
+
+                with open(self.storage_path, 'r+b') as f:
+                    # 1. Acquire Lock
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        # 2. Vectors (appended in place and synced before anything refers to them)
+                        try:
+                            self.embedding_store.append([entry["id"] for entry in entries], embeddings)
+                        except Exception as e:
+                            logger.error(f"Failed to save embeddings to {self.embedding_store.vec_path}: {e}")
+
+                        # 3. Read latest data
+                        try:
+                            content_data = json.loads(f.read().decode('utf-8'))
+                        except json.JSONDecodeError:
+                            content_data = []
+
+                        # 4. Modify
+                        content_data.extend(entries)
+
+                        # 5. Write back; this fsync commits the batch
+                        data = json.dumps(content_data, indent=2, ensure_ascii=False).encode('utf-8')
+                        f.seek(0)
+                        f.write(data)
+                        f.truncate()
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                        # Update in-memory state
+                        self.memories = content_data
+                        self.epoch += 1
+                        self._remember(f, data)
+                    finally:
+                        # 6. Release Lock
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+            except Exception as e:
+                logger.error(f"Failed to save content to {self.storage_path}: {e}")
+                return []
+
+        self.metrics.record(len(entries), time.perf_counter() - start)
+        return list(entries)
+
+    def rewrite(self, removed_ids: set, updated: Dict[str, Dict[str, Any]]):
+        """
+        Drop the entries in `removed_ids` and replace those in `updated` (by id), in one locked
+        rewrite that keeps entries appended concurrently. Readers are told to reload fully.
+        """
+        with self._lock:
+            with open(self.storage_path, 'r+b') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    content_data = json.loads(f.read().decode('utf-8'))
+                    content_data = [updated.get(entry.get("id"), entry) for entry in content_data if entry.get("id") not in removed_ids]
+                    data = json.dumps(content_data, indent=2, ensure_ascii=False).encode('utf-8')
+                    f.seek(0)
+                    f.write(data)
+                    f.truncate()
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.bump_generation()
+                    self.memories = content_data
+                    self.epoch += 1
+                    self._generation = self._read_generation()
+                    self._remember(f, data)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SQLiteVectors:
+    """
+    In-memory view of the vectors in a SQLite bank, with the same read interface as EmbeddingStore
+    (ids, dim, vectors, rows, get). Rows are appended in rowid order as the storage loads them.
+    """
+
+    def __init__(self):
+        self.dim = 0
+        self.ids: List[str] = []
+        self._row_of: Dict[str, int] = {}
+        self._buf = np.zeros((0, 0), dtype=np.float32)
+        self.vec_path = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self._row_of
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """(n, dim) float32 matrix; row i belongs to self.ids[i]."""
+        return self._buf[:len(self.ids)]
+
+    def refresh(self):
+        """Vectors are ingested by the owning storage's load()."""
+
+    def clear(self):
+        self.ids = []
+        self._row_of = {}
+        self._buf = np.zeros((0, self.dim), dtype=np.float32)
+
+    def row(self, item_id: str) -> int:
+        return self._row_of.get(item_id, -1)
+
+    def rows(self, item_ids: List[str]) -> np.ndarray:
+        return np.array([self._row_of.get(item_id, -1) for item_id in item_ids], dtype=np.int64)
+
+    def get(self, item_id: str) -> Optional[np.ndarray]:
+        row = self.row(item_id)
+        if row < 0:
+            return None
+        return self._buf[row]
+
+    def add(self, item_ids: List[str], block: np.ndarray):
+        """Append rows; the backing buffer grows geometrically."""
+        if not item_ids:
+            return
+        if self.dim == 0:
+            self.dim = block.shape[1]
+            self._buf = np.zeros((0, self.dim), dtype=np.float32)
+        n, m = len(self.ids), len(item_ids)
+        if n + m > len(self._buf):
+            buf = np.zeros((max(n + m, 2 * len(self._buf), 64), self.dim), dtype=np.float32)
+            buf[:n] = self._buf[:n]
+            self._buf = buf
+        self._buf[n:n + m] = block
+        for offset, item_id in enumerate(item_ids):
+            self._row_of[item_id] = n + offset
+        self.ids.extend(item_ids)
+
+
+class SQLiteBankStorage:
+    """
+    Content rows and float32 vector BLOBs in one SQLite database in WAL mode.
+
+    Readers never block writers (or each other), each append is one short transaction, and
+    load() only fetches rows with a rowid above the last one seen, so reloading is incremental.
+    If `json_path` names an existing JSON bank (content file, with its embedding store at
+    `embedding_path`), it is imported the first time the database is opened (see migrate_from_json).
+    """
+
+    def __init__(self, storage_path: str, embedding_path: str = None, json_path: str = None):
+        self.storage_path = storage_path
+        dir_name = os.path.dirname(storage_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(storage_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS memories ("
+            "rowid INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, "
+            "domain TEXT, data TEXT NOT NULL, vector BLOB)"
+        )
+        # Bumped by rewrite(); tells other readers that rows were deleted or changed, not just appended
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0)")
+        self.embedding_store = SQLiteVectors()
+        self.memories: List[Dict[str, Any]] = []
+        self.metrics = WriteMetrics()
+        self._last_rowid = 0
+        self._generation = None
+        # Incremented whenever self.memories is replaced rather than extended
+        self.epoch = 0
+        if json_path is not None:
+            self.migrate_from_json(json_path, embedding_path)
+
+    def migrate_from_json(self, json_path: str, embedding_path: str = None) -> int:
+        """
+        One-time import of a JSON bank (the content file and its binary embedding store, itself
+        migrated from the legacy JSON map if needed) into an empty database, in one transaction.
+        The JSON files are left in place. Returns the number of imported entries.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-check inside the write transaction in case another process imported first
+                migrated = self._conn.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+                if migrated is not None or self._conn.execute("SELECT 1 FROM memories LIMIT 1").fetchone():
+                    self._conn.execute("COMMIT")
+                    return 0
+                try:
+                    with open(json_path, 'r', encoding='utf-8') as f:
+                        entries = json.load(f)
+                except json.JSONDecodeError:
+                    logger.warning(f"Failed to decode {json_path}. Skipping import into {self.storage_path}.")
+                    self._conn.execute("COMMIT")
+                    return 0
+                store = None
+                if embedding_path:
+                    store = EmbeddingStore(embedding_path)
+                    store.migrate_from_json()
+                params = []
+                for entry in entries:
+                    entry.setdefault("id", str(uuid.uuid4()))
+                    vector = store.get(entry["id"]) if store is not None else None
+                    blob = np.asarray(vector, dtype=np.float32).tobytes() if vector is not None else None
+                    params.append((entry["id"], entry.get("domain"), json.dumps(entry, ensure_ascii=False), blob))
+                self._conn.executemany("INSERT OR IGNORE INTO memories (id, domain, data, vector) VALUES (?, ?, ?, ?)", params)
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('migrated', 1)")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info(f"Imported {len(params)} entries from {json_path} into {self.storage_path}.")
+        return len(params)
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Ingest rows committed since the last load (by this or any other process)."""
+        with self._lock:
+            return self._load()
+
+    def _load(self) -> List[Dict[str, Any]]:
+        try:
+            generation = self._conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+            if generation != self._generation:
+                # Rows were rewritten; start over
+                self.memories = []
+                self.embedding_store.clear()
+                self._last_rowid = 0
+                self._generation = generation
+                self.epoch += 1
+            rows = self._conn.execute(
+                "SELECT rowid, data, vector FROM memories WHERE rowid > ? ORDER BY rowid", (self._last_rowid,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Error reading {self.storage_path}: {e}")
+            return self.memories
+        if not rows:
+            return self.memories
+
+        vec_ids, vec_blobs = [], []
+        for rowid, data, blob in rows:
+            entry = json.loads(data)
+            self.memories.append(entry)
+            if blob:
+                vec_ids.append(entry["id"])
+                vec_blobs.append(blob)
+            self._last_rowid = rowid
+        if vec_blobs:
+            block = np.frombuffer(b"".join(vec_blobs), dtype=np.float32).reshape(len(vec_blobs), -1)
+            self.embedding_store.add(vec_ids, block)
+        return self.memories
+
+    def append(self, entries: List[Dict[str, Any]], embeddings: List[List[float]]) -> List[Dict[str, Any]]:
+        """Append entries (and their embeddings, if any) in one transaction. Returns the entries that were committed."""
+        if not entries:
+            return []
+        start = time.perf_counter()
+        params = []
+        for entry, embedding in zip(entries, embeddings):
+            blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding else None
+            params.append((entry["id"], entry.get("domain"), json.dumps(entry, ensure_ascii=False), blob))
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.executemany("INSERT INTO memories (id, domain, data, vector) VALUES (?, ?, ?, ?)", params)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            logger.error(f"Failed to save content to {self.storage_path}: {e}")
+            return []
+        self.metrics.record(len(entries), time.perf_counter() - start)
+        self.load()
+        return list(entries)
+
+
+    def rewrite(self, removed_ids: set, updated: Dict[str, Dict[str, Any]]):
+        """Delete the rows in `removed_ids` and replace the content of those in `updated` (by id), in one transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("DELETE FROM memories WHERE id = ?", [(i,) for i in removed_ids])
+                self._conn.executemany(
+                    "UPDATE memories SET data = ? WHERE id = ?",
+                    [(json.dumps(entry, ensure_ascii=False), i) for i, entry in updated.items()],
+                )
+                self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._load()
+
+
+SQLITE_EXTENSIONS = (".sqlite", ".sqlite3", ".db")
+
+
+def make_bank_storage(storage_path: str, embedding_path: str, backend: str = None):
+    """
+    Create the storage backend: "json" or "sqlite" (inferred from the file extension if not given).
+    Switching an existing JSON bank to "sqlite" keeps the database beside it (data/bank.json ->
+    data/bank.sqlite) and imports the JSON content and embeddings on first open.
+    """
+    base, ext = os.path.splitext(storage_path)
+    is_sqlite_path = ext in SQLITE_EXTENSIONS
+    if backend is None:
+        backend = "sqlite" if is_sqlite_path else "json"
+    if backend == "sqlite":
+        if is_sqlite_path:
+            return SQLiteBankStorage(storage_path, embedding_path, json_path=f"{base}.json")
+        return SQLiteBankStorage(f"{base}.sqlite", embedding_path, json_path=storage_path)
+    if backend == "json":
+        return JSONBankStorage(storage_path, embedding_path)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,104 @@
+import numpy as np
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+
+
+def _group_codes(groups: Optional[Sequence], n: int) -> np.ndarray:
+    if groups is None:
+        return np.zeros(n, dtype=np.int64)
+    _, codes = np.unique(np.array([repr(g) for g in groups], dtype=object), return_inverse=True)
+    return codes
+
+
+def _unit_rows(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Row-normalized float32 copy of `vectors` and a mask of rows that have a (non-zero) vector."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True) if vectors.size else np.zeros((len(vectors), 1), dtype=np.float32)
+    valid = norms[:, 0] > 0
+    norms[~valid] = 1.0
+    return vectors / norms, valid
+
+
+def greedy_clusters(vectors: np.ndarray, threshold: float, groups: Optional[Sequence] = None, block_size: int = 1024) -> np.ndarray:
+    """
+    Leader clustering by cosine similarity.
+
+    Rows are visited in order; a row joins the most similar existing leader of the same group if
+    that similarity is >= threshold, otherwise it becomes a leader itself. Returns `leader_of`,
+    the leader row of every row (leaders map to themselves). Rows without a vector are always
+    their own leader. Similarities are computed block-wise against the leader matrix.
+    """
+    unit, valid = _unit_rows(vectors)
+    n = len(unit)
+    codes = _group_codes(groups, n)
+    leader_of = np.arange(n)
+    leaders = np.zeros(0, dtype=np.int64)
+
+    for start in range(0, n, block_size):
+        block_rows = np.arange(start, min(start + block_size, n))
+        block = unit[block_rows]
+        # Similarity to the leaders found so far (other groups can never match)
+        if len(leaders):
+            old = block @ unit[leaders].T
+            old[codes[block_rows][:, None] != codes[leaders][None, :]] = -np.inf
+        local = block @ block.T
+        new_leaders: List[int] = []
+        for i, row in enumerate(block_rows):
+            if not valid[row]:
+                continue
+            best_score, best_leader = -np.inf, row
+            if len(leaders):
+                j = int(np.argmax(old[i]))
+                best_score, best_leader = old[i, j], leaders[j]
+            if new_leaders:
+                same = [k for k in new_leaders if codes[block_rows[k]] == codes[row]]
+                if same:
+                    scores = local[i, same]
+                    j = int(np.argmax(scores))
+                    if scores[j] > best_score:
+                        best_score, best_leader = scores[j], block_rows[same[j]]
+            if best_score >= threshold:
+                leader_of[row] = best_leader
+            else:
+                new_leaders.append(i)
+        leaders = np.concatenate([leaders, block_rows[new_leaders]])
+    return leader_of
+
+
+def most_similar(vector, matrix: np.ndarray, candidates: Optional[np.ndarray] = None) -> Tuple[int, float]:
+    """(row, cosine similarity) of the row in `matrix` (restricted to `candidates`) closest to `vector`; (-1, -inf) if none."""
+    query = np.asarray(vector, dtype=np.float32)
+    query_norm = np.linalg.norm(query)
+    rows = np.arange(len(matrix)) if candidates is None else np.asarray(candidates, dtype=np.int64)
+    if len(rows) == 0 or query_norm == 0:
+        return -1, -np.inf
+    unit, valid = _unit_rows(matrix[rows])
+    scores = unit @ (query / query_norm)
+    scores[~valid] = -np.inf
+    j = int(np.argmax(scores))
+    return int(rows[j]), float(scores[j])
+
+
+def merge_clusters(entries: List[Dict[str, Any]], leader_of: np.ndarray) -> List[Dict[str, Any]]:
+    """
+    Keep one entry per cluster (its leader) in the original order. The leader's "support" counts
+    how many items it now stands for.
+    """
+    kept = {}
+    for row, leader in enumerate(leader_of):
+        if row == leader:
+            kept[row] = dict(entries[row])
+            kept[row].setdefault("support", 1)
+    for row, leader in enumerate(leader_of):
+        if row != leader:
+            kept[leader]["support"] += entries[row].get("support", 1)
+    return [kept[row] for row in sorted(kept)]
+
+
+def shrink_report(before: int, after: int) -> Dict[str, Any]:
+    removed = before - after
+    return {
+        "before": before,
+        "after": after,
+        "removed": removed,
+        "shrink_ratio": removed / before if before else 0.0,
+    }
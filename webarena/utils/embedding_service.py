@@ -0,0 +1,180 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def embedding_key(text: str, model: str) -> str:
+    """Content-addressed cache key for (model, text)."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache in a single SQLite file, keyed by content hash.
+    Holds at most `max_entries` vectors; the least recently used ones are evicted first.
+    Uses WAL mode so several processes can share one cache file.
+    """
+
+    def __init__(self, path: str, max_entries: int = 500_000):
+        self.path = path
+        self.max_entries = max_entries
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        if not keys:
+            return found
+        now = time.time()
+        with self._lock:
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found]
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(k, np.asarray(v, dtype=np.float32).tobytes(), now) for k, v in items.items()],
+            )
+            self._count += max(cursor.rowcount, 0)
+            self._conn.commit()
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        """Drop the least recently used rows, leaving ~10% headroom so eviction is not run on every insert."""
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = self._count - int(self.max_entries * 0.9)
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        self._conn.commit()
+        self._count -= excess
+        logger.info(f"Evicted {excess} embeddings from cache {self.path}")
+
+
+class EmbeddingService:
+    """
+    Batching, deduplicating front end for an embedding function.
+
+    `embed_fn(texts, model)` must return one vector per input text, in order. Requests are
+    served from the cache when possible; the remaining texts are deduplicated (also against
+    identical requests already in flight on other threads) and sent in batches of `batch_size`.
+    Instead of `cache`, `open_cache` may be given: it is called on the first request to open the
+    cache (or return None), so constructing a service at import time touches no files.
+    """
+
+    def __init__(self, embed_fn: Callable[[List[str], str], List[List[float]]],
+                 cache: Optional[EmbeddingCache] = None, batch_size: int = 256,
+                 open_cache: Optional[Callable[[], Optional[EmbeddingCache]]] = None):
+        self.embed_fn = embed_fn
+        self.cache = cache
+        self.batch_size = batch_size
+        self._open_cache = open_cache
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+        self.stats = {"requests": 0, "cache_hits": 0, "api_calls": 0, "api_texts": 0}
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return text.replace("\n", " ")
+
+    def _get_cache(self) -> Optional[EmbeddingCache]:
+        if self._open_cache is not None:
+            with self._lock:
+                if self._open_cache is not None:
+                    self.cache, self._open_cache = self._open_cache(), None
+        return self.cache
+
+    def embed(self, text: str, model: str) -> List[float]:
+        return self.embed_many([text], model)[0]
+
+    def embed_many(self, texts: List[str], model: str) -> List[List[float]]:
+        texts = [self.normalize(t) for t in texts]
+        keys = [embedding_key(t, model) for t in texts]
+        text_of = dict(zip(keys, texts))
+
+        cache = self._get_cache()
+        results = cache.get_many(list(text_of)) if cache is not None else {}
+
+        # Claim the misses nobody else is fetching; wait on the rest
+        owned, waiting = [], {}
+        with self._lock:
+            self.stats["requests"] += len(texts)
+            self.stats["cache_hits"] += sum(1 for k in keys if k in results)
+            for key in text_of:
+                if key in results:
+                    continue
+                if key in self._inflight:
+                    waiting[key] = self._inflight[key]
+                else:
+                    self._inflight[key] = Future()
+                    owned.append(key)
+
+        for start in range(0, len(owned), self.batch_size):
+            batch = owned[start:start + self.batch_size]
+            try:
+                vectors = self.embed_fn([text_of[k] for k in batch], model)
+                if len(vectors) != len(batch):
+                    raise ValueError(f"Embedding function returned {len(vectors)} vectors for {len(batch)} inputs")
+            except Exception as e:
+                with self._lock:
+                    for key in owned[start:]:
+                        self._inflight.pop(key).set_exception(e)
+                raise
+            fetched = dict(zip(batch, vectors))
+            if cache is not None:
+                cache.put_many(fetched)
+            results.update(fetched)
+            with self._lock:
+                self.stats["api_calls"] += 1
+                self.stats["api_texts"] += len(batch)
+                for key in batch:
+                    self._inflight.pop(key).set_result(fetched[key])
+
+        for key, future in waiting.items():
+            results[key] = future.result()
+
+        return [list(results[k]) for k in keys]
@@ -0,0 +1,155 @@
+import os
+import json
+import fcntl
+import numpy as np
+from typing import List, Dict, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """
+    Binary, append-only embedding store.
+
+    Vectors live in a raw float32 file (one row per id) that is memory-mapped on open,
+    next to a text index with one id per line and a small JSON header holding the dimension.
+    Given `path="data/reasoning_bank_embeddings.json"` the files are:
+        data/reasoning_bank_embeddings.f32       raw float32 rows
+        data/reasoning_bank_embeddings.ids       ids, one per line (row i <-> line i)
+        data/reasoning_bank_embeddings.meta.json {"dim": ..., "dtype": "float32"}
+    An id line is only written after its vector is on disk, so a torn write never exposes
+    a partial row. If the same id is appended twice, the latest row wins.
+    """
+
+    def __init__(self, path: str):
+        base, _ = os.path.splitext(path)
+        self.legacy_json_path = path
+        self.vec_path = f"{base}.f32"
+        self.ids_path = f"{base}.ids"
+        self.meta_path = f"{base}.meta.json"
+        self.dim = 0
+        self.ids: List[str] = []
+        self._row_of: Dict[str, int] = {}
+        self._ids_offset = 0
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        dir_name = os.path.dirname(self.vec_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.refresh()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self._row_of
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """Memory-mapped (n, dim) float32 matrix; row i belongs to self.ids[i]."""
+        return self._vectors
+
+    def refresh(self):
+        """Pick up rows appended since the last refresh (by this or another process)."""
+        if self.dim == 0 and os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.dim = int(json.load(f).get("dim", 0))
+
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, 'rb') as f:
+                f.seek(self._ids_offset)
+                chunk = f.read()
+            # Only consume complete lines; a trailing partial line belongs to an in-flight write
+            complete = chunk[:chunk.rfind(b"\n") + 1]
+            self._ids_offset += len(complete)
+            for item_id in complete.decode('utf-8').splitlines():
+                self._row_of[item_id] = len(self.ids)
+                self.ids.append(item_id)
+
+        n = len(self.ids)
+        if n == 0 or self.dim == 0:
+            self._vectors = np.zeros((0, self.dim), dtype=np.float32)
+        elif self._vectors.shape[0] != n:
+            self._vectors = np.memmap(self.vec_path, dtype=np.float32, mode='r', shape=(n, self.dim))
+
+    def row(self, item_id: str) -> int:
+        """Row index of `item_id`, or -1 if it has no stored vector."""
+        return self._row_of.get(item_id, -1)
+
+    def rows(self, item_ids: List[str]) -> np.ndarray:
+        """Row indices for a list of ids (-1 where missing)."""
+        return np.array([self._row_of.get(item_id, -1) for item_id in item_ids], dtype=np.int64)
+
+    def get(self, item_id: str) -> Optional[np.ndarray]:
+        row = self.row(item_id)
+        if row < 0:
+            return None
+        return self._vectors[row]
+
+    def append(self, item_ids: List[str], embeddings: List[List[float]]):
+        """Append vectors in place. Safe across processes (exclusive flock on the id index)."""
+        pairs = [(i, e) for i, e in zip(item_ids, embeddings) if e is not None and len(e) > 0]
+        if not pairs:
+            return
+        with open(self.ids_path, 'a+', encoding='utf-8') as ids_f:
+            fcntl.flock(ids_f, fcntl.LOCK_EX)
+            try:
+                self._append_locked(ids_f, pairs)
+            finally:
+                fcntl.flock(ids_f, fcntl.LOCK_UN)
+
+    def _append_locked(self, ids_f, pairs):
+        """Write rows while holding the exclusive lock on `ids_f`."""
+        # Another writer may have appended since we last looked
+        self.refresh()
+        block = np.asarray([e for _, e in pairs], dtype=np.float32)
+        if self.dim == 0:
+            self.dim = block.shape[1]
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({"dim": self.dim, "dtype": "float32"}, f)
+        if block.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {block.shape[1]} does not match store dimension {self.dim}")
+
+        # 1. Vectors first, at the end of the committed rows (overwrites any torn tail)
+        mode = 'r+b' if os.path.exists(self.vec_path) else 'wb'
+        with open(self.vec_path, mode) as vec_f:
+            vec_f.seek(len(self.ids) * self.dim * 4)
+            vec_f.write(block.tobytes())
+            vec_f.truncate()
+            vec_f.flush()
+            os.fsync(vec_f.fileno())
+
+        # 2. Then the ids, which commit the rows
+        ids_f.write("".join(f"{i}\n" for i, _ in pairs))
+        ids_f.flush()
+        os.fsync(ids_f.fileno())
+
+        self.refresh()
+
+    def migrate_from_json(self) -> bool:
+        """
+        One-time migration from the legacy `{id: [floats]}` JSON embedding file.
+        Does nothing if the binary store already has rows. Returns True if rows were imported.
+        """
+        if len(self) or not os.path.exists(self.legacy_json_path):
+            return False
+        with open(self.ids_path, 'a+', encoding='utf-8') as ids_f:
+            fcntl.flock(ids_f, fcntl.LOCK_EX)
+            try:
+                # Re-check under the writer lock in case another process migrated first
+                self.refresh()
+                if len(self):
+                    return False
+                try:
+                    with open(self.legacy_json_path, 'r', encoding='utf-8') as f:
+                        embeddings_map = json.load(f)
+                except json.JSONDecodeError:
+                    logger.warning(f"Failed to decode {self.legacy_json_path}. Skipping embedding migration.")
+                    return False
+                pairs = [(k, v) for k, v in embeddings_map.items() if v]
+                if pairs:
+                    self._append_locked(ids_f, pairs)
+            finally:
+                fcntl.flock(ids_f, fcntl.LOCK_UN)
+        logger.info(f"Migrated {len(pairs)} embeddings from {self.legacy_json_path} to {self.vec_path}.")
+        return bool(pairs)
@@ -4,6 +4,7 @@ import os
 import inspect
 import tiktoken
 from openai import OpenAI, BadRequestError
+from utils.embedding_service import EmbeddingService, EmbeddingCache
 
 logger = logging.getLogger("main")
 client = OpenAI()
@@ -14,15 +15,40 @@ MODELS_WITHOUT_STOP_SUPPORT = {
     "o1-preview",
 }
 
+def _openai_embed(texts: list[str], model: str) -> list[list[float]]:
+    """One batched embeddings request; results are returned in input order."""
+    response = client.embeddings.create(input=texts, model=model)
+    return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+
+# Batched, deduplicated embedding calls backed by a persistent content-hash cache, which is
+# opened on the first embedding request. Set EMBEDDING_CACHE_PATH="" to disable the on-disk cache.
+_embedding_cache_path = os.environ.get("EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite")
+embedding_service = EmbeddingService(
+    _openai_embed,
+    open_cache=lambda: EmbeddingCache(_embedding_cache_path) if _embedding_cache_path else None,
+)
+
+
 def get_embedding(text: str, model: str = "text-embedding-3-small") -> list[float]:
-    """Get embedding from OpenAI."""
+    """Get embedding from OpenAI (served from the embedding cache when possible)."""
     try:
-        text = text.replace("\n", " ")
-        return client.embeddings.create(input=[text], model=model).data[0].embedding
+        return embedding_service.embed(text, model)
     except Exception as e:
         logger.error(f"Error getting embedding: {e}")
         return []
 
+
+def get_embeddings(texts: list[str], model: str = "text-embedding-3-small") -> list[list[float]]:
+    """Get embeddings for many texts with batched requests. Failed lookups yield empty lists."""
+    if not texts:
+        return []
+    try:
+        return embedding_service.embed_many(texts, model)
+    except Exception as e:
+        logger.error(f"Error getting embeddings: {e}")
+        return [[] for _ in texts]
+
 def get_mode(model: str) -> str:
     """Check if the model is a chat model."""
     if model in [
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+
+class QueryCache:
+    """
+    Thread-safe LRU cache of retrieval results with hit/miss counters.
+
+    Every lookup passes the current bank version; a version the cache has not seen before
+    drops all cached results, so results computed before a write to the bank are never served.
+    """
+    _MISSING = object()
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Queries that differ only in whitespace share a cache entry."""
+        return " ".join(query.split())
+
+    def _check_version(self, version: Hashable):
+        if version != self._version:
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+            self._version = version
+
+    def get(self, key: Hashable, version: Hashable) -> Any:
+        """The cached result for `key` at `version`, or None."""
+        with self._lock:
+            self._check_version(version)
+            value = self._entries.get(key, self._MISSING)
+            if value is self._MISSING:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, version: Hashable, value: Any):
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+            "invalidations": self.invalidations,
+        }
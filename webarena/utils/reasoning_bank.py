@@ -2,19 +2,33 @@ import os, json, random
 import numpy as np
 import math
 import uuid
+import fcntl
+import heapq
 import argparse
 import re
-import fcntl
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 from pathlib import Path
 from collections import Counter
 from datetime import datetime
-from utils.llm import get_embedding
+from functools import lru_cache
+from utils.llm import get_embedding, get_embeddings
+from utils.bank_storage import make_bank_storage
+from utils.ann_index import IVFIndex
+from utils.query_cache import QueryCache
+from utils.consolidation import greedy_clusters, merge_clusters, most_similar, shrink_report
 from nltk.stem import SnowballStemmer
 
 import logging
 logger = logging.getLogger(__name__)
 
+stemmer = SnowballStemmer("english")
+# Stemming dominates tokenization cost and the vocabulary is small, so cache stems
+_stem = lru_cache(maxsize=200_000)(stemmer.stem)
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, split on whitespace and stem."""
+    return [_stem(token) for token in text.lower().split()]
+
 def cosine_similarity(v1, v2):
     if not v1 or not v2:
         return 0.0
@@ -61,53 +75,300 @@ class BM25:
                     scores[index] += numerator / denominator
         return scores
 
+def _ranks(scores: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """1-based rank of each valid score (highest first, ties in input order); 0 for invalid entries."""
+    ranks = np.zeros(len(scores), dtype=np.int64)
+    idx = np.flatnonzero(valid)
+    ranks[idx[np.argsort(-scores[idx], kind="stable")]] = np.arange(1, len(idx) + 1)
+    return ranks
+
+def _zscores(scores: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    """Standardize the valid scores; invalid entries get the lowest valid z-score."""
+    z = np.zeros(len(scores), dtype=np.float64)
+    if not valid.any():
+        return z
+    values = scores[valid]
+    std = values.std()
+    z[valid] = (values - values.mean()) / std if std > 0 else 0.0
+    z[~valid] = z[valid].min()
+    return z
+
+def fuse_scores(dense: np.ndarray, sparse: np.ndarray, method: str = "rrf", dense_weight: float = 0.5, rrf_k: int = 60) -> np.ndarray:
+    """
+    Fuse aligned embedding (`dense`, NaN where a row has no vector) and BM25 (`sparse`) scores.
+    "rrf": weighted reciprocal rank fusion; rows with no embedding or a zero BM25 score get no
+    contribution from that signal. "zscore": weighted sum of standardized scores.
+    """
+    dense_valid = ~np.isnan(dense)
+    if method == "zscore":
+        return dense_weight * _zscores(dense, dense_valid) + (1 - dense_weight) * _zscores(sparse, np.ones(len(sparse), dtype=bool))
+    if method != "rrf":
+        raise ValueError(f"Unknown fusion method: {method}")
+    fused = np.zeros(len(dense), dtype=np.float64)
+    for weight, ranks in ((dense_weight, _ranks(dense, dense_valid)), (1 - dense_weight, _ranks(sparse, sparse > 0))):
+        ranked = ranks > 0
+        fused[ranked] += weight / (rrf_k + ranks[ranked])
+    return fused
+
+class BM25Index:
+    """
+    Persistent, incrementally maintained inverted index for BM25.
+
+    Rows are positions in the bank's memory list. Postings hold term frequencies, and
+    document frequencies / lengths are also tracked per domain so that domain-filtered
+    queries score exactly like a BM25 built over just that domain's documents.
+    Scoring only touches the postings of the query terms.
+    """
+    VERSION = 1
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[str] = []
+        self.doc_domains: List[str] = []
+        self.doc_len: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.total_len = 0
+        self.domain_df: Dict[str, Counter] = {}
+        self.domain_count: Counter = Counter()
+        self.domain_len: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def add(self, doc_id: str, domain: str, tokens: List[str]):
+        row = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_domains.append(domain)
+        self.doc_len.append(len(tokens))
+        self.total_len += len(tokens)
+        self.domain_count[domain] += 1
+        self.domain_len[domain] += len(tokens)
+        for token, freq in Counter(tokens).items():
+            self.postings.setdefault(token, {})[row] = freq
+            self.domain_df.setdefault(token, Counter())[domain] += 1
+
+    def get_scores(self, query: List[str], domain: str = None) -> Dict[int, float]:
+        """
+        Sparse BM25 scores {row: score} over all documents, or only those in `domain`
+        (statistics then come from that domain alone). Rows scoring zero are omitted.
+        """
+        if domain is None:
+            corpus_size, total_len = len(self.doc_ids), self.total_len
+        else:
+            corpus_size, total_len = self.domain_count[domain], self.domain_len[domain]
+        if corpus_size == 0:
+            return {}
+        avgdl = total_len / corpus_size
+
+        scores: Dict[int, float] = {}
+        for token in query:
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            freq_in_corpus = len(postings) if domain is None else self.domain_df[token][domain]
+            if freq_in_corpus == 0:
+                continue
+            idf = math.log(1 + (corpus_size - freq_in_corpus + 0.5) / (freq_in_corpus + 0.5))
+            for row, freq in postings.items():
+                if domain is not None and self.doc_domains[row] != domain:
+                    continue
+                numerator = idf * freq * (self.k1 + 1)
+                denominator = freq + self.k1 * (1 - self.b + self.b * self.doc_len[row] / avgdl)
+                scores[row] = scores.get(row, 0.0) + numerator / denominator
+        return scores
+
+    def save(self, path: str):
+        data = {
+            "version": self.VERSION,
+            "k1": self.k1,
+            "b": self.b,
+            "doc_ids": self.doc_ids,
+            "doc_domains": self.doc_domains,
+            "doc_len": self.doc_len,
+            "postings": {t: [[row, freq] for row, freq in p.items()] for t, p in self.postings.items()},
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Load a saved index. Returns None if the file is missing, corrupt, or from another version."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            return None
+        if data.get("version") != cls.VERSION:
+            return None
+        index = cls(k1=data["k1"], b=data["b"])
+        index.doc_ids = data["doc_ids"]
+        index.doc_domains = data["doc_domains"]
+        index.doc_len = data["doc_len"]
+        index.total_len = sum(index.doc_len)
+        for domain, length in zip(index.doc_domains, index.doc_len):
+            index.domain_count[domain] += 1
+            index.domain_len[domain] += length
+        for token, postings in data["postings"].items():
+            index.postings[token] = {row: freq for row, freq in postings}
+            index.domain_df[token] = Counter(index.doc_domains[row] for row, _ in postings)
+        return index
+
+    def matches_prefix(self, doc_ids: List[str]) -> bool:
+        """True if this index covers exactly the first len(self) of `doc_ids`, in order."""
+        return len(self.doc_ids) <= len(doc_ids) and self.doc_ids == doc_ids[:len(self.doc_ids)]
+
 class ReasoningBank:
-    def __init__(self, storage_path: str = "reasoning_bank.json", embedding_path: str = "reasoning_bank_embeddings.json"):
+    # Utility = score * w["score"] + log(1 + hits) * w["hits"] + last use (days) / w["recency_days"]
+    EVICTION_WEIGHTS = {"score": 1.0, "hits": 1.0, "recency_days": 7.0}
+    # Persisted BM25/IVF indexes are rewritten only once the rows they lack reach this fraction of the
+    # rows they cover, so index writes cost amortized O(1) per insert; readers index the gap themselves
+    INDEX_SAVE_FRACTION = 0.25
+
+    def __init__(self, storage_path: str = "reasoning_bank.json", embedding_path: str = "reasoning_bank_embeddings.json",
+                 index_type: str = "exact", ann_nprobe: int = 8, ann_min_size: int = 10_000,
+                 hybrid_fusion: str = "rrf", hybrid_dense_weight: float = 0.5, backend: str = None,
+                 dedup_threshold: float = None, capacity: int = None, eviction_weights: Dict[str, float] = None,
+                 query_cache_size: int = 1024):
         self.storage_path = storage_path
+        # Legacy JSON embedding path; vectors are kept in a binary store derived from it (JSON backend)
         self.embedding_path = embedding_path
+        # Content + vector storage: "json" (flock-guarded JSON file + binary embedding store) or
+        # "sqlite" (one WAL-mode database). Inferred from the storage_path extension if not given;
+        # an existing JSON bank is imported when it is switched to "sqlite" (see make_bank_storage).
+        self.storage = make_bank_storage(storage_path, embedding_path, backend=backend)
+        self.embedding_store = self.storage.embedding_store
         self.memories = []
+        # BM25 inverted index, persisted beside the content file; loaded on first BM25 query
+        self.bm25_index_path = f"{os.path.splitext(storage_path)[0]}.bm25.json"
+        self._bm25_index = None
+        self._bm25_epoch = None
+        self._bm25_saved = 0  # documents covered by the persisted BM25 index
+        # Embedding search: "exact" scans every candidate; "ivf" uses the approximate index over the
+        # embedding store (also selectable per query with retrieve_type="ann"). Stores smaller than
+        # ann_min_size are always searched exactly. ann_nprobe trades recall for latency.
+        self.index_type = index_type
+        self.ann_nprobe = ann_nprobe
+        self.ann_min_size = ann_min_size
+        self.ann_index_path = f"{os.path.splitext(storage_path)[0]}.ivf.npz"
+        self._ann_index = None
+        self._ann_saved = 0  # rows covered by the persisted IVF index
+        # retrieve_type="hybrid": how embedding and BM25 scores are fused (see fuse_scores)
+        self.hybrid_fusion = hybrid_fusion
+        self.hybrid_dense_weight = hybrid_dense_weight
+        # Reject new items whose embedding is at least this similar to an existing item with the
+        # same domain and score (None disables the check). See also consolidate().
+        self.dedup_threshold = dedup_threshold
+        # Keep at most `capacity` items (None = unbounded). Writes that take the bank over capacity move
+        # the lowest-utility items (see _utility) to an append-only archive beside the content file.
+        # Retrieval hits, which raise utility, are appended to a hits log shared by all processes.
+        self.capacity = capacity
+        self.eviction_weights = {**self.EVICTION_WEIGHTS, **(eviction_weights or {})}
+        self.archive_path = f"{os.path.splitext(storage_path)[0]}.archive.jsonl"
+        self.hits_path = f"{os.path.splitext(storage_path)[0]}.hits.jsonl"
+        # LRU cache of retrieval results, invalidated whenever the loaded bank changes (0 disables)
+        self.query_cache = QueryCache(query_cache_size) if query_cache_size else None
         # Initial load for read access. For writing, we'll reload under lock.
         self._load_bank_read_only()
 
     def _load_bank_read_only(self):
-        """Load the reasoning bank content and embeddings from disk safely using shared locks."""
-        # Ensure directories exist
-        dir_name = os.path.dirname(self.storage_path)
-        if dir_name and not os.path.exists(dir_name):
-            os.makedirs(dir_name, exist_ok=True)
-        
-        self.memories = []
-        embeddings_map = {}
+        """Load the reasoning bank content and embeddings from the storage backend."""
+        self.memories = self.storage.load()
 
-        # 1. Load Content
-        if os.path.exists(self.storage_path):
-            try:
-                with open(self.storage_path, 'r', encoding='utf-8') as f:
-                    fcntl.flock(f, fcntl.LOCK_SH) # Shared lock for reading
-                    self.memories = json.load(f)
-                    fcntl.flock(f, fcntl.LOCK_UN)
-            except json.JSONDecodeError:
-                logger.warning(f"Failed to decode {self.storage_path}. Starting with empty bank.")
-                self.memories = []
-            except Exception as e:
-                logger.error(f"Error reading {self.storage_path}: {e}")
+    @staticmethod
+    def _bm25_tokens(item: Dict[str, Any]) -> List[str]:
+        return tokenize(f"{item.get('title', '')} {item.get('description', '')} {item.get('content', '')}")
 
-        # 2. Load Embeddings
-        if os.path.exists(self.embedding_path):
+    def _get_bm25_index(self) -> BM25Index:
+        """
+        Return the BM25 index covering self.memories, saving it when the persisted one lags too far
+        behind (see INDEX_SAVE_FRACTION). The persisted index is reused as long as it covers a prefix
+        of the (append-only) content file.
+        """
+        # The prefix check is only needed when the storage replaced (rather than extended) its content
+        if self._bm25_index is not None and self._bm25_epoch != self.storage.epoch:
+            if not self._bm25_index.matches_prefix([m.get("id") for m in self.memories]):
+                self._bm25_index = None
+        if self._bm25_index is None:
+            ids = [m.get("id") for m in self.memories]
+            # save() replaces the file atomically, so a plain read always sees a complete index
+            index = BM25Index.load(self.bm25_index_path)
+            if index is None or not index.matches_prefix(ids):
+                index = BM25Index()
+            self._bm25_index = index
+            self._bm25_saved = len(index)
+        self._bm25_epoch = self.storage.epoch
+        for entry in self.memories[len(self._bm25_index):]:
+            self._bm25_index.add(entry.get("id"), entry.get("domain"), self._bm25_tokens(entry))
+        if len(self._bm25_index) - self._bm25_saved > self.INDEX_SAVE_FRACTION * self._bm25_saved:
+            self._save_bm25_index()
+        return self._bm25_index
+
+    def _save_bm25_index(self):
+        """Persist the BM25 index (atomic replace, so concurrent readers never see a partial file)."""
+        try:
+            self._bm25_index.save(self.bm25_index_path)
+            self._bm25_saved = len(self._bm25_index)
+        except Exception as e:
+            logger.error(f"Failed to save BM25 index to {self.bm25_index_path}: {e}")
+
+    def _get_ann_index(self) -> IVFIndex:
+        """
+        Return the IVF index over the embedding store rows, loading the persisted one when it still
+        covers a prefix of the (append-only) store and indexing the rows appended since. A retrained
+        index is saved at once; inserts are saved as the BM25 index is (see INDEX_SAVE_FRACTION).
+        """
+        store = self.embedding_store
+        if self._ann_index is None or not self._ann_index.matches_prefix(store.ids):
+            index = IVFIndex.load(self.ann_index_path, lambda rows: store.vectors[rows])
+            if index is None or index.dim != store.dim or not index.matches_prefix(store.ids):
+                index = None
+            self._ann_index = index
+            self._ann_saved = 0 if index is None else len(index)
+
+        index = self._ann_index
+        if index is None or index.needs_retrain():
+            index = IVFIndex(store.dim, nprobe=self.ann_nprobe)
+            index.train(store.vectors)
+            index.reset()
+            self._ann_saved = 0
+        if len(store) > len(index):
+            index.add(store.ids[len(index):], np.arange(len(index), len(store)), store.vectors[len(index):])
+        self._ann_index = index
+        if len(index) - self._ann_saved > self.INDEX_SAVE_FRACTION * self._ann_saved:
             try:
-                with open(self.embedding_path, 'r', encoding='utf-8') as f:
-                    fcntl.flock(f, fcntl.LOCK_SH) # Shared lock for reading
-                    embeddings_map = json.load(f)
-                    fcntl.flock(f, fcntl.LOCK_UN)
-            except json.JSONDecodeError:
-                embeddings_map = {}
+                index.save(self.ann_index_path)
+                self._ann_saved = len(index)
             except Exception as e:
-                logger.error(f"Error reading {self.embedding_path}: {e}")
+                logger.error(f"Failed to save ANN index to {self.ann_index_path}: {e}")
+        index.nprobe = self.ann_nprobe
+        return index
 
-        # 3. Merge (In-memory only)
-        for entry in self.memories:
-            if "id" in entry:
-                entry["embedding"] = embeddings_map.get(entry["id"])
+    def _ann_search(self, query_vec: np.ndarray, store_rows: np.ndarray, items: List[Dict[str, Any]], k: int):
+        """
+        Approximate top-k (similarity, item) pairs, where items[i] is stored at store_rows[i].
+        Returns None if the exact path should be used instead.
+        """
+        store = self.embedding_store
+        query_norm = np.linalg.norm(query_vec)
+        if len(store) < self.ann_min_size or query_norm == 0:
+            return None
+        row_mask = np.zeros(len(store), dtype=bool)
+        row_mask[store_rows] = True
+        top_rows = self._get_ann_index().search(query_vec / query_norm, store.vectors, k, row_mask=row_mask)
+        if len(top_rows) < min(k, len(store_rows)):
+            # Probed lists held too few candidates (e.g. a small domain); fall back to the exact scan
+            return None
+        item_of = dict(zip(store_rows.tolist(), items))
+        vectors = store.vectors[top_rows]
+        norms = np.linalg.norm(vectors, axis=1) * query_norm
+        norms[norms == 0] = np.inf
+        similarities = (vectors @ query_vec) / norms
+        return [(sim, item_of[row]) for sim, row in zip(similarities.tolist(), top_rows.tolist())]
 
     def add_memory(self, task_query: str, trajectory_summary: str, memory_items: List[Dict[str, str]], score: float, domain: str = ""):
         """
@@ -118,9 +379,9 @@ class ReasoningBank:
             logger.warning("No memory items to add.")
             return
 
-        # Store each memory item as a separate entry
+        # Create embedding from title + description + content for comprehensive semantic representation
+        embeddable = []
         for item in memory_items:
-            # Create embedding from title + description + content for comprehensive semantic representation
             parts = [
                 item.get('title', '').strip(),
                 item.get('description', '').strip(),
@@ -131,12 +392,29 @@ class ReasoningBank:
             if not embedding_text:
                 logger.warning(f"Skipping memory item with no content: {item}")
                 continue
+            embeddable.append((item, embedding_text))
+
+        # Embed all items in one batched request
+        embeddings = get_embeddings([text for _, text in embeddable])
+
+        if self.dedup_threshold is not None:
+            self._load_bank_read_only()
+            kept = []
+            for (item, text), embedding in zip(embeddable, embeddings):
+                if self._is_duplicate(embedding, domain, score, [e for _, e in kept]):
+                    logger.info(f"Skipping near-duplicate memory item: {item.get('title', '')[:50]}")
+                    continue
+                kept.append(((item, text), embedding))
+            embeddable = [pair for pair, _ in kept]
+            embeddings = [embedding for _, embedding in kept]
+            if not embeddable:
+                return
 
-            embedding = get_embedding(embedding_text)
-
-            new_id = str(uuid.uuid4())
-            new_entry = {
-                "id": new_id,
+        # Store each memory item as a separate entry
+        entries = []
+        for item, _ in embeddable:
+            entries.append({
+                "id": str(uuid.uuid4()),
                 "source_task": task_query,
                 "domain": domain,
                 "title": item.get("title", ""),
@@ -144,80 +422,159 @@ class ReasoningBank:
                 "content": item.get("content", ""),
                 "score": score,
                 "timestamp": datetime.now().isoformat()
-            }
-
-            # --- Critical Section: Content File ---
-            try:
-                # Ensure file exists
-                if not os.path.exists(self.storage_path):
-                    with open(self.storage_path, 'w') as f: json.dump([], f)
-
-                with open(self.storage_path, 'r+', encoding='utf-8') as f:
-                    # 1. Acquire Lock
-                    fcntl.flock(f, fcntl.LOCK_EX)
-
-                    # 2. Read latest data
-                    try:
-                        content_data = json.load(f)
-                    except json.JSONDecodeError:
-                        content_data = []
-
-                    # 3. Modify
-                    content_data.append(new_entry)
-
-                    # 4. Write back
-                    f.seek(0)
-                    json.dump(content_data, f, indent=2, ensure_ascii=False)
-                    f.truncate()
+            })
+        # All items are written in one locked transaction
+        committed = self.storage.append(entries, embeddings)
+        self.memories = self.storage.memories
+        for entry in committed:
+            logger.info(f"Memory item added successfully (ID: {entry['id']}, Title: {entry['title'][:30]}...)")
+        self._evict_over_capacity()
+
+    def _is_duplicate(self, embedding, domain: str, score: float, pending: List[List[float]]) -> bool:
+        """True if `embedding` is within dedup_threshold of a stored item (same domain and score) or of `pending`."""
+        if not embedding:
+            return False
+        if pending:
+            _, best = most_similar(embedding, np.asarray(pending, dtype=np.float32))
+            if best >= self.dedup_threshold:
+                return True
+        store = self.embedding_store
+        if len(store) == 0 or len(embedding) != store.dim:
+            return False
+        rows = store.rows([m.get("id") for m in self.memories if m.get("domain") == domain and m.get("score") == score])
+        _, best = most_similar(embedding, store.vectors, rows[rows >= 0])
+        return best >= self.dedup_threshold
+
+    def consolidate(self, threshold: float = 0.95, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Merge near-duplicate memories: items of the same domain and score whose embeddings have cosine
+        similarity >= threshold are clustered (greedy, oldest item leads) and only the leader is kept,
+        with "support" counting the items it absorbed. Rewrites the storage unless dry_run.
+        Returns a report of how much the bank shrank.
+        """
+        self._load_bank_read_only()
+        store = self.embedding_store
+        rows = store.rows([m.get("id") for m in self.memories])
+        has_vec = rows >= 0
+        matrix = np.zeros((len(self.memories), store.dim), dtype=np.float32)
+        matrix[has_vec] = store.vectors[rows[has_vec]]
+        groups = [(m.get("domain"), m.get("score")) for m in self.memories]
+        leader_of = greedy_clusters(matrix, threshold, groups)
+        kept = merge_clusters(self.memories, leader_of)
+        report = shrink_report(len(self.memories), len(kept))
+        if dry_run or not report["removed"]:
+            return report
+
+        duplicates = np.flatnonzero(leader_of != np.arange(len(leader_of)))
+        removed_ids = {self.memories[row].get("id") for row in duplicates}
+        kept_by_id = {entry.get("id"): entry for entry in kept}
+        updated = {self.memories[row].get("id"): kept_by_id[self.memories[row].get("id")] for row in set(leader_of[duplicates].tolist())}
+        self.storage.rewrite(removed_ids, updated)
+        self.memories = self.storage.memories
+        # Row positions change, so the BM25 index is rebuilt from scratch
+        self._bm25_index = None
+        if os.path.exists(self.bm25_index_path):
+            os.remove(self.bm25_index_path)
+        logger.info(f"Consolidated Reasoning Bank {self.storage_path}: {report['before']} -> {report['after']} items.")
+        return report
+
+    @staticmethod
+    def _epoch_seconds(timestamp) -> float:
+        try:
+            return datetime.fromisoformat(timestamp).timestamp()
+        except (TypeError, ValueError):
+            return 0.0
+
+    def _utility(self, entry: Dict[str, Any], hits: int = 0, last_retrieved: str = None) -> float:
+        """Eviction priority of an entry (lowest is evicted first); recency is the time of last use (added or retrieved)."""
+        w = self.eviction_weights
+        last_used = max(self._epoch_seconds(entry.get("timestamp")), self._epoch_seconds(last_retrieved))
+        return (w["score"] * float(entry.get("score") or 0.0)
+                + w["hits"] * math.log1p(hits)
+                + last_used / (86400.0 * w["recency_days"]))
+
+    def _record_hits(self, items: List[Dict[str, Any]]):
+        """Append a retrieval of each item to the hits log (only with a capacity, since hits only matter for eviction)."""
+        if self.capacity is None or not items:
+            return
+        now = datetime.now().isoformat()
+        records = "".join(json.dumps({"id": item.get("id"), "hits": 1, "last_retrieved": now}) + "\n" for item in items)
+        try:
+            with open(self.hits_path, 'a', encoding='utf-8') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(records)
                     f.flush()
-                    os.fsync(f.fileno())
-
-                    # 5. Release Lock
+                finally:
                     fcntl.flock(f, fcntl.LOCK_UN)
+        except OSError as e:
+            logger.error(f"Failed to record retrieval hits in {self.hits_path}: {e}")
+
+    @staticmethod
+    def _read_hits(f) -> Dict[str, Tuple[int, str]]:
+        """Fold the (open, locked) hits log into {id: (hits, last retrieved)}."""
+        f.seek(0)
+        hits = {}
+        for line in f.read().splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn line from an interrupted append
+            count, last = hits.get(record.get("id"), (0, ""))
+            hits[record.get("id")] = (count + record.get("hits", 0), max(last, record.get("last_retrieved") or ""))
+        return hits
 
-                    # Update in-memory state
-                    self.memories = content_data
-
-            except Exception as e:
-                logger.error(f"Failed to save content to {self.storage_path}: {e}")
-                continue
-
-            # --- Critical Section: Embedding File ---
-            if embedding:
-                new_entry["embedding"] = embedding
-                try:
-                    if not os.path.exists(self.embedding_path):
-                        with open(self.embedding_path, 'w') as f: json.dump({}, f)
-
-                    with open(self.embedding_path, 'r+', encoding='utf-8') as f:
-                        fcntl.flock(f, fcntl.LOCK_EX)
-                        try:
-                            embedding_data = json.load(f)
-                        except json.JSONDecodeError:
-                            embedding_data = {}
-
-                        embedding_data[new_id] = embedding
-
-                        f.seek(0)
-                        json.dump(embedding_data, f)
-                        f.truncate()
-                        f.flush()
-                        os.fsync(f.fileno())
-                        fcntl.flock(f, fcntl.LOCK_UN)
-                except Exception as e:
-                    logger.error(f"Failed to save embedding to {self.embedding_path}: {e}")
-
-            logger.info(f"Memory item added successfully (ID: {new_id}, Title: {item.get('title', '')[:30]}...)")
-
-    def retrieve(self, query: str, top_k: int = 3, domain: str = None, retrieve_type: str = "embedding") -> List[Dict[str, Any]]:
+    def _evict_over_capacity(self):
         """
-        Retrieve relevant memory items based on the specified retrieval type.
+        Archive and remove the lowest-utility items until the bank is within capacity. The bank is
+        reloaded per process anyway, so utilities are heapified in O(N) and each victim popped in
+        O(log N). The hits log lock serializes evictions by concurrent writers; the log is compacted
+        (one folded record per live item) at the same time.
         """
-        self._load_bank_read_only()
-
-        if not self.memories:
-            return []
-
+        if self.capacity is None or len(self.memories) <= self.capacity:
+            return
+        with open(self.hits_path, 'a+', encoding='utf-8') as hits_f:
+            fcntl.flock(hits_f, fcntl.LOCK_EX)
+            try:
+                # Another writer may have evicted since this process loaded the bank
+                self._load_bank_read_only()
+                excess = len(self.memories) - self.capacity
+                if excess <= 0:
+                    return
+                hits = self._read_hits(hits_f)
+                heap = [(self._utility(entry, *hits.get(entry.get("id"), (0, None))), row) for row, entry in enumerate(self.memories)]
+                heapq.heapify(heap)
+                victims = [self.memories[heapq.heappop(heap)[1]] for _ in range(excess)]
+
+                # Archive first, then remove: a crash in between leaves an item archived and live, never lost
+                evicted_at = datetime.now().isoformat()
+                with open(self.archive_path, 'a', encoding='utf-8') as f:
+                    f.write("".join(json.dumps({"evicted_at": evicted_at, "entry": e}, ensure_ascii=False) + "\n" for e in victims))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.storage.rewrite({e.get("id") for e in victims}, {})
+                self.memories = self.storage.memories
+
+                live_ids = {m.get("id") for m in self.memories}
+                hits_f.seek(0)
+                hits_f.truncate()
+                hits_f.write("".join(json.dumps({"id": i, "hits": n, "last_retrieved": last}) + "\n"
+                                     for i, (n, last) in hits.items() if i in live_ids))
+                hits_f.flush()
+            finally:
+                fcntl.flock(hits_f, fcntl.LOCK_UN)
+        logger.info(f"Evicted {len(victims)} items from Reasoning Bank {self.storage_path} to {self.archive_path} (capacity {self.capacity}).")
+
+    def write_stats(self) -> Dict[str, Dict[str, float]]:
+        """Write batch sizes and latencies per storage commit."""
+        return {"commit": self.storage.metrics.snapshot()}
+
+    def query_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the retrieval cache (empty if disabled)."""
+        return self.query_cache.stats() if self.query_cache is not None else {}
+
+    def _rank(self, query: str, top_k: int, domain: str, retrieve_type: str) -> List[Tuple[float, Dict[str, Any]]]:
+        """(score, entry) pairs for the query, best first (at least the top_k)."""
         candidates = self.memories
         if domain:
             filtered_candidates = [m for m in self.memories if m.get("domain") == domain]
@@ -227,41 +584,99 @@ class ReasoningBank:
         if not candidates:
             return []
 
-        if retrieve_type == "embedding":
+        if retrieve_type in ("embedding", "ann"):
             query_embedding = get_embedding(query)
             if not query_embedding:
                 return []
 
-            scored_items = []
-            for item in candidates:
-                item_embedding = item.get("embedding")
-                if item_embedding:
-                    similarity = cosine_similarity(query_embedding, item_embedding)
-                    scored_items.append((similarity, item))
-            
-            scored_items.sort(key=lambda x: x[0], reverse=True)
+            rows = self.embedding_store.rows([item.get("id") for item in candidates])
+            has_vec = rows >= 0
+            if not has_vec.any():
+                return []
+            query_vec = np.asarray(query_embedding, dtype=np.float32)
+            embedded = [item for item, ok in zip(candidates, has_vec) if ok]
+
+            scored_items = None
+            if retrieve_type == "ann" or self.index_type == "ivf":
+                scored_items = self._ann_search(query_vec, rows[has_vec], embedded, top_k)
+
+            if scored_items is None:
+                vectors = self.embedding_store.vectors[rows[has_vec]]
+                norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vec)
+                norms[norms == 0] = np.inf  # zero vectors score 0.0, as in cosine_similarity
+                similarities = (vectors @ query_vec) / norms
+
+                scored_items = list(zip(similarities.tolist(), embedded))
+                scored_items.sort(key=lambda x: x[0], reverse=True)
 
         elif retrieve_type == "bm25":
-            stemmer = SnowballStemmer("english")
-            
-            # Stem the corpus
-            corpus = [
-                [stemmer.stem(token) for token in f"{item.get('title', '')} {item.get('description', '')} {item.get('content', '')}".lower().split()]
-                for item in candidates
+            index = self._get_bm25_index()
+
+            # Score only the postings of the query terms, with statistics over the candidate set
+            scope = domain if (domain and index.domain_count[domain]) else None
+            sparse = index.get_scores(tokenize(query), domain=scope)
+            ranked = sorted(sparse.items(), key=lambda x: (-x[1], x[0]))[:top_k]
+            scored_items = [(score, self.memories[row]) for row, score in ranked]
+
+            # Pad with zero-score candidates in bank order, as a full BM25 ranking would
+            for row, item in enumerate(self.memories):
+                if len(scored_items) >= top_k:
+                    break
+                if row not in sparse and (scope is None or item.get("domain") == scope):
+                    scored_items.append((0.0, item))
+
+        elif retrieve_type == "hybrid":
+            # Both signals over the same candidates, fused into one ranking
+            index = self._get_bm25_index()
+            scope = domain if (domain and index.domain_count[domain]) else None
+            sparse_by_row = index.get_scores(tokenize(query), domain=scope)
+            candidate_rows = range(len(self.memories)) if scope is None else [
+                row for row, item in enumerate(self.memories) if item.get("domain") == scope
             ]
-            
-            # Stem the query
-            query_tokens = [stemmer.stem(token) for token in query.lower().split()]
-            
-            bm25 = BM25(corpus)
-            scores = bm25.get_scores(query_tokens)
-            
-            scored_items = list(zip(scores, candidates))
-            scored_items.sort(key=lambda x: x[0], reverse=True)
+            sparse = np.array([sparse_by_row.get(row, 0.0) for row in candidate_rows], dtype=np.float64)
+
+            dense = np.full(len(candidates), np.nan)
+            query_embedding = get_embedding(query)
+            if query_embedding:
+                rows = self.embedding_store.rows([item.get("id") for item in candidates])
+                has_vec = rows >= 0
+                vectors = self.embedding_store.vectors[rows[has_vec]]
+                query_vec = np.asarray(query_embedding, dtype=np.float32)
+                if len(vectors) and vectors.shape[1] == len(query_vec):
+                    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vec)
+                    norms[norms == 0] = np.inf
+                    dense[has_vec] = (vectors @ query_vec) / norms
+
+            fused = fuse_scores(dense, sparse, method=self.hybrid_fusion, dense_weight=self.hybrid_dense_weight)
+            order = np.argsort(-fused, kind="stable")[:top_k]
+            scored_items = [(fused[i], candidates[i]) for i in order]
 
         else:
             raise ValueError(f"Unknown retrieve_type: {retrieve_type}")
 
+        return scored_items
+
+    def retrieve(self, query: str, top_k: int = 3, domain: str = None, retrieve_type: str = "embedding") -> List[Dict[str, Any]]:
+        """
+        Retrieve relevant memory items based on the specified retrieval type.
+        Results are cached per (query, domain, top_k, retrieve_type) until the bank changes.
+        """
+        self._load_bank_read_only()
+
+        if not self.memories:
+            return []
+
+        # Rewrites bump the storage epoch; appends grow the content and the vectors (which land just after it)
+        version = (self.storage.epoch, len(self.memories), len(self.embedding_store.ids))
+        cache_key = (QueryCache.normalize(query), domain, top_k, retrieve_type,
+                     self.index_type, self.ann_nprobe, self.hybrid_fusion, self.hybrid_dense_weight)
+        scored_items = self.query_cache.get(cache_key, version) if self.query_cache is not None else None
+        if scored_items is None:
+            scored_items = self._rank(query, top_k, domain, retrieve_type)[:top_k]
+            if self.query_cache is not None:
+                self.query_cache.put(cache_key, version, scored_items)
+        self._record_hits([item for _, item in scored_items[:top_k]])
+
         top_items = []
         for sim, item in scored_items[:top_k]:
             top_items.append({
@@ -282,6 +697,22 @@ if __name__ == "__main__":
                         help="Path to the result directory, e.g., 'results/webarena.0'.")
     parser.add_argument("--reasoning_bank_path", type=str, default="reasoning_bank.json",
                         help="Path to Reasoning Bank storage file.")
+    parser.add_argument("--memory_capacity", type=int, default=None,
+                        help="Maximum number of items in the Reasoning Bank; the lowest-utility items are evicted to an archive file.")
+    parser.add_argument("--dedup_threshold", type=float, default=None,
+                        help="Skip new memory items at least this similar to a stored item with the same domain and score (default: off).")
+    parser.add_argument("--bank_backend", type=str, default=None, choices=["json", "sqlite"],
+                        help="Reasoning Bank storage backend (default: from the --reasoning_bank_path extension).")
+    parser.add_argument("--index_type", type=str, default=None, choices=["exact", "ivf"],
+                        help="Embedding search: exact scan or IVF approximate index (default: exact).")
+    parser.add_argument("--ann_nprobe", type=int, default=None,
+                        help="IVF lists probed per query.")
+    parser.add_argument("--ann_min_size", type=int, default=None,
+                        help="Banks smaller than this are always searched exactly.")
+    parser.add_argument("--hybrid_fusion", type=str, default=None, choices=["rrf", "zscore"],
+                        help="How retrieve_type=hybrid fuses embedding and BM25 scores (default: rrf).")
+    parser.add_argument("--hybrid_dense_weight", type=float, default=None,
+                        help="Weight of the embedding score in z-score fusion.")
     args = parser.parse_args()
 
     # 1. Parse Task ID and Load Config
@@ -363,7 +794,11 @@ if __name__ == "__main__":
         base, ext = os.path.splitext(storage_path)
         embedding_path = f"{base}_embeddings{ext}"
         
-        bank = ReasoningBank(storage_path=storage_path, embedding_path=embedding_path)
+        bank_kwargs = {option: getattr(args, option) for option in
+                       ("dedup_threshold", "index_type", "ann_nprobe", "ann_min_size", "hybrid_fusion", "hybrid_dense_weight")
+                       if getattr(args, option) is not None}
+        bank = ReasoningBank(storage_path=storage_path, embedding_path=embedding_path, capacity=args.memory_capacity,
+                             backend=args.bank_backend, **bank_kwargs)
         
         print(f"Adding {len(memory_items)} memory items for task {task_id} to Reasoning Bank...")
         bank.add_memory(
@@ -374,3 +809,4 @@ if __name__ == "__main__":
             domain=domain
         )
         print("Reasoning Bank updated successfully.")
+        print(f"Write stats: {bank.write_stats()['commit']}")
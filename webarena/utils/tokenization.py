@@ -0,0 +1,117 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str, default: Optional[str] = None) -> tiktoken.Encoding:
+    """
+    The tiktoken encoding of `model`, loaded once per process. If tiktoken does not know the model,
+    the encoding named `default` is used, or KeyError is raised when there is none.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        if default is None:
+            raise
+        return tiktoken.get_encoding(default)
+
+
+def text_key(text: str) -> bytes:
+    """Content hash of `text`, so the cache does not keep long prompts alive."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class TokenizationService:
+    """
+    Token counts of strings under one encoding (a tiktoken Encoding, or any tokenizer with `encode`),
+    memoized in a bounded LRU keyed by content hash. Prompts are rebuilt from the same long pieces
+    (observations, exemplars, AX trees) many times, so most counts are lookups. Strings missing from
+    the cache are encoded in one batch, with tiktoken's threaded batch encoder when available.
+    Thread-safe; encoding happens outside the lock.
+    """
+
+    def __init__(self, encoding, max_entries: int = 100_000, num_threads: int = 8):
+        self.encoding = encoding
+        self.max_entries = max_entries
+        self.num_threads = num_threads
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def _lookup(self, key: bytes) -> Optional[int]:
+        count = self._counts.get(key)
+        if count is not None:
+            self._counts.move_to_end(key)
+        return count
+
+    def _store(self, items: dict):
+        with self._lock:
+            self._counts.update(items)
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def _encode_lengths(self, texts: List[str]) -> List[int]:
+        if len(texts) > 1 and isinstance(self.encoding, tiktoken.Encoding):
+            return [len(tokens) for tokens in self.encoding.encode_batch(texts, num_threads=self.num_threads)]
+        return [len(self.encoding.encode(text)) for text in texts]
+
+    def count(self, text: str) -> int:
+        key = text_key(text)
+        with self._lock:
+            count = self._lookup(key)
+            if count is not None:
+                self.hits += 1
+                return count
+            self.misses += 1
+        count = len(self.encoding.encode(text))
+        self._store({key: count})
+        return count
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        """Token counts of `texts`, in order; each distinct uncached text is encoded once."""
+        keys = [text_key(text) for text in texts]
+        counts = {}
+        with self._lock:
+            for key in keys:
+                if key not in counts:
+                    count = self._lookup(key)
+                    if count is not None:
+                        counts[key] = count
+            self.hits += len(counts)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in counts:
+                missing.setdefault(key, text)
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            computed = dict(zip(missing, self._encode_lengths(list(missing.values()))))
+            self._store(computed)
+            counts.update(computed)
+        return [counts[key] for key in keys]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._counts), "hits": self.hits, "misses": self.misses}
+
+
+_SERVICES = {}
+_SERVICES_LOCK = threading.Lock()
+
+
+def get_tokenization_service(model: str, default: Optional[str] = None) -> TokenizationService:
+    """Process-wide TokenizationService for the tiktoken encoding of `model` (see get_encoding); models sharing an encoding share its cache."""
+    encoding = get_encoding(model, default)
+    with _SERVICES_LOCK:
+        if encoding.name not in _SERVICES:
+            _SERVICES[encoding.name] = TokenizationService(encoding)
+        return _SERVICES[encoding.name]